@@ -0,0 +1,85 @@
+"""
+Times target matching as the lexicon grows, medspacy's TargetMatcher against ed_nlp.lexicon.LexiconMatcher, and checks
+that both find the same entities.
+python3 benchmark_lexicon.py --sizes 10 100 1000 5000 --n-notes 500
+
+Lexicons are the rules in ed_nlp.resources.target_rules plus symptom terms and random stems (which rarely match, as
+most terms of a real lexicon don't appear in a given note), as prefix, substring, phrase and regex rules.
+Exits with an error if the matchers disagree.
+"""
+import argparse
+import csv
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+from ed_nlp.utils import load
+from ed_nlp.lexicon import LexiconMatcher, read_lexicon
+from ed_nlp.resources import target_rules
+from ed_nlp.synthetic import make_labeled_notes
+
+SYMPTOMS = [('nause', 'prefix'), ('fever', 'substring'), ('cough', 'substring'), ('rash', 'substring'),
+            ('diarrh', 'prefix'), ('abdominal pain', 'phrase'), ('neck stiffness', 'phrase'), ('decreased oral intake', 'phrase')]
+
+
+def write_lexicon(path: str, size: int, seed: int = 0):
+    rng = random.Random(seed)
+    rows = [{'literal': literal, 'category': 'PROBLEM', 'match': match, 'pattern': ''} for literal, match in SYMPTOMS]
+    rows.append({'literal': 'fevers', 'category': 'PROBLEM', 'match': 'regex', 'pattern': '^fevers?$'})
+    while len(rows) < size:
+        stem = ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(5, 9)))
+        match = rng.choice(['prefix', 'substring', 'phrase'])
+        literal = f'{stem} {stem[::-1]}' if match == 'phrase' else stem
+        rows.append({'literal': literal, 'category': 'PROBLEM', 'match': match, 'pattern': ''})
+    with open(path, 'w', newline = '', encoding = 'utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames = ['literal', 'category', 'match', 'pattern'])
+        writer.writeheader()
+        writer.writerows(rows[:size])
+
+
+def run(matcher, nlp, texts):
+    docs = [nlp.make_doc(text) for text in texts]
+    start = time.perf_counter()
+    docs = [matcher(doc) for doc in docs]
+    elapsed = time.perf_counter() - start
+    ents = [[(ent.start, ent.end, ent.label_, ent._.target_rule.literal) for ent in doc.ents] for doc in docs]
+    return elapsed, ents
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [10, 100, 1000, 5000], help = 'lexicon sizes')
+    parser.add_argument('--n-notes', type = int, default = 500)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    texts = [note['text'] for note in make_labeled_notes(args.n_notes, seed = args.seed)]
+    # the preprocessor and tokenizer of the pipeline, so notes are tokenized as they would be
+    nlp = load(fast_target_matcher = False)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            path = os.path.join(tmp_dir, f'lexicon-{size}.csv')
+            write_lexicon(path, size, seed = args.seed)
+
+            medspacy_matcher = nlp.create_pipe('medspacy_target_matcher')
+            medspacy_matcher.add(target_rules + read_lexicon(path))
+            lexicon_matcher = LexiconMatcher(nlp)
+            lexicon_matcher.add(target_rules + read_lexicon(path))
+
+            medspacy_s, medspacy_ents = run(medspacy_matcher, nlp, texts)
+            # the second run over the same notes shows the matcher once most words are cached
+            lexicon_s, lexicon_ents = run(lexicon_matcher, nlp, texts)
+            cached_s, _ = run(lexicon_matcher, nlp, texts)
+            same = sum(a == b for a, b in zip(medspacy_ents, lexicon_ents))
+            failed |= same != len(texts)
+            print(f'{size + len(target_rules)} rules: medspacy {medspacy_s:.3f}s, lexicon {lexicon_s:.3f}s '
+                  f'({cached_s:.3f}s on a second pass), {sum(map(len, lexicon_ents))} entities, identical notes {same}/{len(texts)}')
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,62 @@
+"""
+Times the vectorized postprocessor (`ed_nlp.postprocess`, `load(fast_postprocessor=True)`) against medspacy's
+`Postprocessor` with `postprocess_rules`. tests/test_postprocess.py checks that both give the same output.
+python3 compare_postprocessors.py --n-notes 1000
+
+Notes are run through the pipeline up to the postprocessor, twice, and each copy goes through one of the postprocessors.
+With the target rules every entity is a PROBLEM, so to exercise the label and text rules some entities are relabeled
+(to CHEMICAL, as from en_ner_bc5cdr_md) and 'presenting illness' entities are added, the same way for both copies.
+"""
+import argparse
+import random
+import time
+
+from spacy.tokens import Span
+
+from ed_nlp.utils import load
+from ed_nlp.postprocess import ArrayPostprocessor
+from ed_nlp.resources import array_postprocess_rules
+from ed_nlp.synthetic import make_labeled_notes
+
+def make_texts(n_notes: int, seed: int = 0):
+    """
+    synthetic notes, every other one with a lowercase 'history of presenting illness' title for `augment` to find
+    """
+    texts = [note['text'] for note in make_labeled_notes(n_notes, seed = seed)]
+    return [text.replace('Presenting Illness', 'presenting illness') if i % 2 else text for i, text in enumerate(texts)]
+
+
+def augment(doc, seed: int, relabel: float = 0.3):
+    rng = random.Random(seed)
+    ents = [Span(doc, ent.start, ent.end, label = 'CHEMICAL') if rng.random() < relabel else ent for ent in doc.ents]
+    start = doc.text.find('presenting illness')
+    span = doc.char_span(start, start + len('presenting illness')) if start >= 0 else None
+    if span is not None and not any(ent.start < span.end and span.start < ent.end for ent in ents):
+        ents.append(span if rng.random() < 0.5 else Span(doc, span.start, span.end, label = 'DISEASE'))
+    doc.ents = sorted(ents, key = lambda ent: ent.start)
+    return doc
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-notes', type = int, default = 1000)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    texts = make_texts(args.n_notes, seed = args.seed)
+    nlp = load(fast_postprocessor = False)
+    medspacy_postprocessor = nlp.get_pipe('medspacy_postprocessor')
+    array_postprocessor = ArrayPostprocessor(nlp)
+    array_postprocessor.add(array_postprocess_rules)
+
+    with nlp.select_pipes(disable = ['medspacy_postprocessor']):
+        for name, postprocessor in [('medspacy', medspacy_postprocessor), ('vectorized', array_postprocessor)]:
+            docs = [augment(doc, seed = args.seed + i) for i, doc in enumerate(nlp.pipe(texts))]
+            n_ents = sum(len(doc.ents) for doc in docs)
+            start = time.time()
+            docs = [postprocessor(doc) for doc in docs]
+            elapsed = time.time() - start
+            print(f'{name}: {n_ents} entities in {elapsed:.3f}s ({n_ents / max(elapsed, 1e-9):.0f} entities/s), '
+                  f'{sum(len(doc.ents) for doc in docs)} kept')
+
@@ -0,0 +1,64 @@
+"""
+Checks that section-aware extraction (`load(sections=NER_SECTIONS)`, see `ed_nlp.sections`) finds the same entities,
+with the same offsets, ConText modifiers and attributes, as the whole-note pipeline does within those sections, and
+times both.
+python3 compare_sections.py --n-notes 1000 --medications 40
+
+Synthetic notes are short, --medications adds a 'Current Outpatient Medications' list of that many lines to each note,
+as in the long notes section-aware extraction is meant for. Exits with an error if any note differs.
+"""
+import argparse
+import random
+import sys
+import time
+
+from ed_nlp.utils import load
+from ed_nlp.batch import doc_to_record
+from ed_nlp.sections import NER_SECTIONS, section_regions
+from ed_nlp.synthetic import make_labeled_notes
+
+MEDICATIONS = ['acetaminophen 160 mg/5 mL oral suspension', 'ibuprofen 100 mg/5 mL oral suspension', 'ondansetron 4 mg ODT',
+               'salbutamol 100 mcg/actuation inhaler', 'fluticasone 125 mcg/actuation inhaler', 'amoxicillin 400 mg/5 mL',
+               'cetirizine 5 mg/5 mL syrup', 'polyethylene glycol 17 g powder', 'methylphenidate 10 mg tablet']
+
+
+def add_medications(text: str, n: int, seed: int) -> str:
+    if not n:
+        return text
+    rng = random.Random(seed)
+    lines = '  '.join(f'{rng.choice(MEDICATIONS)}, take as directed, prn for headache or vomiting' for _ in range(n))
+    return f'{text}         Current Outpatient Medications  {lines}'
+
+
+def in_sections(doc, sections):
+    regions = [doc[start:end] for start, end in section_regions(doc, sections)]
+    return [ent for ent in doc_to_record(doc)['entities']
+            if any(span.start_char <= ent['start_char'] and ent['end_char'] <= span.end_char for span in regions)]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-notes', type = int, default = 1000)
+    parser.add_argument('--medications', type = int, default = 40, help = 'lines of medications added to each note')
+    parser.add_argument('--sentence-splitter', default = 'pysbd')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    texts = [add_medications(note['text'], args.medications, seed = args.seed + i)
+             for i, note in enumerate(make_labeled_notes(args.n_notes, seed = args.seed))]
+
+    results = {}
+    for name, sections in [('whole notes', None), ('sections', NER_SECTIONS)]:
+        nlp = load(sentence_splitter = args.sentence_splitter, sections = sections)
+        start = time.time()
+        docs = list(nlp.pipe(texts))
+        elapsed = time.time() - start
+        results[name] = [in_sections(doc, NER_SECTIONS) if sections is None else doc_to_record(doc)['entities'] for doc in docs]
+        print(f'{name}: {len(texts)} notes in {elapsed:.2f}s ({len(texts) / max(elapsed, 1e-9):.0f} notes/s), '
+              f'{sum(len(doc.ents) for doc in docs)} entities')
+
+    different = [i for i, (a, b) in enumerate(zip(results['whole notes'], results['sections'])) if a != b]
+    print(f'\nNotes with identical entities in {NER_SECTIONS}: {len(texts) - len(different)}/{len(texts)}')
+    if different:
+        sys.exit(1)
@@ -0,0 +1,72 @@
+"""
+Compares the sentence splitters available in `ed_nlp.load()` (pysbd and the rule-based newline splitter): throughput,
+agreement of sentence starts with pysbd, whether entities end up in the same sections and sentences and, with --labels,
+accuracy against an annotated sample.
+python3 compare_sentencizers.py --labels processed/sentence-labels.jsonl
+
+--labels is a JSONL file with one {"text": ..., "sentences": [...]} per note, where the sentences are the note's gold
+segmentation, in order: precision/recall/F1 of sentence starts and the proportion of notes segmented exactly are
+reported against it. Without it, synthetic notes (see ed_nlp.synthetic.make_labeled_notes) are used for timing and
+agreement only - their sentences are built from the same line structure the newline splitter splits on, so they can't
+tell how accurate it is.
+"""
+import argparse
+import json
+import time
+from functools import reduce
+
+import pandas as pd
+
+from ed_nlp.utils import load, get_entities
+from ed_nlp.sentences import SENTENCE_SPLITTERS, sentence_starts, gold_starts, boundary_scores
+from ed_nlp.synthetic import make_labeled_notes
+
+
+def entity_summary(doc):
+    return [(ent['start_char'], ent['section_category'], str(ent['current_sentence_extracted']).strip()) for ent in get_entities(doc, use_rules = True)]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--labels', default = None, help = 'annotated JSONL of {"text", "sentences"}, needed for accuracy')
+    parser.add_argument('--n-notes', type = int, default = 500, help = 'number of synthetic notes')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    if args.labels:
+        with open(args.labels, encoding = 'utf-8') as f:
+            labeled = [json.loads(line) for line in f]
+    else:
+        labeled = make_labeled_notes(args.n_notes, seed = args.seed)
+    texts = [note['text'] for note in labeled]
+
+    rows = []
+    entities, starts = {}, {}
+    # pysbd first, the others are compared to it
+    for splitter in sorted(SENTENCE_SPLITTERS, key = lambda splitter: splitter != 'pysbd'):
+        nlp = load(sentence_splitter = splitter)
+        start = time.time()
+        docs = list(nlp.pipe(texts))
+        elapsed = time.time() - start
+
+        starts[splitter] = [sentence_starts(doc) for doc in docs]
+        agreement = boundary_scores(starts[splitter], starts['pysbd'])
+        row = {'splitter': splitter, 'pysbd_f1': agreement['f1'], 'pysbd_exact': agreement['exact']}
+        if args.labels:
+            # gold sentences are preprocessed the same way as the notes, so offsets are comparable
+            preprocess = lambda text: reduce(lambda text, rule: rule(text), nlp.tokenizer.rules, text)
+            gold = [gold_starts(doc.text, note['sentences'], preprocess) for doc, note in zip(docs, labeled)]
+            row.update(boundary_scores(starts[splitter], gold))
+
+        entities[splitter] = [entity_summary(doc) for doc in docs]
+        rows.append({**row, 'n_sentences': sum(len(list(doc.sents)) for doc in docs),
+                     'seconds': elapsed, 'notes_per_s': len(docs) / max(elapsed, 1e-9)})
+
+    summary = pd.DataFrame(rows).set_index('splitter')
+    print(summary.round(4).to_string())
+    if not args.labels:
+        print('\nNo --labels given: synthetic notes, timing and agreement with pysbd only')
+
+    same = [a == b for a, b in zip(*entities.values())]
+    print(f"\nNotes with identical entities, sections and sentences across splitters: {sum(same)}/{len(same)}")
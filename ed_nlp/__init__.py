@@ -1,4 +1,40 @@
+"""
+Names are imported lazily on first access (PEP 562), so `import ed_nlp` doesn't pull in spaCy, medspacy or pandas
+until something that needs them is used.
+"""
+import importlib
 
-from . import resources
-from .utils import load, get_entities, query_results,  df_from_entity_json, get_regex_tbl, _set_attributes, create_doc_consumer
-__all__ = ["load", "resources", "get_entities", "query_results", "df_from_entity_json", "get_regex_tbl", "_set_attributes", "create_doc_consumer"]
\ No newline at end of file
+_exports = {
+    "load": ".utils",
+    "get_entities": ".utils",
+    "query_results": ".utils",
+    "df_from_entity_json": ".utils",
+    "get_regex_tbl": ".utils",
+    "get_regex_prevalence_tbl": ".utils",
+    "_set_attributes": ".utils",
+    "create_doc_consumer": ".utils",
+    "BatchExtractor": ".batch",
+    "run_batch": ".batch",
+    "EntityIndex": ".index",
+    "load_cached": ".artifact",
+    "instrument": ".profiling",
+    "ColumnarWriter": ".columnar",
+    "read_entities": ".columnar",
+    "run_incremental": ".incremental",
+    "ExtractionService": ".service",
+    "export_tables": ".export",
+}
+
+__all__ = ["load", "resources", "get_entities", "query_results", "df_from_entity_json", "get_regex_tbl", "get_regex_prevalence_tbl", "_set_attributes", "create_doc_consumer", "BatchExtractor", "run_batch", "EntityIndex", "load_cached", "instrument", "ColumnarWriter", "read_entities", "run_incremental", "ExtractionService", "export_tables"]
+
+
+def __getattr__(name):
+    if name == "resources":
+        return importlib.import_module(".resources", __name__)
+    if name in _exports:
+        return getattr(importlib.import_module(_exports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,96 @@
+"""
+Versioned, pickled snapshots of the fully assembled pipeline from `load()`.
+
+`load()` loads the spaCy/medspacy models and compiles every rule in `ed_nlp.resources`, which takes several seconds.
+`load_cached()` does this once and saves the result (including the compiled matcher, sectionizer, ConText and
+postprocessor state) with cloudpickle, as some rules are lambdas. Later calls with the same rules, config, pipeline code
+(`ed_nlp.cache.PIPELINE_MODULES`) and library versions unpickle the snapshot instead.
+
+    nlp = load_cached('models/ed_nlp', use_rules=True)
+"""
+import json
+import os
+import sys
+from typing import Any, Dict, Optional
+
+import spacy
+import srsly
+
+from .cache import pipeline_fingerprint
+from .utils import load, _set_attributes
+
+# bump when the snapshot format changes
+ARTIFACT_VERSION = 1
+
+
+def _library_versions() -> Dict[str, str]:
+    import medspacy
+
+    return {
+        "python": ".".join(str(v) for v in sys.version_info[:3]),
+        "spacy": spacy.__version__,
+        "medspacy": getattr(medspacy, "__version__", "unknown"),
+    }
+
+
+def artifact_metadata(load_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    everything a snapshot depends on, a snapshot is only reused if all of it matches
+    """
+    return {
+        "artifact_version": ARTIFACT_VERSION,
+        "fingerprint": pipeline_fingerprint(load_kwargs),
+        **_library_versions(),
+    }
+
+
+def _paths(artifact_dir: str, metadata: Dict[str, Any]):
+    stem = os.path.join(artifact_dir, f"ed_nlp-v{metadata['artifact_version']}-{metadata['fingerprint'][:16]}")
+    return stem + ".pkl", stem + ".json"
+
+
+def save_pipeline(nlp: spacy.Language, artifact_dir: str, load_kwargs: Dict[str, Any]) -> str:
+    """
+    snapshots a pipeline built with `load(**load_kwargs)`, returns the path of the snapshot
+    """
+    os.makedirs(artifact_dir, exist_ok=True)
+    metadata = artifact_metadata(load_kwargs)
+    pkl_path, meta_path = _paths(artifact_dir, metadata)
+
+    tmp_path = pkl_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(srsly.pickle_dumps(nlp))
+    os.replace(tmp_path, pkl_path)
+    srsly.write_json(meta_path, metadata)
+    return pkl_path
+
+
+def load_pipeline(artifact_dir: str, load_kwargs: Dict[str, Any]) -> Optional[spacy.Language]:
+    """
+    loads the snapshot matching `load_kwargs`, the current rules and library versions, or None if there isn't one
+    """
+    metadata = artifact_metadata(load_kwargs)
+    pkl_path, meta_path = _paths(artifact_dir, metadata)
+    if not (os.path.isfile(pkl_path) and os.path.isfile(meta_path)):
+        return None
+    with open(meta_path) as f:
+        if json.load(f) != metadata:
+            return None
+
+    with open(pkl_path, "rb") as f:
+        nlp = srsly.pickle_loads(f.read())
+    # extensions are registered on the spaCy classes, not stored in the pipeline
+    if load_kwargs.get("set_attributes", True):
+        _set_attributes()
+    return nlp
+
+
+def load_cached(artifact_dir: str, **load_kwargs) -> spacy.Language:
+    """
+    drop-in replacement for `load(**load_kwargs)` that reuses a snapshot in `artifact_dir`, building and saving one if needed
+    """
+    nlp = load_pipeline(artifact_dir, load_kwargs)
+    if nlp is None:
+        nlp = load(**load_kwargs)
+        save_pipeline(nlp, artifact_dir, load_kwargs)
+    return nlp
@@ -0,0 +1,251 @@
+"""
+Batch entity extraction over the tidy ED notes csv.
+
+Notes are streamed from disk in chunks, run through `nlp.pipe` and the output of `get_entities` is written as JSONL,
+one line per note, in the same order as the input.
+"""
+import json
+import os
+from itertools import islice
+from multiprocessing import Pool
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from .utils import load, get_entities
+from .storage import iter_partitions
+
+# (note text, {'csn': ..., 'date': ...})
+Note = Tuple[str, Dict[str, Any]]
+
+# pipeline held by each worker process, set by _init_worker
+_nlp = None
+_use_rules = True
+
+
+def iter_notes(
+    csv_path: str,
+    text_col: str = "ED Provider Notes",
+    csn_col: str = "CSN",
+    date_col: str = "Arrival Date",
+    chunksize: int = 10000,
+) -> Iterator[Note]:
+    """
+    streams (text, context) tuples from a csv of notes without loading the whole file.
+    `csv_path` can also be a year-partitioned parquet table (see `ed_nlp.storage`), which is read one year at a time.
+    rows with a missing note are skipped.
+    """
+    columns = [csn_col, date_col, text_col]
+    if os.path.isdir(csv_path):
+        reader = (df for _, df in iter_partitions(csv_path, columns=columns))
+    else:
+        reader = pd.read_csv(csv_path, usecols=columns, chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[chunk[text_col].notna()]
+        for csn, date, text in zip(chunk[csn_col], chunk[date_col], chunk[text_col]):
+            yield str(text), {"csn": _to_native(csn), "date": _to_native(date)}
+
+
+def _to_native(value: Any) -> Any:
+    """
+    converts numpy scalars and missing values into something json can serialize
+    """
+    if pd.isna(value):
+        return None
+    return value.item() if hasattr(value, "item") else value
+
+
+def _modifier_to_json(modifier) -> Dict[str, Any]:
+    """
+    flattens a ConTextModifier into the fields expected by the app's Context table
+    """
+    span, scope = modifier.span, modifier.scope
+    return {
+        "modifier_text": span.text,
+        "modifier_category": modifier._context_rule.category,
+        "modifier_direction": modifier._context_rule.direction,
+        "modifier_start_char": span.start_char,
+        "modifier_end_char": span.end_char,
+        "modifier_scope_start_char": scope.start_char,
+        "modifier_scope_end_char": scope.end_char,
+    }
+
+
+def doc_to_record(doc, use_rules: bool = True) -> Dict[str, Any]:
+    """
+    converts a processed doc into a json serializable record, spans in `get_entities` are cast to strings.
+    """
+    entities = []
+    for ent, ent_dict in zip(doc.ents, get_entities(doc, use_rules=use_rules)):
+        for key in ["current_sentence_extracted", "previous_sentence_extracted", "next_sentence_extracted", "section_title"]:
+            if ent_dict[key] is not None:
+                ent_dict[key] = str(ent_dict[key])
+        ent_dict["entity_modifiers"] = [list(mod) for mod in ent_dict["entity_modifiers"]]
+        ent_dict["modifiers"] = [_modifier_to_json(mod) for mod in ent._.modifiers]
+        entities.append(ent_dict)
+
+    return {"csn": doc._.csn, "date": doc._.date, "text": doc.text, "entities": entities}
+
+
+def process_notes(
+    nlp, notes: Iterable[Note], use_rules: bool = True, batch_size: int = 64, columnar: bool = False
+) -> Iterator[Dict[str, Any]]:
+    """
+    runs notes through `nlp.pipe` in a single process, setting the csn and date extensions on each doc.
+    with `columnar`, yields the output of `ed_nlp.columnar.doc_to_columns` instead of records.
+    """
+    to_output = doc_to_record
+    if columnar:
+        from .columnar import doc_to_columns
+
+        to_output = doc_to_columns
+    for doc, context in nlp.pipe(notes, as_tuples=True, batch_size=batch_size):
+        doc._.csn = context.get("csn")
+        doc._.date = context.get("date")
+        yield to_output(doc, use_rules=use_rules)
+
+
+def _load(load_kwargs: Dict[str, Any], artifact_dir: Optional[str] = None):
+    if artifact_dir is None:
+        return load(**load_kwargs)
+    from .artifact import load_cached
+
+    return load_cached(artifact_dir, **load_kwargs)
+
+
+def _init_worker(load_kwargs: Dict[str, Any], artifact_dir: Optional[str] = None):
+    global _nlp, _use_rules
+    _nlp = _load(load_kwargs, artifact_dir)
+    _use_rules = load_kwargs.get("use_rules", True)
+
+
+def _process_chunk(args: Tuple[List[Note], int, bool]) -> List[Dict[str, Any]]:
+    notes, batch_size, columnar = args
+    return list(process_notes(_nlp, notes, use_rules=_use_rules, batch_size=batch_size, columnar=columnar))
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BatchExtractor:
+    """
+    Holds a pool of worker processes, each with its own pipeline from `load()`.
+
+    Whole chunks of notes, including `get_entities`, are handled in the workers so throughput scales with the
+    number of processes; results are yielded back in input order. With `n_process=1` everything runs in-process.
+    With `artifact_dir`, pipelines are loaded from a snapshot (see `ed_nlp.artifact`) rather than rebuilt by each worker.
+    With `columnar`, the output of `ed_nlp.columnar.doc_to_columns` is yielded instead of records.
+    With `dedup`, notes with the same text (after the preprocess rules) are only processed once, see `ed_nlp.dedup`.
+
+        with BatchExtractor(n_process=8, use_rules=True) as extractor:
+            for record in extractor.extract(iter_notes('processed/ed-notes-tidy-patient-no-metadata.csv')):
+                ...
+    """
+
+    def __init__(
+        self,
+        n_process: int = 1,
+        batch_size: int = 64,
+        chunk_size: Optional[int] = None,
+        artifact_dir: Optional[str] = None,
+        columnar: bool = False,
+        dedup: bool = False,
+        **load_kwargs,
+    ):
+        self.n_process = n_process
+        self.batch_size = batch_size
+        # notes sent to a worker at once, large enough to amortize pickling
+        self.chunk_size = chunk_size or batch_size * 4
+        self.load_kwargs = load_kwargs
+        self.artifact_dir = artifact_dir
+        self.columnar = columnar
+        self.dedup = dedup
+        self.dedup_stats = None
+        self.use_rules = load_kwargs.get("use_rules", True)
+        self._pool = None
+        self._nlp = None
+
+    def __enter__(self):
+        if self.n_process > 1:
+            if self.artifact_dir is not None:
+                # build the snapshot once up front rather than in every worker
+                _load(self.load_kwargs, self.artifact_dir)
+            self._pool = Pool(self.n_process, initializer=_init_worker, initargs=(self.load_kwargs, self.artifact_dir))
+        else:
+            self._nlp = _load(self.load_kwargs, self.artifact_dir)
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def extract(self, notes: Iterable[Note]) -> Iterator[Dict[str, Any]]:
+        """
+        yields one record per note, in input order
+        """
+        if self._pool is None and self._nlp is None:
+            raise RuntimeError("BatchExtractor must be used as a context manager")
+        if self.dedup:
+            from .dedup import DedupStats, extract_unique
+
+            self.dedup_stats = DedupStats()
+            return extract_unique(notes, self._extract, stats=self.dedup_stats)
+        return self._extract(notes)
+
+    def _extract(self, notes: Iterable[Note]) -> Iterator[Dict[str, Any]]:
+        if self._pool is None:
+            yield from process_notes(self._nlp, notes, use_rules=self.use_rules, batch_size=self.batch_size,
+                                     columnar=self.columnar)
+            return
+
+        tasks = ((chunk, self.batch_size, self.columnar) for chunk in _chunked(notes, self.chunk_size))
+        for records in self._pool.imap(_process_chunk, tasks):
+            yield from records
+
+
+def run_batch(
+    csv_path: str,
+    out_path: str,
+    n_process: int = 1,
+    batch_size: int = 64,
+    text_col: str = "ED Provider Notes",
+    columnar: bool = False,
+    dedup: bool = False,
+    **load_kwargs,
+) -> int:
+    """
+    extracts entities for every note in `csv_path` and writes them to `out_path` as JSONL. returns the number of notes written.
+    with `columnar`, `out_path` is a directory of parquet tables instead, see `ed_nlp.columnar`.
+    with `dedup`, notes with the same text are only processed once, see `ed_nlp.dedup`.
+    """
+    if columnar:
+        from .columnar import ColumnarWriter
+
+        with BatchExtractor(n_process=n_process, batch_size=batch_size, columnar=True, dedup=dedup, **load_kwargs) as extractor, \
+                ColumnarWriter(out_path) as writer:
+            for columns in extractor.extract(iter_notes(csv_path, text_col=text_col)):
+                writer.write(columns)
+        if dedup:
+            print(extractor.dedup_stats)
+        return writer.n_docs
+
+    n_docs = 0
+    with BatchExtractor(n_process=n_process, batch_size=batch_size, dedup=dedup, **load_kwargs) as extractor, \
+            open(out_path, "w", encoding="utf-8") as f:
+        for record in extractor.extract(iter_notes(csv_path, text_col=text_col)):
+            f.write(json.dumps(record) + "\n")
+            n_docs += 1
+    if dedup:
+        print(extractor.dedup_stats)
+    return n_docs
@@ -0,0 +1,225 @@
+"""
+Persistent result cache and checkpointed extraction jobs.
+
+Results are keyed by a hash of the note text, the rules in `ed_nlp.resources`, the code of the pipeline
+(`PIPELINE_MODULES`) and the config passed to `load()`, so editing a rule, the code or the config invalidates the
+results it could affect. A job writes its output in
+shards and each finished shard is a checkpoint - an interrupted job picks up at the first unfinished shard.
+"""
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import sqlite3
+from contextlib import ExitStack
+from glob import glob
+from typing import Any, Dict, Iterable, List, Optional
+
+RESOURCE_MODULES = ["preprocess_rules", "target_rules", "section_rules", "context_rules", "postprocess_rules"]
+# ed_nlp modules whose code decides what `load()` builds and what a processed note's record holds
+PIPELINE_MODULES = ["utils", "preprocess", "postprocess", "lexicon", "sections", "dedup", "sentences", "profiling", "batch"]
+
+
+def code_fingerprint(modules: Optional[List[str]] = None) -> str:
+    """
+    hashes the source files of `modules` (`PIPELINE_MODULES` by default). they are read rather than imported, as
+    `load()` only imports some of them when they are used
+    """
+    digest = hashlib.sha256()
+    for name in PIPELINE_MODULES if modules is None else modules:
+        with open(os.path.join(os.path.dirname(__file__), f"{name}.py"), "rb") as f:
+            digest.update(name.encode("utf-8") + b"\x00" + f.read())
+    return digest.hexdigest()
+
+
+def resource_fingerprints() -> Dict[str, str]:
+    """
+    hashes the source of each module in `ed_nlp.resources`.
+    the source is used rather than the rule objects as some rules are lambdas, which can't be serialized.
+    """
+    fingerprints = {}
+    for name in RESOURCE_MODULES:
+        module = importlib.import_module(f"ed_nlp.resources.{name}")
+        fingerprints[name] = hashlib.sha256(inspect.getsource(module).encode("utf-8")).hexdigest()
+    return fingerprints
+
+
+def config_fingerprint(load_kwargs: Dict[str, Any]) -> str:
+    """
+    hashes the keyword arguments passed to `load()`, sets are sorted so the hash is stable
+    """
+    serialized = json.dumps(
+        load_kwargs, sort_keys=True, default=lambda x: sorted(x) if isinstance(x, (set, frozenset)) else str(x)
+    )
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def lexicon_fingerprint(load_kwargs: Dict[str, Any]) -> Optional[str]:
+    """
+    hashes the contents of the target lexicon passed to `load()`, if any
+    """
+    if load_kwargs.get("lexicon") is None:
+        return None
+    with open(load_kwargs["lexicon"], "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def pipeline_fingerprint(load_kwargs: Dict[str, Any]) -> str:
+    """
+    combined hash of the rule set, pipeline code and config, including the contents of the target lexicon if one is given
+    """
+    fingerprints = resource_fingerprints()
+    fingerprints["code"] = code_fingerprint()
+    if load_kwargs.get("lexicon") is not None:
+        fingerprints["lexicon"] = lexicon_fingerprint(load_kwargs)
+    rules = json.dumps(fingerprints, sort_keys=True)
+    return hashlib.sha256((rules + config_fingerprint(load_kwargs)).encode("utf-8")).hexdigest()
+
+
+def note_key(text: str, fingerprint: str) -> str:
+    return hashlib.sha256((fingerprint + "\x00" + text).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk key-value store (sqlite) mapping a note key to its processed text and entities.
+    Writes are only visible to other runs once `commit()` is called.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.commit()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Dict[str, Any]]:
+        found = {}
+        # sqlite limits the number of host parameters per statement
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT key, value FROM results WHERE key IN ({','.join('?' * len(batch))})", batch
+            )
+            found.update((key, json.loads(value)) for key, value in rows)
+        return found
+
+    def put_many(self, items: Iterable):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)",
+            ((key, json.dumps(value)) for key, value in items),
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+def _part_path(job_dir: str, shard_idx: int) -> str:
+    return os.path.join(job_dir, f"part-{shard_idx:05d}.jsonl")
+
+
+def _prepare_job_dir(job_dir: str, fingerprint: str, shard_size: int):
+    """
+    writes the job metadata, clearing checkpoints left behind by a run with different rules, config or shard size
+    """
+    os.makedirs(job_dir, exist_ok=True)
+    meta_path = os.path.join(job_dir, "_job.json")
+    meta = {"fingerprint": fingerprint, "shard_size": shard_size}
+
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == meta:
+                return
+        print(f"Rules or config changed since the last run, discarding checkpoints in {job_dir}")
+        for part in glob(os.path.join(job_dir, "part-*.jsonl")):
+            os.remove(part)
+
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+
+def run_checkpointed(
+    csv_path: str,
+    job_dir: str,
+    cache_path: Optional[str] = None,
+    shard_size: int = 10000,
+    n_process: int = 1,
+    batch_size: int = 64,
+    text_col: str = "ED Provider Notes",
+    artifact_dir: Optional[str] = None,
+    **load_kwargs,
+) -> List[str]:
+    """
+    extracts entities for every note in `csv_path`, writing one JSONL part per shard of `shard_size` notes into `job_dir`.
+
+    shards that already have a part are skipped, and notes found in the cache are not re-processed. the pipeline is only
+    loaded if there is something left to process. returns the part paths, in order.
+    """
+    # imported here so the fingerprints can be used (eg. by ed_nlp.artifact) without pandas
+    from .batch import BatchExtractor, iter_notes, _chunked
+
+    fingerprint = pipeline_fingerprint(load_kwargs)
+    _prepare_job_dir(job_dir, fingerprint, shard_size)
+    cache = ResultCache(cache_path or os.path.join(job_dir, "cache.sqlite"))
+
+    parts = []
+    with ExitStack() as stack:
+        stack.callback(cache.close)
+        extractor = None
+
+        for shard_idx, shard in enumerate(_chunked(iter_notes(csv_path, text_col=text_col), shard_size)):
+            part_path = _part_path(job_dir, shard_idx)
+            parts.append(part_path)
+            if os.path.isfile(part_path):
+                continue
+
+            keys = [note_key(text, fingerprint) for text, _ in shard]
+            cached = cache.get_many(list(set(keys)))
+            # notes with the same text are only processed once
+            missing = {}
+            for key, note in zip(keys, shard):
+                if key not in cached and key not in missing:
+                    missing[key] = note
+
+            if missing:
+                if extractor is None:
+                    extractor = stack.enter_context(
+                        BatchExtractor(n_process=n_process, batch_size=batch_size, artifact_dir=artifact_dir, **load_kwargs)
+                    )
+                new = {}
+                for key, record in zip(missing, extractor.extract(missing.values())):
+                    new[key] = {"text": record["text"], "entities": record["entities"]}
+                cache.put_many(new.items())
+                cache.commit()
+                cached.update(new)
+
+            # write to a temporary file first so a crash never leaves a partial part behind
+            tmp_path = part_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for key, (_, context) in zip(keys, shard):
+                    record = {"csn": context.get("csn"), "date": context.get("date"), **cached[key]}
+                    f.write(json.dumps(record) + "\n")
+            os.replace(tmp_path, part_path)
+            print(f"Shard {shard_idx}: {len(shard)} notes, {len(missing)} processed, {len(shard) - len(missing)} cached or duplicates")
+
+    return parts
+
+
+def merge_parts(parts: List[str], out_path: str) -> int:
+    """
+    concatenates job parts into a single JSONL file, returns the number of lines written
+    """
+    n_lines = 0
+    with open(out_path, "w", encoding="utf-8") as out:
+        for part in parts:
+            with open(part, encoding="utf-8") as f:
+                for line in f:
+                    out.write(line)
+                    n_lines += 1
+    return n_lines
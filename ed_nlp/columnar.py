@@ -0,0 +1,261 @@
+"""
+Columnar entity output, written as parquet instead of one JSON record (or dict of spaCy spans) per note.
+
+An output directory holds two tables:
+- docs.parquet: one row per note, doc_id, csn, date and the preprocessed note text
+- entities.parquet: one row per entity, with the doc_id of its note
+
+Sentences, the section title and the entity itself are stored as character offsets into the note text rather than
+copies of the text, so a sentence shared by several entities is stored once, in the note. Offsets are -1 where there is
+no span (no next sentence, no section title). Modifiers are list columns - a single flattened array of values per field
+with one offset per entity - instead of a list of dicts per entity.
+
+Docs are converted to columns as soon as they are processed, so no `Span` (or `Doc`) is kept alive, and rows are written
+in record batches of `batch_size` entities.
+
+    with ColumnarWriter('processed/ner-columnar') as writer:
+        for doc in nlp.pipe(texts):
+            writer.write(doc_to_columns(doc))
+    df = read_entities('processed/ner-columnar')
+"""
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import sentences
+
+DOCS_FILE = "docs.parquet"
+ENTITIES_FILE = "entities.parquet"
+MISSING = -1
+
+FLAGS = ["is_negated", "is_uncertain", "is_historical", "is_hypothetical", "is_family"]
+# (start, end) offset columns and the text column `read_entities` builds from them
+SPANS = {
+    "entity_text": ("start_char", "end_char"),
+    "current_sentence_extracted": ("sentence_start_char", "sentence_end_char"),
+    "previous_sentence_extracted": ("previous_sentence_start_char", "previous_sentence_end_char"),
+    "next_sentence_extracted": ("next_sentence_start_char", "next_sentence_end_char"),
+    "section_title": ("section_title_start_char", "section_title_end_char"),
+}
+MODIFIER_FIELDS = {
+    "modifier_literal": pa.string(),
+    "modifier_category": pa.string(),
+    "modifier_direction": pa.string(),
+    "modifier_start_char": pa.int32(),
+    "modifier_end_char": pa.int32(),
+    "modifier_scope_start_char": pa.int32(),
+    "modifier_scope_end_char": pa.int32(),
+}
+
+DOC_SCHEMA = pa.schema([
+    ("doc_id", pa.int64()),
+    ("csn", pa.int64()),
+    ("date", pa.string()),
+    ("text", pa.string()),
+])
+
+ENTITY_SCHEMA = pa.schema(
+    [
+        ("doc_id", pa.int64()),
+        ("entity_label", pa.dictionary(pa.int32(), pa.string())),
+        ("entity_literal", pa.dictionary(pa.int32(), pa.string())),
+        ("section_category", pa.dictionary(pa.int32(), pa.string())),
+    ]
+    + [(flag, pa.bool_()) for flag in FLAGS]
+    + [(col, pa.int32()) for span in SPANS.values() for col in span]
+    + [(name, pa.list_(dtype)) for name, dtype in MODIFIER_FIELDS.items()]
+)
+
+
+def _offsets(span) -> tuple:
+    return (MISSING, MISSING) if span is None else (span.start_char, span.end_char)
+
+
+def doc_to_columns(doc, use_rules: bool = True) -> Dict[str, Any]:
+    """
+    converts a processed doc into {'doc': {csn, date, text}, 'entities': {column: [value per entity]}}, with the
+    modifier fields flattened across entities and 'n_modifiers' per entity. only plain python values, so it can be
+    pickled back from a worker process.
+    """
+    columns = {name: [] for name in ["entity_label", "entity_literal", "section_category", "n_modifiers"] + FLAGS}
+    columns.update({col: [] for span in SPANS.values() for col in span})
+    columns.update({name: [] for name in MODIFIER_FIELDS})
+
+    for ent in doc.ents:
+        columns["entity_label"].append(ent.label_)
+        columns["entity_literal"].append(ent._.target_rule.literal if use_rules else None)
+        columns["section_category"].append(ent._.section_category)
+        for flag in FLAGS:
+            columns[flag].append(getattr(ent._, flag))
+
+        next_sent = sentences.next_sentence(ent)
+        spans = {
+            "entity_text": ent,
+            "current_sentence_extracted": sentences.get_sentence(ent),
+            "previous_sentence_extracted": sentences.sentence_span(doc, sentences.previous_sentence(ent)),
+            "next_sentence_extracted": None if next_sent is None else sentences.sentence_span(doc, next_sent),
+            "section_title": ent._.section_title,
+        }
+        for name, (start_col, end_col) in SPANS.items():
+            start, end = _offsets(spans[name])
+            columns[start_col].append(start)
+            columns[end_col].append(end)
+
+        columns["n_modifiers"].append(len(ent._.modifiers))
+        for modifier in ent._.modifiers:
+            rule = modifier._context_rule
+            columns["modifier_literal"].append(rule.literal)
+            columns["modifier_category"].append(rule.category)
+            columns["modifier_direction"].append(rule.direction)
+            columns["modifier_start_char"].append(modifier.span.start_char)
+            columns["modifier_end_char"].append(modifier.span.end_char)
+            columns["modifier_scope_start_char"].append(modifier.scope.start_char)
+            columns["modifier_scope_end_char"].append(modifier.scope.end_char)
+
+    return {"doc": {"csn": doc._.csn, "date": doc._.date, "text": doc.text}, "entities": columns}
+
+
+class ColumnarWriter:
+    """
+    Appends the output of `doc_to_columns` to docs.parquet and entities.parquet in `out_dir`, assigning doc ids in
+    the order docs are written. Rows are buffered and written as a record batch once `batch_size` entities (or docs) are held.
+    """
+
+    def __init__(self, out_dir: str, batch_size: int = 50000):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.batch_size = batch_size
+        self.n_docs = 0
+        self.n_entities = 0
+        self._docs = pq.ParquetWriter(os.path.join(out_dir, DOCS_FILE), DOC_SCHEMA)
+        self._entities = pq.ParquetWriter(os.path.join(out_dir, ENTITIES_FILE), ENTITY_SCHEMA)
+        self._reset()
+
+    def _reset(self):
+        self._doc_rows = {name: [] for name in DOC_SCHEMA.names}
+        self._entity_rows = {name: [] for name in ENTITY_SCHEMA.names}
+        self._modifier_offsets = [0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, columns: Dict[str, Any]) -> int:
+        """
+        buffers one doc, returns its doc_id
+        """
+        doc_id = self.n_docs
+        doc = columns["doc"]
+        self._doc_rows["doc_id"].append(doc_id)
+        self._doc_rows["csn"].append(doc["csn"])
+        self._doc_rows["date"].append(None if doc["date"] is None else str(doc["date"]))
+        self._doc_rows["text"].append(doc["text"])
+
+        entities = columns["entities"]
+        n_entities = len(entities["entity_label"])
+        self._entity_rows["doc_id"].extend([doc_id] * n_entities)
+        for name in ENTITY_SCHEMA.names[1:]:
+            self._entity_rows[name].extend(entities[name])
+        for n_modifiers in entities["n_modifiers"]:
+            self._modifier_offsets.append(self._modifier_offsets[-1] + n_modifiers)
+
+        self.n_docs += 1
+        self.n_entities += n_entities
+        if max(len(self._entity_rows["doc_id"]), len(self._doc_rows["doc_id"])) >= self.batch_size:
+            self.flush()
+        return doc_id
+
+    def flush(self):
+        if not self._doc_rows["doc_id"]:
+            return
+        self._docs.write_table(pa.Table.from_pydict(self._doc_rows, schema=DOC_SCHEMA))
+
+        offsets = pa.array(self._modifier_offsets, type=pa.int32())
+        arrays = []
+        for field in ENTITY_SCHEMA:
+            values = self._entity_rows[field.name]
+            if field.name in MODIFIER_FIELDS:
+                arrays.append(pa.ListArray.from_arrays(offsets, pa.array(values, type=MODIFIER_FIELDS[field.name])))
+            else:
+                arrays.append(pa.array(values, type=field.type))
+        self._entities.write_table(pa.Table.from_arrays(arrays, schema=ENTITY_SCHEMA))
+        self._reset()
+
+    def close(self):
+        if self._docs is None:
+            return
+        self.flush()
+        self._docs.close()
+        self._entities.close()
+        self._docs = self._entities = None
+
+
+def read_tables(out_dir: str, columns: Optional[List[str]] = None):
+    """
+    (docs, entities) as memory-mapped arrow tables, `columns` selects the entity columns
+    """
+    docs = pq.read_table(os.path.join(out_dir, DOCS_FILE), memory_map=True)
+    entities = pq.read_table(os.path.join(out_dir, ENTITIES_FILE), columns=columns, memory_map=True)
+    return docs, entities
+
+
+def _slice(texts: List[str], doc_ids: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> List[Optional[str]]:
+    return [None if start == MISSING else texts[doc_id][start:end] for doc_id, start, end in zip(doc_ids, starts, ends)]
+
+
+def _slice_spans(out_dir: str, df: pd.DataFrame, batch_size: int = 10000) -> Dict[str, np.ndarray]:
+    """
+    the text of every span in SPANS, reading the notes `batch_size` docs at a time rather than all at once. doc ids
+    are written in increasing order, in docs.parquet as in entities.parquet, so the entities of a batch of docs are a
+    contiguous range of `df`
+    """
+    doc_ids = df["doc_id"].to_numpy()
+    spans = {name: np.full(len(df), None, dtype=object) for name in SPANS}
+    docs = pq.ParquetFile(os.path.join(out_dir, DOCS_FILE), memory_map=True)
+    for batch in docs.iter_batches(batch_size=batch_size, columns=["doc_id", "text"]):
+        if not batch.num_rows:
+            continue
+        batch_ids = batch.column(0).to_numpy()
+        lo = np.searchsorted(doc_ids, batch_ids[0], side="left")
+        hi = np.searchsorted(doc_ids, batch_ids[-1], side="right")
+        if lo == hi:
+            continue
+        texts = batch.column(1).to_pylist()
+        for name, (start_col, end_col) in SPANS.items():
+            spans[name][lo:hi] = _slice(texts, doc_ids[lo:hi] - batch_ids[0], df[start_col].to_numpy()[lo:hi],
+                                        df[end_col].to_numpy()[lo:hi])
+    return spans
+
+
+def read_entities(out_dir: str, text: bool = True, modifiers: bool = False) -> pd.DataFrame:
+    """
+    one row per entity, replaces `df_from_entity_json`. offsets, flags and categories are converted straight from the
+    memory-mapped arrow columns (without going through python objects). with `text`, the entity, sentence and section
+    title columns of `df_from_entity_json` are sliced out of the note text (a batch of notes at a time), along with
+    'final_sentences', 'csn', 'date' and 'year'. modifier list columns are only read with `modifiers`, as converting
+    them makes one array per row.
+    """
+    columns = [name for name in ENTITY_SCHEMA.names if modifiers or name not in MODIFIER_FIELDS]
+    entities = pq.read_table(os.path.join(out_dir, ENTITIES_FILE), columns=columns, memory_map=True)
+    df = entities.to_pandas(split_blocks=True)
+    if not text:
+        return df
+
+    for name, values in _slice_spans(out_dir, df).items():
+        df[name] = values
+
+    doc_ids = df["doc_id"].to_numpy()
+    meta = pq.read_table(os.path.join(out_dir, DOCS_FILE), columns=["doc_id", "csn", "date"], memory_map=True)\
+        .to_pandas().set_index("doc_id")
+    df["csn"] = meta["csn"].reindex(doc_ids).to_numpy()
+    df["date"] = meta["date"].reindex(doc_ids).to_numpy()
+    df["final_sentences"] = (df["previous_sentence_extracted"] + df["current_sentence_extracted"]
+                             + df["next_sentence_extracted"].fillna(""))
+    df["year"] = pd.DatetimeIndex(df["date"]).year
+    return df.rename_axis("unique_sentence_id").reset_index()
@@ -0,0 +1,196 @@
+"""
+Deduplication of repeated note text, so identical content only goes through the pipeline once.
+
+Notes: Crystal exports contain true duplicate visits, with the same note under several CSNs. `extract_unique` keys each
+note by a hash of its normalized text - the text after the preprocess rules, which is what the pipeline sees, so notes
+with the same key get the same entities - runs the pipeline once per distinct key and fans the result out to every
+note with that key, with its own csn and date. Used by `BatchExtractor(dedup=True)` and `run_ner.py --dedup`.
+
+Blocks: most notes are built from templates, so the same lines (eg. 'Neuro: GCS 15, no focal deficits') recur across
+notes. With `load(block_cache=...)` the target matcher (or en_ner_bc5cdr_md's ner) and ConText are moved into a
+`BlockCache` pipe, which splits each note into blocks (its lines, as runs of whole sentences) and keeps the result of
+the last `block_cache` distinct blocks in memory. Only blocks it hasn't seen are run through the wrapped pipes, each as
+a copy of its own so its result only depends on its text, and results are mapped back onto the note as in
+`ed_nlp.sections`. ConText scopes end at the end of a sentence and target matches don't run over a line break, so a block's
+entities and modifiers don't depend on the rest of the note; the sectionizer and the postprocessor still run over the
+whole note, as do sentence lookups in `get_entities`. The pre-trained model's ner (`use_rules=False`) looks at the
+surrounding tokens, so it can't be cached per block.
+
+    nlp = load(block_cache=50000)
+    with BatchExtractor(n_process=8, dedup=True, block_cache=50000) as extractor:
+        ...
+"""
+import hashlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from spacy.attrs import IDX, SENT_START
+from spacy.language import Language
+from spacy.tokens import Doc, Span
+
+from .preprocess import FastPreprocessor
+from .sections import SectionNER, section_regions, _map_back
+from .sentences import sentence_index
+
+
+def text_normalizer() -> Callable[[str], str]:
+    """
+    the text of a note after the preprocess rules, as seen by the pipeline
+    """
+    from .resources import preprocess_rules
+
+    preprocessor = FastPreprocessor(tokenizer=None)
+    preprocessor.add(preprocess_rules)
+    return preprocessor.preprocess
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _with_context(output: Dict[str, Any], context: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    a copy of a record (or of the output of `ed_nlp.columnar.doc_to_columns`) with the csn and date of another note
+    """
+    fields = {"csn": context.get("csn"), "date": context.get("date")}
+    if "doc" in output:
+        return {**output, "doc": {**output["doc"], **fields}}
+    return {**output, **fields}
+
+
+class DedupStats:
+    def __init__(self):
+        self.notes = 0
+        self.processed = 0
+
+    def __repr__(self):
+        return f"DedupStats({self.notes} notes, {self.processed} processed, {self.notes - self.processed} duplicates)"
+
+
+def extract_unique(
+    notes: Iterable[Tuple[str, Dict[str, Any]]],
+    extract: Callable[[List[Tuple[str, Dict[str, Any]]]], Iterable[Dict[str, Any]]],
+    window: int = 10000,
+    normalize: Optional[Callable[[str], str]] = None,
+    stats: Optional[DedupStats] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    yields `extract`'s output for every note, in order, calling it with the notes whose normalized text hasn't been
+    seen. notes are read `window` at a time, and the outputs of the last `window` distinct texts are kept, so memory
+    stays bounded and duplicates are found within about two windows of each other.
+    """
+    from .batch import _chunked
+
+    normalize = normalize or text_normalizer()
+    seen: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+    for chunk in _chunked(notes, window):
+        keys = [text_key(normalize(text)) for text, _ in chunk]
+        new: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        for key, note in zip(keys, chunk):
+            if key not in seen and key not in new:
+                new[key] = note
+        for key, output in zip(new, extract(list(new.values()))):
+            seen[key] = output
+        if stats is not None:
+            stats.notes += len(chunk)
+            stats.processed += len(new)
+
+        for key, (_, context) in zip(keys, chunk):
+            seen.move_to_end(key)
+            yield _with_context(seen[key], context)
+        while len(seen) > window:
+            seen.popitem(last=False)
+
+
+def doc_blocks(doc: Doc, regions: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    token offsets (start, end) of the blocks of each region: a block starts at a sentence start following a newline
+    """
+    starts = [start for start in sentence_index(doc)[0] if start and "\n" in doc[start - 1].text_with_ws]
+    blocks = []
+    for start, end in regions:
+        # a region starts a block, and a block never runs past the end of its region
+        cuts = [start] + sorted(i for i in starts if start < i < end) + [end]
+        blocks.extend(zip(cuts[:-1], cuts[1:]))
+    return blocks
+
+
+def _block_key(doc: Doc, text: str, offsets: np.ndarray, start: int, end: int) -> bytes:
+    """
+    hash of a block's text, token offsets and sentence starts, which is all the wrapped pipes see
+    """
+    start_char = int(offsets[start, 0])
+    end_char = int(offsets[end - 1, 0]) + len(doc[end - 1])
+    digest = hashlib.sha256(text[start_char:end_char].encode("utf-8"))
+    block = offsets[start:end].copy()
+    block[:, 0] -= start_char
+    # the first token of a block always starts a sentence in the copy
+    block[0, 1] = 1
+    digest.update(block.tobytes())
+    return digest.digest()
+
+
+@Language.factory("ed_nlp_block_cache", default_config={"max_blocks": 50000, "sections": None})
+class BlockCache(SectionNER):
+    """
+    runs the pipes added with `add` only over blocks of text it hasn't seen yet, see the module docstring. with
+    `sections`, only those sections are processed, as with `SectionNER`.
+    """
+
+    def __init__(self, nlp: Language, name: str = "ed_nlp_block_cache", max_blocks: int = 50000,
+                 sections: Optional[List[str]] = None):
+        super().__init__(nlp, name=name, sections=sections or [])
+        self.whole_doc = sections is None
+        self.max_blocks = max_blocks
+        # block key -> processed copy of the block
+        self.cache: "OrderedDict[bytes, Doc]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _process(self, docs: List[Doc], batch_size: int = 128) -> List[Doc]:
+        regions, blocks, keys = {}, {}, {}
+        # the first occurrence of each new key, (doc, block)
+        pending: "OrderedDict[bytes, Tuple[int, int]]" = OrderedDict()
+        for i, doc in enumerate(docs):
+            regions[i] = [(0, len(doc))] if self.whole_doc and len(doc) else section_regions(doc, self.sections)
+            blocks[i] = doc_blocks(doc, regions[i])
+            offsets = doc.to_array([IDX, SENT_START]).reshape(-1, 2).astype(np.int64)
+            text = doc.text
+            keys[i] = [_block_key(doc, text, offsets, start, end) for start, end in blocks[i]]
+            for j, key in enumerate(keys[i]):
+                if key not in self.cache and key not in pending:
+                    pending[key] = (i, j)
+
+        # every new block is processed as a copy of its own, so what is cached only depends on the block's key
+        sub_docs, arrays = [], {}
+        for i, j in pending.values():
+            # the doc's arrays are read once rather than once per block
+            if i not in arrays:
+                array_head = Doc._get_array_attrs()
+                arrays[i] = (array_head, docs[i].to_array(array_head))
+            array_head, array = arrays[i]
+            start, end = blocks[i][j]
+            sub_docs.append(docs[i][start:end].as_doc(array_head=array_head, array=array))
+        for _, component in self.pipes:
+            if hasattr(component, "pipe"):
+                sub_docs = list(component.pipe(sub_docs, batch_size=batch_size))
+            else:
+                sub_docs = [component(sub_doc) for sub_doc in sub_docs]
+
+        self.cache.update(zip(pending, sub_docs))
+        self.misses += len(pending)
+        self.hits += sum(len(block_keys) for block_keys in keys.values()) - len(pending)
+
+        for i, doc in enumerate(docs):
+            if not blocks[i]:
+                continue
+            mapped: List[Span] = []
+            for (start, _), key in zip(blocks[i], keys[i]):
+                self.cache.move_to_end(key)
+                mapped.extend(_map_back(doc, self.cache[key], start))
+            outside = [ent for ent in doc.ents if not any(ent.start < end and start < ent.end for start, end in regions[i])]
+            doc.ents = sorted(outside + mapped, key=lambda ent: ent.start)
+        while len(self.cache) > self.max_blocks:
+            self.cache.popitem(last=False)
+        return docs
@@ -0,0 +1,139 @@
+"""
+De-identification of free text notes.
+
+All redaction rules are compiled into a single alternation, so each note is scanned once and the number of redactions made by
+each rule is counted as the note is rewritten (a single rule is compiled as-is, which keeps `^` anchored patterns fast). Large columns are split into chunks and redacted across processes.
+"""
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class RedactionRule(NamedTuple):
+    """
+    matches of `pattern` are replaced by the literal string `repl`. `max_per_note` is the most redactions expected in a single note, used by `check_counts`.
+    """
+    name: str
+    pattern: str
+    repl: str
+    max_per_note: Optional[int] = None
+
+
+# standard pattern consisting of John doe, a X y.o. Y m.o male presented....
+DEFAULT_RULES = [
+    RedactionRule(
+        name="patient_name",
+        pattern=r"^([A-Za-z].*?)presented",
+        repl="[Patient Name Redacted] presented",
+        max_per_note=1,
+    ),
+]
+
+
+class Redactor:
+    def __init__(self, rules: List[RedactionRule] = DEFAULT_RULES):
+        self.rules = list(rules)
+        self.names = [rule.name for rule in self.rules]
+        self._repl = {f"_r{i}": rule.repl for i, rule in enumerate(self.rules)}
+        self._index = {f"_r{i}": i for i in range(len(self.rules))}
+        if len(self.rules) == 1:
+            # wrapping a pattern in a group stops re from skipping ahead on a leading ^, so keep a single rule as-is
+            self.pattern = re.compile(self.rules[0].pattern)
+        else:
+            self.pattern = re.compile("|".join(f"(?P<_r{i}>{rule.pattern})" for i, rule in enumerate(self.rules)))
+
+    def redact(self, text: str) -> Tuple[str, List[int]]:
+        """
+        redacts a single note, returning the new text and the number of redactions per rule
+        """
+        if len(self.rules) == 1:
+            repl = self.rules[0].repl
+            text, n = self.pattern.subn(lambda match: repl, text)
+            return text, [n]
+
+        counts = [0] * len(self.rules)
+
+        def replace(match):
+            counts[self._index[match.lastgroup]] += 1
+            return self._repl[match.lastgroup]
+
+        return self.pattern.sub(replace, text), counts
+
+    def redact_many(self, texts: Iterable) -> Tuple[List, np.ndarray]:
+        """
+        redacts a sequence of notes. values that aren't strings (eg. missing notes) are returned unchanged with NaN counts.
+        """
+        out = []
+        counts = []
+        missing = [np.nan] * len(self.rules)
+        for text in texts:
+            if isinstance(text, str):
+                text, note_counts = self.redact(text)
+                counts.append(note_counts)
+            else:
+                counts.append(missing)
+            out.append(text)
+        return out, np.array(counts, dtype=float).reshape(len(out), len(self.rules))
+
+
+_redactors = {}
+
+
+def _redact_chunk(args) -> Tuple[List, np.ndarray]:
+    rules, texts = args
+    key = tuple(rules)
+    if key not in _redactors:
+        _redactors[key] = Redactor(rules)
+    return _redactors[key].redact_many(texts)
+
+
+def redact_notes(
+    notes: pd.Series, rules: List[RedactionRule] = DEFAULT_RULES, n_process: int = 1, chunksize: int = 50000
+) -> Tuple[pd.Series, pd.DataFrame]:
+    """
+    redacts a column of notes, returning the redacted notes and a dataframe with the number of redactions per note (rows) and rule (columns).
+    both share the index of `notes`; counts are NaN where the note is missing.
+    """
+    values = notes.tolist()
+    chunks = [(rules, values[start:start + chunksize]) for start in range(0, len(values), chunksize)]
+
+    if n_process > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_process) as executor:
+            results = list(executor.map(_redact_chunk, chunks))
+    else:
+        results = [_redact_chunk(chunk) for chunk in chunks]
+
+    texts = [text for chunk_texts, _ in results for text in chunk_texts]
+    counts = np.concatenate([chunk_counts for _, chunk_counts in results]) if results else np.empty((0, len(rules)))
+
+    redacted = pd.Series(texts, index=notes.index, name=notes.name, dtype=object)
+    counts_df = pd.DataFrame(counts, index=notes.index, columns=[rule.name for rule in rules])
+    return redacted, counts_df
+
+
+def check_counts(counts: pd.DataFrame, rules: List[RedactionRule] = DEFAULT_RULES):
+    """
+    raises an AssertionError if any note has more redactions for a rule than its `max_per_note`
+    """
+    for rule in rules:
+        if rule.max_per_note is None:
+            continue
+        n_over = int((counts[rule.name] > rule.max_per_note).sum())
+        assert n_over == 0, f"{n_over} notes have more than {rule.max_per_note} '{rule.name}' redactions"
+
+
+def summarize_counts(counts: pd.DataFrame, year: pd.Series) -> pd.DataFrame:
+    """
+    number of redactions, notes and the proportion of notes redacted per year, with a (rule, statistic) column for each rule.
+    `year` is aligned to `counts` on the index.
+    """
+    grouped = counts.groupby(year.rename("year"))
+    summaries = {}
+    for rule in counts.columns:
+        summary_cts = grouped[rule].agg(["sum", "count"])
+        summary_cts["prop"] = summary_cts["sum"] / summary_cts["count"]
+        summaries[rule] = summary_cts
+    return pd.concat(summaries, axis=1)
@@ -0,0 +1,317 @@
+"""
+Streaming export of the NER output (output_ner_full.jsonl) to the app database tables, as files the database loads
+natively instead of going through the ORM or executemany inserts (`upload_docs.py`).
+
+An output directory holds one file per table, doc, entity and context, as csv or parquet, with the columns of
+`models.Doc`, `models.Entity` and `models.Context` (the same rows as `upload_docs.records_to_rows`). Entity ids are
+assigned here, from `start_ent_id`, so context rows reference their entity without a round trip; context rows can be
+given ids too (`context_id=`), for a Context table whose primary key isn't auto-incremented.
+
+The JSONL is read `chunk_size` records at a time and each chunk is written out before the next is parsed, so memory
+doesn't grow with the file. Lines are parsed with orjson when it is installed, otherwise with the ujson bundled in
+srsly (a spaCy dependency), both faster than json.
+
+csv files are written for LOAD DATA (MySQL) and COPY (Postgres): a header line, strings always quoted, missing values
+as an unquoted NULL and flags as 1/0, see `bulk_load_statements`. `load_sqlite` loads an export into SQLite, for testing.
+
+    export_tables('processed/output_ner_full.jsonl', 'processed/tables', fmt='csv', start_ent_id=1)
+    for statement in bulk_load_statements('processed/tables', dialect='mysql'):
+        print(statement)
+"""
+import csv
+import json
+import os
+import sqlite3
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+FORMATS = ["csv", "parquet"]
+TABLES = ["doc", "entity", "context"]
+
+DOC_SCHEMA = pa.schema([
+    ("csn", pa.int64()),
+    ("text", pa.string()),
+    ("date", pa.string()),
+])
+
+ENTITY_SCHEMA = pa.schema([
+    ("ent_id", pa.int64()),
+    ("csn", pa.int64()),
+    ("text", pa.string()),
+    ("start_char", pa.int32()),
+    ("end_char", pa.int32()),
+    ("is_negated", pa.bool_()),
+    ("is_uncertain", pa.bool_()),
+    ("is_historical", pa.bool_()),
+    ("is_hypothetical", pa.bool_()),
+    ("is_family", pa.bool_()),
+    ("sentence", pa.string()),
+    ("section_category", pa.string()),
+    ("section_title", pa.string()),
+])
+
+CONTEXT_SCHEMA = pa.schema([
+    ("ent_id", pa.int64()),
+    ("modifier_text", pa.string()),
+    ("modifier_category", pa.string()),
+    ("modifier_direction", pa.string()),
+    ("modifier_start_char", pa.int32()),
+    ("modifier_end_char", pa.int32()),
+    ("modifier_scope_start_char", pa.int32()),
+    ("modifier_scope_end_char", pa.int32()),
+])
+
+# record field each column is read from, when it isn't named the same
+ENTITY_FIELDS = {"text": "entity_text", "sentence": "current_sentence_extracted"}
+
+
+def json_loads() -> Callable[[str], Any]:
+    """
+    the fastest JSON parser available: orjson, srsly's ujson, or json
+    """
+    try:
+        import orjson
+
+        return orjson.loads
+    except ImportError:
+        pass
+    try:
+        from srsly import ujson
+
+        return ujson.loads
+    except ImportError:
+        return json.loads
+
+
+def table_schemas(context_id: Optional[str] = None) -> Dict[str, pa.Schema]:
+    """
+    the schema of each table, with `context_id` as the first column of the context table if given
+    """
+    context = CONTEXT_SCHEMA.insert(0, pa.field(context_id, pa.int64())) if context_id else CONTEXT_SCHEMA
+    return {"doc": DOC_SCHEMA, "entity": ENTITY_SCHEMA, "context": context}
+
+
+def table_path(out_dir: str, table: str, fmt: str) -> str:
+    return os.path.join(out_dir, f"{table}.{fmt}")
+
+
+def records_to_columns(
+    records: List[Dict[str, Any]], next_ent_id: int, context_id: Optional[str] = None, next_context_id: int = 1
+) -> Tuple[Dict[str, Dict[str, list]], int, int]:
+    """
+    the doc, entity and context columns of parsed records ({table: {column: [values]}}), with entity ids from
+    `next_ent_id` and, with `context_id`, context ids from `next_context_id`. returns them with the next free ids.
+    """
+    doc = {name: [] for name in DOC_SCHEMA.names}
+    entity = {name: [] for name in ENTITY_SCHEMA.names}
+    context = {name: [] for name in CONTEXT_SCHEMA.names}
+    entity_fields = [(name, ENTITY_FIELDS.get(name, name)) for name in ENTITY_SCHEMA.names[2:]]
+    context_fields = CONTEXT_SCHEMA.names[1:]
+    ent_id = next_ent_id
+
+    for record in records:
+        csn = record.get("csn")
+        doc["csn"].append(csn)
+        doc["text"].append(record.get("text"))
+        doc["date"].append(record.get("date"))
+
+        for ent in record["entities"]:
+            entity["ent_id"].append(ent_id)
+            entity["csn"].append(csn)
+            for name, field in entity_fields:
+                entity[name].append(ent.get(field))
+            for modifier in ent.get("modifiers", []):
+                context["ent_id"].append(ent_id)
+                for name in context_fields:
+                    context[name].append(modifier.get(name))
+            ent_id += 1
+
+    if context_id:
+        n_modifiers = len(context["ent_id"])
+        context = {context_id: list(range(next_context_id, next_context_id + n_modifiers)), **context}
+        next_context_id += n_modifiers
+    return {"doc": doc, "entity": entity, "context": context}, ent_id, next_context_id
+
+
+class _Null(float):
+    """
+    a missing value. a QUOTE_NONNUMERIC csv writer only leaves numbers unquoted, so this is written as a bare NULL
+    while a string 'NULL' is quoted
+    """
+
+    def __repr__(self):
+        return "NULL"
+
+    __str__ = __repr__
+
+
+NULL = _Null()
+
+
+def _csv_column(values: list, dtype: pa.DataType) -> list:
+    if pa.types.is_boolean(dtype):
+        return [NULL if value is None else int(value) for value in values]
+    return [NULL if value is None else value for value in values]
+
+
+class TableWriter:
+    """
+    Writes the columns of each chunk to the files of the doc, entity and context tables in `out_dir`, as csv or
+    parquet (one row group per chunk).
+    """
+
+    def __init__(self, out_dir: str, fmt: str = "csv", context_id: Optional[str] = None):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown format {fmt!r}, expected one of {FORMATS}")
+        os.makedirs(out_dir, exist_ok=True)
+        self.fmt = fmt
+        self.schemas = table_schemas(context_id)
+        self.paths = {table: table_path(out_dir, table, fmt) for table in TABLES}
+        self.n_rows = {table: 0 for table in TABLES}
+        self._files, self._writers = {}, {}
+        for table, schema in self.schemas.items():
+            tmp_path = self.paths[table] + ".tmp"
+            if fmt == "csv":
+                self._files[table] = open(tmp_path, "w", encoding="utf-8", newline="")
+                self._writers[table] = csv.writer(self._files[table], quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+                self._writers[table].writerow(schema.names)
+            else:
+                self._writers[table] = pq.ParquetWriter(tmp_path, schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(keep=exc_type is None)
+
+    def write(self, columns: Dict[str, Dict[str, list]]):
+        for table, schema in self.schemas.items():
+            values = columns[table]
+            n_rows = len(next(iter(values.values())))
+            if not n_rows:
+                continue
+            if self.fmt == "csv":
+                self._writers[table].writerows(zip(*(_csv_column(values[field.name], field.type) for field in schema)))
+            else:
+                self._writers[table].write_table(pa.Table.from_pydict(values, schema=schema))
+            self.n_rows[table] += n_rows
+
+    def close(self, keep: bool = True):
+        """
+        closes the files, which replace the previous export unless `keep` is False
+        """
+        if not self._writers:
+            return
+        for table in TABLES:
+            (self._files[table] if self.fmt == "csv" else self._writers[table]).close()
+            tmp_path = self.paths[table] + ".tmp"
+            if keep:
+                os.replace(tmp_path, self.paths[table])
+            else:
+                os.remove(tmp_path)
+        self._files, self._writers = {}, {}
+
+
+def _chunks(path: str, chunk_size: int, loads: Callable[[str], Any]) -> Iterator[List[Dict[str, Any]]]:
+    with open(path, "r", encoding="utf-8") as f:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                return
+            yield [loads(line) for line in lines if line.strip()]
+
+
+def export_tables(
+    jsonl_path: str,
+    out_dir: str,
+    fmt: str = "csv",
+    start_ent_id: int = 1,
+    context_id: Optional[str] = None,
+    start_context_id: int = 1,
+    chunk_size: int = 1000,
+    loads: Optional[Callable[[str], Any]] = None,
+) -> Dict[str, int]:
+    """
+    writes the doc, entity and context tables of the records in `jsonl_path` to `out_dir`, reading `chunk_size`
+    records at a time. entity ids start at `start_ent_id`, which should be past the largest id already in the Entity
+    table; with `context_id`, context rows get ids from `start_context_id` in a column of that name.
+    returns the number of rows written per table.
+    """
+    loads = loads or json_loads()
+    next_ent_id = start_ent_id
+    next_context_id = start_context_id
+    with TableWriter(out_dir, fmt=fmt, context_id=context_id) as writer:
+        for records in _chunks(jsonl_path, chunk_size, loads):
+            columns, next_ent_id, next_context_id = records_to_columns(records, next_ent_id, context_id, next_context_id)
+            writer.write(columns)
+    return writer.n_rows
+
+
+def bulk_load_statements(
+    out_dir: str, dialect: str = "mysql", context_id: Optional[str] = None, local: bool = True
+) -> List[str]:
+    """
+    LOAD DATA (mysql) or COPY (postgres) statements loading a csv export into the doc, entity and context tables, in
+    that order, so foreign keys are satisfied. `local` reads the files from the client (LOAD DATA LOCAL, psql's \\copy)
+    rather than from the database server.
+    """
+    statements = []
+    for table, schema in table_schemas(context_id).items():
+        path = os.path.abspath(table_path(out_dir, table, "csv"))
+        columns = ", ".join(schema.names)
+        if dialect == "mysql":
+            statements.append(
+                f"LOAD DATA {'LOCAL ' if local else ''}INFILE '{path}' INTO TABLE {table} CHARACTER SET utf8mb4 "
+                f"FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' LINES TERMINATED BY '\\n' "
+                f"IGNORE 1 LINES ({columns});"
+            )
+        elif dialect == "postgres":
+            # \\copy is a psql meta-command, which ends at the end of the line rather than at a semicolon
+            command, end = ("\\copy", "") if local else ("COPY", ";")
+            statements.append(
+                f"{command} {table} ({columns}) FROM '{path}' WITH (FORMAT csv, HEADER true, NULL 'NULL'){end}"
+            )
+        else:
+            raise ValueError(f"Unknown dialect {dialect!r}, expected 'mysql' or 'postgres'")
+    return statements
+
+
+def _sqlite_type(dtype: pa.DataType) -> str:
+    return "TEXT" if pa.types.is_string(dtype) else "INTEGER"
+
+
+def _read_batches(path: str, schema: pa.Schema, fmt: str) -> Iterator[pa.RecordBatch]:
+    if fmt == "parquet":
+        yield from pq.ParquetFile(path).iter_batches(batch_size=10000)
+        return
+    import pyarrow.csv as pa_csv
+
+    convert_options = pa_csv.ConvertOptions(
+        column_types=schema, null_values=["NULL"], strings_can_be_null=True, quoted_strings_can_be_null=False
+    )
+    with pa_csv.open_csv(path, convert_options=convert_options) as reader:
+        yield from reader
+
+
+def load_sqlite(out_dir: str, db_path: str, fmt: str = "csv", context_id: Optional[str] = None) -> Dict[str, int]:
+    """
+    appends an export to the doc, entity and context tables of a SQLite database, created if they don't exist.
+    files are read in record batches. returns the number of rows loaded per table.
+    """
+    n_rows = {}
+    primary_keys = {"doc": "csn", "entity": "ent_id", "context": context_id}
+    with sqlite3.connect(db_path) as conn:
+        for table, schema in table_schemas(context_id).items():
+            columns = [f"{field.name} {_sqlite_type(field.type)}" for field in schema]
+            if primary_keys[table]:
+                columns.append(f"PRIMARY KEY ({primary_keys[table]})")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})")
+            insert = f"INSERT INTO {table} ({', '.join(schema.names)}) VALUES ({', '.join('?' * len(schema))})"
+            n_rows[table] = 0
+            for batch in _read_batches(table_path(out_dir, table, fmt), schema, fmt):
+                conn.executemany(insert, zip(*(column.to_pylist() for column in batch.columns)))
+                n_rows[table] += batch.num_rows
+    return n_rows
@@ -0,0 +1,229 @@
+"""
+Incremental re-extraction: processed docs are saved part-way through the pipeline, so a rule change only reruns the
+pipes downstream of it.
+
+Notes are processed in shards and two checkpoints are kept per shard, as DocBin files:
+- tokens: after the preprocessor and the sentence splitter, ie. tokens and sentence boundaries
+- targets: after the target matcher, with the index of each entity's target rule so `ent._.target_rule` can be set again
+
+A checkpoint is keyed by a hash of the resource modules and the ed_nlp code it depends on (`CHECKPOINT_RESOURCES`,
+`CHECKPOINT_MODULES`), the config passed to `load()` and the texts of the shard's notes. Editing context_rules,
+section_rules or postprocess_rules reuses the targets checkpoint and reruns ConText, the sectionizer and the
+postprocessor; editing target_rules, the lexicon or lexicon.py reuses the tokens checkpoint; editing preprocess_rules,
+preprocess.py or sentences.py reruns everything. ConText's output (modifier objects
+holding rules and spans) can't be serialized, so a change to the postprocess rules alone still reruns ConText.
+With the pre-trained model (`use_rules=False`) there is no target matcher and only the tokens checkpoint is kept.
+
+    parts = run_incremental('processed/ed-notes-tidy-patient-no-metadata.csv', 'processed/ner-docs', n_process=8)
+    merge_parts(parts, 'processed/output_ner_full.jsonl')
+"""
+import hashlib
+import json
+import os
+import shutil
+from glob import glob
+from multiprocessing import Pool
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from spacy.tokens import DocBin
+
+from .cache import (resource_fingerprints, code_fingerprint, config_fingerprint, lexicon_fingerprint, pipeline_fingerprint,
+                    _prepare_job_dir, _part_path)
+from .sentences import SENTENCE_SPLITTERS
+
+CHECKPOINTS = ["tokens", "targets"]
+# resource modules the pipes before each checkpoint depend on
+CHECKPOINT_RESOURCES = {"tokens": ["preprocess_rules"], "targets": ["preprocess_rules", "target_rules"]}
+# ed_nlp modules whose code builds those pipes, or saves and restores the checkpoints
+CHECKPOINT_MODULES = {"tokens": ["utils", "preprocess", "sentences", "incremental"],
+                      "targets": ["utils", "preprocess", "sentences", "lexicon", "incremental"]}
+TARGET_MATCHER = "medspacy_target_matcher"
+TARGET_RULES_KEY = "ed_nlp_target_rules"
+
+
+def checkpoint_fingerprint(stage: str, load_kwargs: Dict[str, Any]) -> str:
+    """
+    hash of what the docs saved at `stage` depend on: its resource modules, code, the lexicon and the `load()` config
+    """
+    fingerprints = resource_fingerprints()
+    parts = {name: fingerprints[name] for name in CHECKPOINT_RESOURCES[stage]}
+    parts["code"] = code_fingerprint(CHECKPOINT_MODULES[stage])
+    if stage == "targets":
+        parts["lexicon"] = lexicon_fingerprint(load_kwargs)
+    serialized = json.dumps(parts, sort_keys=True) + config_fingerprint(load_kwargs)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def stage_pipes(nlp) -> Dict[str, List[str]]:
+    """
+    the pipes run before each checkpoint, and after the last one ('rest')
+    """
+    names = nlp.pipe_names
+    if not names or names[0] not in SENTENCE_SPLITTERS.values():
+        raise ValueError(f"The first pipe should be a sentence splitter, got {names[:1]}")
+    if TARGET_MATCHER not in names:
+        return {"tokens": names[:1], "rest": names[1:]}
+    i = names.index(TARGET_MATCHER)
+    return {"tokens": names[:1], "targets": names[1:i + 1], "rest": names[i + 1:]}
+
+
+def _checkpoint_dir(job_dir: str, stage: str, fingerprint: str) -> str:
+    return os.path.join(job_dir, f"{stage}-{fingerprint[:16]}")
+
+
+def _remove_stale_checkpoints(job_dir: str, fingerprints: Dict[str, str]):
+    """
+    removes the checkpoints saved with other rules or config, they would only take up disk space
+    """
+    for stage, fingerprint in fingerprints.items():
+        current = _checkpoint_dir(job_dir, stage, fingerprint)
+        for path in glob(os.path.join(job_dir, f"{stage}-*")):
+            if path != current:
+                shutil.rmtree(path)
+
+
+def _run_pipes(nlp, docs: Iterable, names: List[str], batch_size: int) -> Iterable:
+    for name in names:
+        proc = nlp.get_pipe(name)
+        docs = proc.pipe(docs, batch_size=batch_size) if hasattr(proc, "pipe") else map(proc, docs)
+    return docs
+
+
+def _save(docs: List, path: str):
+    """
+    saves docs with their user data, less the target rules (which aren't serializable)
+    """
+    doc_bin = DocBin(store_user_data=True)
+    for doc in docs:
+        user_data = doc.user_data
+        doc.user_data = {key: value for key, value in user_data.items()
+                         if not (isinstance(key, tuple) and len(key) > 1 and key[1] == "target_rule")}
+        doc_bin.add(doc)
+        doc.user_data = user_data
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    doc_bin.to_disk(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _load(nlp, path: str) -> List:
+    return list(DocBin().from_disk(path).get_docs(nlp.vocab))
+
+
+def _save_target_rules(nlp, docs: List):
+    # rules are identified by their position in the target matcher, which the checkpoint fingerprint covers
+    index = {id(rule): i for i, rule in enumerate(nlp.get_pipe(TARGET_MATCHER).rules)}
+    for doc in docs:
+        doc.user_data[TARGET_RULES_KEY] = [index[id(ent._.target_rule)] for ent in doc.ents]
+
+
+def _set_target_rules(nlp, docs: List):
+    rules = nlp.get_pipe(TARGET_MATCHER).rules
+    for doc in docs:
+        for ent, rule_idx in zip(doc.ents, doc.user_data.pop(TARGET_RULES_KEY, [])):
+            ent._.target_rule = rules[rule_idx]
+
+
+def process_shard(
+    nlp, notes: List[Tuple[str, Dict[str, Any]]], shard_idx: int, job_dir: str, fingerprints: Dict[str, str],
+    use_rules: bool = True, batch_size: int = 64,
+) -> Tuple[str, Optional[str]]:
+    """
+    writes the records of a shard to its part, starting from the latest valid checkpoint.
+    returns the part path and the checkpoint used, if any.
+    """
+    from .batch import doc_to_record
+
+    stages = stage_pipes(nlp)
+    texts_key = hashlib.sha256("\x00".join(text for text, _ in notes).encode("utf-8")).hexdigest()[:16]
+    paths = {
+        stage: os.path.join(_checkpoint_dir(job_dir, stage, fingerprints[stage]), f"shard-{shard_idx:05d}-{texts_key}.spacy")
+        for stage in CHECKPOINTS if stage in stages
+    }
+
+    if "targets" in paths and os.path.isfile(paths["targets"]):
+        docs = _load(nlp, paths["targets"])
+        _set_target_rules(nlp, docs)
+        reused = "targets"
+    else:
+        if os.path.isfile(paths["tokens"]):
+            docs = _load(nlp, paths["tokens"])
+            reused = "tokens"
+        else:
+            docs = []
+            for text, context in notes:
+                doc = nlp.make_doc(text)
+                doc._.csn = context.get("csn")
+                doc._.date = context.get("date")
+                docs.append(doc)
+            docs = list(_run_pipes(nlp, docs, stages["tokens"], batch_size))
+            _save(docs, paths["tokens"])
+            reused = None
+        if "targets" in stages:
+            docs = list(_run_pipes(nlp, docs, stages["targets"], batch_size))
+            _save_target_rules(nlp, docs)
+            _save(docs, paths["targets"])
+            for doc in docs:
+                doc.user_data.pop(TARGET_RULES_KEY)
+
+    part_path = _part_path(job_dir, shard_idx)
+    tmp_path = part_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for doc in _run_pipes(nlp, docs, stages["rest"], batch_size):
+            f.write(json.dumps(doc_to_record(doc, use_rules=use_rules)) + "\n")
+    os.replace(tmp_path, part_path)
+    return part_path, reused
+
+
+def _process_shard_worker(args) -> Tuple[str, Optional[str]]:
+    from . import batch
+
+    return process_shard(batch._nlp, *args)
+
+
+def run_incremental(
+    csv_path: str,
+    job_dir: str,
+    shard_size: int = 10000,
+    n_process: int = 1,
+    batch_size: int = 64,
+    text_col: str = "ED Provider Notes",
+    artifact_dir: Optional[str] = None,
+    **load_kwargs,
+) -> List[str]:
+    """
+    extracts entities for every note in `csv_path`, writing one JSONL part per shard of `shard_size` notes into
+    `job_dir` along with the checkpoints. parts written with the current rules and config are kept, as in
+    `ed_nlp.cache.run_checkpointed`. shards are processed in parallel with `n_process`. returns the part paths, in order.
+    """
+    from .batch import iter_notes, _chunked, _init_worker, _load
+
+    _prepare_job_dir(job_dir, pipeline_fingerprint(load_kwargs), shard_size)
+    fingerprints = {stage: checkpoint_fingerprint(stage, load_kwargs) for stage in CHECKPOINTS}
+    _remove_stale_checkpoints(job_dir, fingerprints)
+
+    parts = []
+
+    def tasks():
+        for shard_idx, shard in enumerate(_chunked(iter_notes(csv_path, text_col=text_col), shard_size)):
+            part_path = _part_path(job_dir, shard_idx)
+            parts.append(part_path)
+            if not os.path.isfile(part_path):
+                yield shard, shard_idx, job_dir, fingerprints, load_kwargs.get("use_rules", True), batch_size
+
+    def report(results):
+        for part_path, reused in results:
+            print(f"{os.path.basename(part_path)}: " + (f"from the {reused} checkpoint" if reused else "from scratch"))
+
+    if n_process > 1:
+        if artifact_dir is not None:
+            _load(load_kwargs, artifact_dir)
+        with Pool(n_process, initializer=_init_worker, initargs=(load_kwargs, artifact_dir)) as pool:
+            report(pool.imap(_process_shard_worker, tasks()))
+    else:
+        nlp = None
+        for task in tasks():
+            # the pipeline is only loaded if there is something left to process
+            nlp = nlp or _load(load_kwargs, artifact_dir)
+            report([process_shard(nlp, *task)])
+    return parts
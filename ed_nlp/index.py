@@ -0,0 +1,229 @@
+"""
+Inverted index over `get_entities` output, for interactive entity search.
+
+Entities are numbered in the order they are indexed. Normalized entity texts (lowercased, whitespace collapsed) are
+mapped to postings of entity ids, character unigrams, bigrams and trigrams of those texts are mapped to postings of
+texts, and target rule literals are mapped to entity ids. Negation, uncertainty, section and year are kept as per-entity arrays so filters
+are a vectorized lookup. Everything is stored as flat numpy arrays, so a saved index can be memory-mapped.
+
+    index = EntityIndex.from_records(records)  # records from the JSONL written by ed_nlp.batch
+    index.save('processed/entity-index')
+    index = EntityIndex.load('processed/entity-index')
+    ids = index.search('vomit', negated=False, year=2019)
+"""
+import json
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+MISSING = -1
+# lengths of the character n-grams with postings; a query up to 3 characters long is looked up directly, a longer one
+# is the intersection of its trigram postings, checked against the texts
+GRAM_SIZES = [1, 2, 3]
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return _WHITESPACE.sub(" ", str(text)).strip().lower()
+
+
+def _grams(text: str, n: int = 3) -> set:
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _csr(keys: np.ndarray, n_keys: int, values: np.ndarray):
+    """
+    groups `values` by `keys` into (offsets, values) so the postings of key k are values[offsets[k]:offsets[k + 1]]
+    """
+    order = np.argsort(keys, kind="stable")
+    offsets = np.zeros(n_keys + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n_keys), out=offsets[1:])
+    return offsets, values[order]
+
+
+def _flag(value) -> int:
+    return MISSING if value is None else int(bool(value))
+
+
+def _year(entity: Dict[str, Any]) -> int:
+    year = entity.get("year")
+    if year is None and entity.get("date"):
+        match = re.match(r"\d{4}", str(entity["date"]))
+        year = match.group() if match else None
+    return MISSING if year is None else int(year)
+
+
+class EntityIndex:
+
+    ARRAYS = [
+        "entity_term", "negated", "uncertain", "section", "year",
+        "term_offsets", "term_entities", "gram_offsets", "gram_terms", "literal_offsets", "literal_entities",
+    ]
+
+    def __init__(self, terms: List[str], grams: List[str], literals: List[str], sections: List[str], arrays: Dict[str, np.ndarray],
+                 gram_sizes: List[int] = GRAM_SIZES):
+        self.terms = terms
+        self.grams = {gram: i for i, gram in enumerate(grams)}
+        self.literals = {literal: i for i, literal in enumerate(literals)}
+        self.sections = {section: i for i, section in enumerate(sections)}
+        self.gram_sizes = gram_sizes
+        self._term_array = np.array(terms, dtype=str)
+        self._vocab = {"terms": terms, "grams": grams, "literals": literals, "sections": sections, "gram_sizes": gram_sizes}
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.entity_term)
+
+    @classmethod
+    def from_entities(cls, entities: Iterable[Dict[str, Any]]) -> "EntityIndex":
+        """
+        builds an index from entity dicts as yielded by `get_entities`. the year is read from 'year', or from 'date' if present.
+        """
+        term_ids, literal_ids, section_ids = {}, {}, {}
+        columns = {name: [] for name in ["entity_term", "literal", "negated", "uncertain", "section", "year"]}
+
+        for entity in entities:
+            columns["entity_term"].append(term_ids.setdefault(normalize(entity["entity_text"]), len(term_ids)))
+            literal = entity.get("entity_literal")
+            columns["literal"].append(MISSING if literal is None else literal_ids.setdefault(literal, len(literal_ids)))
+            section = entity.get("section_category")
+            columns["section"].append(MISSING if section is None else section_ids.setdefault(section, len(section_ids)))
+            columns["negated"].append(_flag(entity.get("is_negated")))
+            columns["uncertain"].append(_flag(entity.get("is_uncertain")))
+            columns["year"].append(_year(entity))
+
+        terms = list(term_ids)
+        entity_term = np.array(columns["entity_term"], dtype=np.int32)
+        entity_ids = np.arange(len(entity_term), dtype=np.int32)
+        term_offsets, term_entities = _csr(entity_term, len(terms), entity_ids)
+
+        gram_ids, gram_keys, gram_values = {}, [], []
+        for term_id, term in enumerate(terms):
+            for n in GRAM_SIZES:
+                for gram in _grams(term, n):
+                    gram_keys.append(gram_ids.setdefault(gram, len(gram_ids)))
+                    gram_values.append(term_id)
+        gram_offsets, gram_terms = _csr(np.array(gram_keys, dtype=np.int64), len(gram_ids), np.array(gram_values, dtype=np.int32))
+
+        literal = np.array(columns["literal"], dtype=np.int32)
+        has_literal = literal != MISSING
+        literal_offsets, literal_entities = _csr(literal[has_literal], len(literal_ids), entity_ids[has_literal])
+
+        arrays = {
+            "entity_term": entity_term,
+            "negated": np.array(columns["negated"], dtype=np.int8),
+            "uncertain": np.array(columns["uncertain"], dtype=np.int8),
+            "section": np.array(columns["section"], dtype=np.int16),
+            "year": np.array(columns["year"], dtype=np.int16),
+            "term_offsets": term_offsets,
+            "term_entities": term_entities,
+            "gram_offsets": gram_offsets,
+            "gram_terms": gram_terms,
+            "literal_offsets": literal_offsets,
+            "literal_entities": literal_entities,
+        }
+        return cls(terms, list(gram_ids), list(literal_ids), list(section_ids), arrays)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]]) -> "EntityIndex":
+        """
+        builds an index from per-note records ({'csn', 'date', 'entities': [...]}), entities are numbered in order across notes
+        """
+        return cls.from_entities(
+            {**entity, "date": record.get("date")} for record in records for entity in record["entities"]
+        )
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(self._vocab, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "EntityIndex":
+        """
+        loads a saved index, by default memory-mapping the arrays so only the postings touched by a query are read from disk
+        """
+        with open(os.path.join(path, "vocab.json"), encoding="utf-8") as f:
+            vocab = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None) for name in cls.ARRAYS}
+        # indexes saved before unigrams and bigrams were added only have trigram postings
+        return cls(vocab["terms"], vocab["grams"], vocab["literals"], vocab["sections"], arrays, vocab.get("gram_sizes", [3]))
+
+    def _matching_terms(self, query: str) -> np.ndarray:
+        """
+        sorted ids of the normalized entity texts containing `query`. a query up to 3 characters long is one n-gram
+        posting, a longer one the intersection of its trigram postings (shortest first) checked with a vectorized find
+        """
+        if not query:
+            return np.arange(len(self.terms), dtype=np.int32)
+        n = min(len(query), 3)
+        if n not in self.gram_sizes:
+            return np.flatnonzero(np.char.find(self._term_array, query) >= 0).astype(np.int32)
+
+        postings = []
+        for gram in _grams(query, n):
+            gram_id = self.grams.get(gram)
+            if gram_id is None:
+                return np.array([], dtype=np.int32)
+            postings.append(self.gram_terms[self.gram_offsets[gram_id]:self.gram_offsets[gram_id + 1]])
+        postings.sort(key=len)
+        candidates = np.asarray(postings[0])
+        for other in postings[1:]:
+            if not len(candidates):
+                break
+            candidates = np.intersect1d(candidates, other, assume_unique=True)
+        # a text can have all the trigrams of a longer query without containing it
+        if len(query) > 3 and len(candidates):
+            candidates = candidates[np.char.find(self._term_array[candidates], query) >= 0]
+        return candidates.astype(np.int32)
+
+    def search(
+        self,
+        query: Optional[str] = None,
+        literal: Optional[str] = None,
+        negated: Optional[bool] = None,
+        uncertain: Optional[bool] = None,
+        section_category: Optional[str] = None,
+        year: Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        sorted ids of entities whose normalized text contains `query` (all entities if None) and that match the given filters
+        """
+        if query is not None:
+            terms = self._matching_terms(normalize(query))
+            # the postings of all the matching terms gathered at once: positions start..end of each term, end to end
+            starts, ends = self.term_offsets[terms], self.term_offsets[terms + 1]
+            lengths = ends - starts
+            positions = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            ids = np.asarray(self.term_entities[positions], dtype=np.int32)
+        else:
+            ids = np.arange(len(self), dtype=np.int32)
+
+        if literal is not None:
+            literal_id = self.literals.get(literal)
+            if literal_id is None:
+                return np.array([], dtype=np.int32)
+            postings = self.literal_entities[self.literal_offsets[literal_id]:self.literal_offsets[literal_id + 1]]
+            ids = np.intersect1d(ids, postings)
+
+        mask = np.ones(len(ids), dtype=bool)
+        if negated is not None:
+            mask &= self.negated[ids] == int(negated)
+        if uncertain is not None:
+            mask &= self.uncertain[ids] == int(uncertain)
+        if section_category is not None:
+            mask &= self.section[ids] == self.sections.get(section_category, -2)
+        if year is not None:
+            mask &= self.year[ids] == year
+        return np.sort(ids[mask])
+
+    def query_results(self, query: str, entity_results: List[Dict[str, Any]], **filters) -> List[Dict[str, Any]]:
+        """
+        indexed equivalent of `ed_nlp.utils.query_results`, for an index built from `entity_results` (matching is on normalized text).
+        """
+        return [entity_results[i] for i in self.search(query, **filters)]
@@ -0,0 +1,307 @@
+"""
+Target matching that scales to large symptom lexicons.
+
+medspacy's target matcher runs every `{"TEXT": {"REGEX": ...}}` token pattern as its own regex search on every token,
+so matching cost grows with the number of rules. `LexiconMatcher` compiles single-token rules whose regex is only a
+literal or an alternation of literals (eg. "vomit", "headache|migraine", "^nause") into a table of stems: a token's text
+matches if one of its substrings (or, for "^" rules, its prefix) is a stem, found with one set lookup per substring
+length rather than one regex per rule. The result is cached per distinct token text, so a word is only looked up the
+first time it is seen (the cache is cleared once it holds `STEM_CACHE_SIZE` texts). Phrase rules (no pattern) go to
+spaCy's PhraseMatcher, a hash lookup whatever the number of phrases, and only the remaining rules fall back to spaCy's
+Matcher (token patterns) or a regex over the text (string patterns).
+
+Matches are pruned and added to `doc.ents` as in medspacy's `TargetMatcher`: the longest of overlapping matches is
+kept, existing entities take precedence, and each entity's `target_rule` is set.
+
+A lexicon is a CSV with `literal` and `category` columns and optionally `match` and `pattern`:
+- phrase (default): the literal as a phrase, case-insensitive
+- prefix: tokens starting with the literal, case-insensitive, eg. 'nause' for nausea/nauseous/nauseated
+- substring: tokens containing the literal, case-insensitive
+- regex: tokens whose lowercased text matches `pattern` (re.search), compiled to stems when it's a literal alternation
+
+    nlp = load(lexicon='lexicons/symptoms.csv')
+"""
+import csv
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+try:
+    # sre_parse and sre_constants are deprecated aliases since python 3.11
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+import numpy as np
+from medspacy.ner import TargetRule
+from spacy.attrs import LOWER, ORTH
+from spacy.language import Language
+from spacy.matcher import Matcher, PhraseMatcher
+from spacy.tokens import Doc, Span
+
+MATCH_TYPES = ["phrase", "prefix", "substring", "regex"]
+# token attributes a stem rule can match on, and the attribute whose text is looked up (and cached)
+_STEM_ATTRS = {"TEXT": ORTH, "ORTH": ORTH, "LOWER": LOWER}
+# distinct token texts whose stem lookup is kept, per attribute; typos, numbers and ids make the vocabulary of a
+# corpus unbounded, so the cache is cleared when full rather than growing with every new text
+STEM_CACHE_SIZE = 100000
+
+
+def read_lexicon(path: str) -> List[TargetRule]:
+    """
+    reads a lexicon CSV (see the module docstring) into target rules, in file order
+    """
+    rules = []
+    with open(path, newline="", encoding="utf-8") as f:
+        for line, row in enumerate(csv.DictReader(f), start=2):
+            literal, category = (row.get("literal") or "").strip(), (row.get("category") or "").strip()
+            match = (row.get("match") or "phrase").strip().lower()
+            if not literal or not category:
+                raise ValueError(f"{path}:{line}: literal and category are required")
+            if match not in MATCH_TYPES:
+                raise ValueError(f"{path}:{line}: match must be one of {MATCH_TYPES}, got {match!r}")
+
+            if match == "phrase":
+                rules.append(TargetRule(literal=literal, category=category))
+                continue
+            if match == "regex":
+                pattern = (row.get("pattern") or "").strip()
+                if not pattern:
+                    raise ValueError(f"{path}:{line}: regex rules need a pattern")
+            else:
+                pattern = ("^" if match == "prefix" else "") + re.escape(literal.lower())
+            rules.append(TargetRule(literal=literal, category=category, pattern=[{"LOWER": {"REGEX": pattern}}]))
+    return rules
+
+
+def _literals(parsed) -> Optional[List[str]]:
+    """
+    the alternatives of a parsed pattern made only of literals, eg. ['headache', 'migraine'] for 'headache|migraine'
+    """
+    if len(parsed) == 1 and parsed[0][0] is sre_constants.SUBPATTERN:
+        _, add_flags, del_flags, parsed = parsed[0][1]
+        if add_flags or del_flags:
+            return None
+    if len(parsed) == 1 and parsed[0][0] is sre_constants.BRANCH:
+        alternatives = [_literals(branch) for branch in parsed[0][1][1]]
+        return None if any(alt is None or len(alt) != 1 for alt in alternatives) else [alt[0] for alt in alternatives]
+    if len(parsed) == 1 and parsed[0][0] is sre_constants.IN:
+        # single character alternatives, eg. 'a|b', are parsed as a character set
+        chars = parsed[0][1]
+        return [chr(av) for op, av in chars] if all(op is sre_constants.LITERAL for op, _ in chars) else None
+    if len(parsed) and all(op is sre_constants.LITERAL for op, _ in parsed):
+        return ["".join(chr(av) for _, av in parsed)]
+    return None
+
+
+def compile_stem(rule: TargetRule) -> Optional[Tuple[str, bool, List[str]]]:
+    """
+    (attribute, prefix only, stems) for a rule that can be matched as stems, None for the rules that need a regex
+    """
+    pattern = rule.pattern
+    if not isinstance(pattern, list) or len(pattern) != 1 or len(pattern[0]) != 1 or rule.on_match is not None:
+        return None
+    attr, value = next(iter(pattern[0].items()))
+    if attr not in _STEM_ATTRS or not isinstance(value, dict) or list(value) != ["REGEX"] or not isinstance(value["REGEX"], str):
+        return None
+    try:
+        parsed = sre_parse.parse(value["REGEX"])
+    except re.error:
+        return None
+    # inline flags, eg. (?i), change what the literals match
+    if parsed.state.flags & ~(re.UNICODE | re.VERBOSE):
+        return None
+    parsed = list(parsed)
+    prefix = bool(parsed) and parsed[0] == (sre_constants.AT, sre_constants.AT_BEGINNING)
+    stems = _literals(parsed[1:] if prefix else parsed)
+    if not stems or not all(stems):
+        return None
+    return attr, prefix, stems
+
+
+class _StemTable:
+    """
+    stems of one token attribute, mapped to the rules they belong to
+    """
+
+    def __init__(self, cache_size: int = STEM_CACHE_SIZE):
+        self.substrings: Dict[str, List[int]] = {}
+        self.prefixes: Dict[str, List[int]] = {}
+        self._lengths: Dict[bool, List[int]] = {True: [], False: []}
+        self.cache: Dict[int, Tuple[int, ...]] = {}
+        self.cache_size = cache_size
+
+    def add(self, rule_idx: int, prefix: bool, stems: List[str]):
+        table = self.prefixes if prefix else self.substrings
+        for stem in stems:
+            table.setdefault(stem, []).append(rule_idx)
+        self._lengths = {is_prefix: sorted({len(stem) for stem in (self.prefixes if is_prefix else self.substrings)})
+                         for is_prefix in (True, False)}
+        self.cache.clear()
+
+    def lookup(self, text: str) -> Tuple[int, ...]:
+        """
+        indices of the rules matching a token's text, in rule order
+        """
+        found: Set[int] = set()
+        for length in self._lengths[True]:
+            found.update(self.prefixes.get(text[:length], ()))
+        for length in self._lengths[False]:
+            for start in range(len(text) - length + 1):
+                found.update(self.substrings.get(text[start:start + length], ()))
+        return tuple(sorted(found))
+
+    def cached_lookup(self, key: int, strings) -> Tuple[int, ...]:
+        """
+        `lookup` of the text with hash `key` in the string store `strings`, cached on the hash
+        """
+        rule_ids = self.cache.get(key)
+        if rule_ids is None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            rule_ids = self.cache[key] = self.lookup(strings[key])
+        return rule_ids
+
+
+def prune_overlapping_matches(matches: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    """
+    keeps the longest of overlapping matches, the first one on ties, as medspacy's matcher does
+    """
+    while True:
+        remaining = sorted(matches, key=lambda match: (match[1], match[2]))
+        pruned = []
+        while remaining:
+            current = remaining.pop(0)
+            if remaining and current[1] < remaining[0][2] and remaining[0][1] < current[2]:
+                following = remaining.pop(0)
+                current = max(current, following, key=lambda match: match[2] - match[1])
+            pruned.append(current)
+        if len(pruned) == len(matches):
+            return pruned
+        matches = pruned
+
+
+@Language.factory("ed_nlp_target_matcher")
+class LexiconMatcher:
+    """
+    Same interface as medspacy's `TargetMatcher`: `TargetRule`s are added with `add` and kept, in order, in `rules`.
+    Rules that can't be compiled to stems go to spaCy's Matcher (token patterns), PhraseMatcher (no pattern) or, for
+    string patterns, a regex over the doc text expanded to token boundaries. the rules themselves aren't modified.
+    """
+
+    def __init__(self, nlp: Language, name: str = "ed_nlp_target_matcher", phrase_matcher_attr: str = "LOWER"):
+        self.nlp = nlp
+        self.name = name
+        self._rules: List[TargetRule] = []
+        self._matcher = Matcher(nlp.vocab)
+        self._phrase_matcher = PhraseMatcher(nlp.vocab, attr=phrase_matcher_attr)
+        self._regexes: List[Tuple[int, "re.Pattern"]] = []
+        self._stems: Dict[int, _StemTable] = {}
+        # match id of each stem rule
+        self._stem_match_ids: List[int] = []
+        # rule index of each match id, and the order of its matches: medspacy's matcher lists token pattern matches
+        # (stem rules included) before phrase and then regex matches, each in rule order, and the first of matches
+        # over the same tokens is kept. matches are sorted the same way.
+        self._match_rules: Dict[int, int] = {}
+        self._match_order: Dict[int, Tuple[int, int]] = {}
+
+    @property
+    def rules(self) -> List[TargetRule]:
+        return self._rules
+
+    @property
+    def labels(self) -> Set[str]:
+        return {rule.category for rule in self._rules}
+
+    def add(self, rules: List[TargetRule]):
+        if not isinstance(rules, list):
+            rules = [rules]
+        for rule in rules:
+            if not isinstance(rule, TargetRule):
+                raise ValueError("Rules must be TargetRule, not", type(rule))
+            i = len(self._rules)
+            self._rules.append(rule)
+            # match ids are kept apart from the ids medspacy's matchers give the same rules
+            key = f"ed_nlp_target_rule_{i}"
+            match_id = self.nlp.vocab.strings.add(key)
+            self._match_rules[match_id] = i
+            compiled = compile_stem(rule)
+            if compiled is not None:
+                attr, prefix, stems = compiled
+                self._stems.setdefault(_STEM_ATTRS[attr], _StemTable()).add(len(self._stem_match_ids), prefix, stems)
+                self._stem_match_ids.append(match_id)
+                self._match_order[match_id] = (0, i)
+            elif isinstance(rule.pattern, list):
+                self._matcher.add(key, [rule.pattern], on_match=rule.on_match)
+                self._match_order[match_id] = (0, i)
+            elif rule.pattern is None:
+                self._phrase_matcher.add(key, [self.nlp.make_doc(rule.literal.lower())], on_match=rule.on_match)
+                self._match_order[match_id] = (1, i)
+            elif isinstance(rule.pattern, str):
+                self._regexes.append((match_id, re.compile(rule.pattern, flags=re.IGNORECASE)))
+                self._match_order[match_id] = (2, i)
+            else:
+                raise ValueError(f"The pattern argument must be either a string or a list, not {type(rule.pattern)}")
+
+    def _stem_matches(self, doc: Doc) -> List[Tuple[int, int, int]]:
+        if not self._stems or not len(doc):
+            return []
+        attrs = list(self._stems)
+        keys = doc.to_array(attrs).reshape(len(doc), len(attrs))
+        strings = self.nlp.vocab.strings
+        matches = []
+        for j, attr in enumerate(attrs):
+            table = self._stems[attr]
+            hits = {}
+            for key in np.unique(keys[:, j]).tolist():
+                rule_ids = table.cached_lookup(key, strings)
+                if rule_ids:
+                    hits[key] = rule_ids
+            if not hits:
+                continue
+            for i, key in enumerate(keys[:, j].tolist()):
+                for rule_idx in hits.get(key, ()):
+                    matches.append((self._stem_match_ids[rule_idx], i, i + 1))
+        return matches
+
+    def _regex_matches(self, doc: Doc) -> List[Tuple[int, int, int]]:
+        matches = []
+        for match_id, regex in self._regexes:
+            # as with medspacy's RegexMatcher, a match that doesn't line up with tokens takes in the tokens it cuts
+            for found in regex.finditer(doc.text_with_ws):
+                span = doc.char_span(found.start(), found.end(), alignment_mode="expand")
+                if span is not None and len(span):
+                    matches.append((match_id, span.start, span.end))
+        return matches
+
+    def _fallback_matches(self, doc: Doc) -> List[Tuple[int, int, int]]:
+        # only the matchers with rules are run, spaCy warns about empty ones
+        matches = list(self._matcher(doc)) if len(self._matcher) else []
+        if len(self._phrase_matcher):
+            matches.extend(self._phrase_matcher(doc))
+        return matches + self._regex_matches(doc)
+
+    def __call__(self, doc: Doc) -> Doc:
+        matches = self._fallback_matches(doc) + self._stem_matches(doc)
+        if not matches:
+            return doc
+        matches.sort(key=lambda match: self._match_order[match[0]])
+
+        taken = np.zeros(len(doc), dtype=bool)
+        ents = list(doc.ents)
+        for ent in ents:
+            taken[ent.start:ent.end] = True
+        for match_id, start, end in prune_overlapping_matches(matches):
+            rule = self._rules[self._match_rules[match_id]]
+            # as with medspacy, entities already in the doc take precedence
+            if taken[start:end].any():
+                continue
+            span = Span(doc, start=start, end=end, label=rule.category)
+            span._.target_rule = rule
+            if rule.attributes is not None:
+                for attribute, value in rule.attributes.items():
+                    setattr(span._, attribute, value)
+            taken[start:end] = True
+            ents.append(span)
+        doc.ents = sorted(ents, key=lambda ent: ent.start)
+        return doc
@@ -0,0 +1,202 @@
+"""
+Vectorized drop-in for medspacy's `Postprocessor`, evaluating each rule over all the entities of a doc at once.
+
+medspacy's postprocessor calls every rule's lambdas entity by entity, `ent._.window(1)._.contains("?")` building a new
+span (and its lowercased text) per entity, and removes entities one at a time by rebuilding `doc.ents`. Here the
+entities of a doc are read into arrays (token and character offsets, label hashes) with a single `doc.to_array`, each
+rule's condition is a boolean mask over them, and removals are applied with one assignment to `doc.ents`.
+
+Rules are `ArrayRule`s: a condition built from `label_not_in`, `text_in` or `window_contains`, and an action, either
+"remove" or the name of an attribute to set (eg. "is_uncertain"). As in medspacy, rules are applied in order and an
+entity removed by a rule isn't seen by the rules after it; conditions only look at the entity itself, so evaluating
+rule by rule over all entities gives the same result as medspacy's entity by entity loop. See compare_postprocessors.py.
+
+    postprocessor = nlp.add_pipe("ed_nlp_postprocessor")
+    postprocessor.add(array_postprocess_rules)
+"""
+import re
+from typing import Callable, Iterable, List, Optional
+
+import numpy as np
+from spacy.attrs import ENT_IOB, ENT_KB_ID, ENT_TYPE, IDX, LENGTH
+from spacy.language import Language
+from spacy.tokens import Doc, Span
+
+# ENT_IOB values
+_IOB_IN, _IOB_BEGIN = 1, 3
+
+
+class EntityArrays:
+    """
+    the entities of a doc as arrays: token offsets (start, end), character offsets (start_char, end_char) and label
+    hashes, in the order of `doc.ents`. spans are only built for the entities an action is taken on, as `doc.ents` (and
+    `doc.text`) walk every token of the doc each time they are read.
+    """
+
+    def __init__(self, doc: Doc):
+        self.doc = doc
+        self._text = None
+        attrs = doc.to_array([ENT_IOB, ENT_TYPE, ENT_KB_ID, IDX, LENGTH]).reshape(-1, 5)
+        iob = attrs[:, 0].astype(np.int64)
+        self.token_idx, self.token_len = attrs[:, 3].astype(np.int64), attrs[:, 4].astype(np.int64)
+        self.start = np.flatnonzero(iob == _IOB_BEGIN)
+        # an entity runs until the first token after its start that isn't inside an entity
+        not_inside = np.append(np.flatnonzero(iob != _IOB_IN), len(doc))
+        self.end = not_inside[np.searchsorted(not_inside, self.start, side="right")]
+        self.label = attrs[self.start, 1]
+        self.kb_id = attrs[self.start, 2]
+        self.start_char = self.token_idx[self.start]
+        self.end_char = self.token_idx[self.end - 1] + self.token_len[self.end - 1]
+        self._lower = None
+        self._matches = {}
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.doc.text
+        return self._text
+
+    def span(self, i: int) -> Span:
+        """
+        the entity `i`, equal to `doc.ents[i]`
+        """
+        return Span(self.doc, int(self.start[i]), int(self.end[i]), label=int(self.label[i]), kb_id=int(self.kb_id[i]))
+
+    def char_window(self, n: int = 1, left: bool = True, right: bool = True):
+        """
+        character offsets of `ent._.window(n, left, right)` for every entity
+        """
+        start = np.maximum(self.start - n, 0) if left else self.start
+        end = np.minimum(self.end + n, len(self.doc)) if right else self.end
+        return self.token_idx[start], self.token_idx[end - 1] + self.token_len[end - 1]
+
+    def matches(self, target: str) -> np.ndarray:
+        """
+        sorted start offsets of every (possibly overlapping) case-insensitive occurrence of `target` in the doc text
+        """
+        if target not in self._matches:
+            if self._lower is None:
+                self._lower = self.text.lower()
+            positions = []
+            if len(self._lower) == len(self.text):
+                target_lower = target.lower()
+                position = self._lower.find(target_lower)
+                while position >= 0:
+                    positions.append(position)
+                    position = self._lower.find(target_lower, position + 1)
+            else:
+                # lowercasing changed the length of the text (some non-ascii characters), so offsets wouldn't line up
+                pattern = re.compile(f"(?={re.escape(target)})", flags=re.IGNORECASE)
+                positions = [match.start() for match in pattern.finditer(self.text)]
+            self._matches[target] = np.array(positions, dtype=np.int64)
+        return self._matches[target]
+
+
+def label_not_in(labels: Iterable[str]) -> Callable[[EntityArrays], np.ndarray]:
+    """
+    as `lambda ent: ent.label_ not in labels`
+    """
+    labels = list(labels)
+
+    def condition(arrays: EntityArrays) -> np.ndarray:
+        strings = arrays.doc.vocab.strings
+        return ~np.isin(arrays.label, np.array([strings[label] for label in labels], dtype=arrays.label.dtype))
+
+    return condition
+
+
+def text_in(texts: Iterable[str]) -> Callable[[EntityArrays], np.ndarray]:
+    """
+    as `lambda ent: ent.text in texts`. only entities of the right length are compared.
+    """
+    texts = set(texts)
+    lengths = np.array(sorted({len(text) for text in texts}), dtype=np.int64)
+
+    def condition(arrays: EntityArrays) -> np.ndarray:
+        mask = np.zeros(len(arrays), dtype=bool)
+        for i in np.flatnonzero(np.isin(arrays.end_char - arrays.start_char, lengths)):
+            mask[i] = arrays.text[arrays.start_char[i]:arrays.end_char[i]] in texts
+        return mask
+
+    return condition
+
+
+def window_contains(target: str, n: int = 1, left: bool = True, right: bool = True) -> Callable[[EntityArrays], np.ndarray]:
+    """
+    as `lambda ent: ent._.window(n, left, right)._.contains(target, regex=False)`, which is case-insensitive. a window
+    contains `target` if an occurrence starts in it and ends before the end of the window.
+    """
+
+    def condition(arrays: EntityArrays) -> np.ndarray:
+        window_start, window_end = arrays.char_window(n, left=left, right=right)
+        positions = arrays.matches(target)
+        first = np.searchsorted(positions, window_start, side="left")
+        last = np.searchsorted(positions, window_end - len(target), side="right")
+        return last > first
+
+    return condition
+
+
+class ArrayRule:
+    """
+    `condition` maps an `EntityArrays` to a boolean mask of the entities the rule applies to. `action` is "remove",
+    or the name of an entity attribute (eg. "is_uncertain") which is set to `value`.
+    """
+
+    def __init__(self, condition: Callable[[EntityArrays], np.ndarray], action: str = "remove", value=True,
+                 description: Optional[str] = None):
+        self.condition = condition
+        self.action = action
+        self.value = value
+        self.description = description
+
+    def __call__(self, arrays: EntityArrays, active: np.ndarray) -> np.ndarray:
+        """
+        mask of the `active` entities the rule applies to
+        """
+        return self.condition(arrays) & active
+
+    def __repr__(self):
+        return f"ArrayRule: {self.action} - {self.description}"
+
+
+@Language.factory("ed_nlp_postprocessor")
+class ArrayPostprocessor:
+    """
+    Same interface as `medspacy.postprocess.Postprocessor`: rules are added with `add` and kept, in order, in `rules`.
+    """
+
+    def __init__(self, nlp: Language, name: str = "ed_nlp_postprocessor"):
+        self.nlp = nlp
+        self.name = name
+        self.rules: List[ArrayRule] = []
+
+    def add(self, rules: List[ArrayRule]):
+        self.rules += rules
+
+    def __call__(self, doc: Doc) -> Doc:
+        if not self.rules:
+            return doc
+        arrays = EntityArrays(doc)
+        if not len(arrays):
+            return doc
+        active = np.ones(len(arrays), dtype=bool)
+        for rule in self.rules:
+            mask = rule(arrays, active)
+            if not mask.any():
+                continue
+            if rule.action == "remove":
+                active &= ~mask
+            else:
+                for i in np.flatnonzero(mask):
+                    setattr(arrays.span(i)._, rule.action, rule.value)
+        if not active.all():
+            doc.ents = [arrays.span(i) for i in np.flatnonzero(active)]
+        return doc
+
+    def pipe(self, docs: Iterable[Doc], batch_size: int = 128) -> Iterable[Doc]:
+        for doc in docs:
+            yield self(doc)
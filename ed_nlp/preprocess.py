@@ -0,0 +1,111 @@
+"""
+Drop-in replacement for medspacy's `Preprocessor` that avoids regex scans which can't change the note.
+
+medspacy's preprocessor runs every rule over the full note, each `re.sub` scanning (and copying) the whole string. Most
+rules here can only match if a literal substring is present - 'presented' for the patient name rule, 'hpi' for the two
+hpi rules, 'review of systems' - and checking for a substring with `in` is far cheaper than a regex scan. The literal
+is read from the parsed pattern: the longest run of literals at the top level of the pattern, which every match must
+contain. Rules without one (eg. `\\s{2,}`, case-insensitive patterns) and plain callables always run.
+
+`re.sub` also tries a `^` anchored pattern (the patient name rule) at every position of the note, so those are applied
+with a single `match` at the start instead. Rules still run one after another, in order, so the output is identical
+to medspacy's.
+
+    preprocessor = FastPreprocessor(nlp.tokenizer)
+    preprocessor.add(preprocess_rules)
+    nlp.tokenizer = preprocessor
+"""
+import re
+from functools import partial
+from typing import Callable, List, Optional, Tuple, Union
+
+try:
+    # sre_parse and sre_constants are deprecated aliases since python 3.11
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+from medspacy.preprocess import PreprocessingRule
+
+
+def required_literal(pattern: re.Pattern, min_len: int = 2) -> Optional[str]:
+    """
+    the longest literal substring every match of `pattern` contains, if one of at least `min_len` characters can be found
+    """
+    if pattern.flags & re.IGNORECASE or not isinstance(pattern.pattern, str):
+        return None
+    best, run = "", []
+    for op, av in list(sre_parse.parse(pattern.pattern, pattern.flags)) + [(None, None)]:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+        else:
+            best = max(best, "".join(run), key=len)
+            run = []
+    return best if len(best) >= min_len else None
+
+
+def _anchored_at_start(pattern: re.Pattern) -> bool:
+    parsed = sre_parse.parse(pattern.pattern, pattern.flags) if isinstance(pattern.pattern, str) else []
+    if not len(parsed) or parsed[0][0] is not sre_constants.AT:
+        return False
+    at = parsed[0][1]
+    return at is sre_constants.AT_BEGINNING_STRING or (at is sre_constants.AT_BEGINNING and not pattern.flags & re.MULTILINE)
+
+
+def _sub_at_start(pattern: re.Pattern, repl, text: str) -> str:
+    """
+    `pattern.sub(repl, text)` for a pattern that can only match at the start of the string. `sub` would still try every
+    position in the string, `match` only tries the first.
+    """
+    if pattern.match(text) is None:
+        return text
+    # the match is at the start, so a single substitution finds it straight away
+    return pattern.sub(repl, text, count=1)
+
+
+def _compile_rule(rule: Callable) -> Tuple[Optional[str], Callable]:
+    if isinstance(rule, PreprocessingRule) and rule.callback is None:
+        if _anchored_at_start(rule.pattern):
+            return required_literal(rule.pattern), partial(_sub_at_start, rule.pattern, rule.repl)
+        return required_literal(rule.pattern), rule
+    return None, rule
+
+
+class FastPreprocessor:
+    """
+    Same interface as `medspacy.preprocess.Preprocessor`: rules are added with `add` and kept, in order, in `rules`.
+    """
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.rules = []
+        self._compiled_rules = None
+        self._compiled = []
+
+    def add(self, rules: Union[Callable, List[Callable]]):
+        """
+        appends a rule, or a list of rules
+        """
+        if callable(rules):
+            rules = [rules]
+        self.rules += list(rules)
+
+    def _compile(self):
+        # recompiled whenever the rules change, including in place (eg. when they are wrapped for profiling)
+        if self._compiled_rules != self.rules:
+            self._compiled = [_compile_rule(rule) for rule in self.rules]
+            self._compiled_rules = list(self.rules)
+        return self._compiled
+
+    def preprocess(self, text: str) -> str:
+        """
+        applies the rules to `text` without tokenizing it
+        """
+        for literal, rule in self._compile():
+            if literal is None or literal in text:
+                text = rule(text)
+        return text
+
+    def __call__(self, text: str):
+        return self.tokenizer(self.preprocess(text))
@@ -0,0 +1,234 @@
+"""
+Opt-in instrumentation of the pipeline built by `load()`.
+
+`load(profile=True)` wraps the preprocessor/tokenizer and every pipe so each call is timed, and wraps the individual
+preprocessing and postprocessing rules so the rules that dominate a stage can be found. Entities are counted after
+each pipe, and target, section and ConText rule matches are counted from the docs as they come out of their pipe.
+
+    nlp = load(profile=True)
+    docs = list(nlp.pipe(texts))
+    print(nlp.profiler.report())
+    nlp.profiler.save_json('processed/profile.json')
+
+Components are called one doc at a time while profiled (rather than through their own `pipe`), so the timings are
+per-doc and the overall throughput can be slightly lower than an uninstrumented run.
+"""
+import json
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import spacy
+
+PREPROCESSOR = "preprocessor"
+
+
+def _target_matches(doc) -> Iterable[Tuple[str, str]]:
+    for ent in doc.ents:
+        rule = ent._.target_rule
+        if rule is not None:
+            yield rule.category, rule.literal
+
+
+def _section_matches(doc) -> Iterable[Tuple[str, str]]:
+    for section in doc._.sections:
+        rule = getattr(section, "rule", None)
+        if rule is not None:
+            yield rule.category, rule.literal
+        elif section.category is not None:
+            yield section.category, section.category
+
+
+def _context_matches(doc) -> Iterable[Tuple[str, str]]:
+    for modifier in doc._.context_graph.modifiers:
+        yield modifier._context_rule.category, modifier._context_rule.literal
+
+
+# pipes whose output can be attributed to individual rules
+RULE_COUNTERS = {
+    "medspacy_target_matcher": ("target", _target_matches),
+    "medspacy_sectionizer": ("section", _section_matches),
+    "medspacy_context": ("context", _context_matches),
+}
+
+
+def _rule_label(rule) -> str:
+    for attr in ["description", "desc"]:
+        label = getattr(rule, attr, None)
+        if label:
+            return str(label)
+    return getattr(rule, "__name__", repr(rule))
+
+
+class PipelineProfiler:
+    """
+    Accumulates timings and counts from the instrumented pipeline, see `instrument()`.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.order = []
+        self.components = {}
+        # (stage, category, rule) -> stats
+        self.rules = {}
+
+    def _add_component(self, name: str, elapsed: float, doc):
+        if name not in self.components:
+            self.order.append(name)
+        stats = self.components.setdefault(name, {"time": 0.0, "docs": 0, "tokens": 0, "entities": 0})
+        stats["time"] += elapsed
+        stats["docs"] += 1
+        stats["tokens"] += len(doc)
+        stats["entities"] += len(doc.ents)
+
+    def _add_rule(self, key: Tuple[str, str, str], elapsed: float = 0.0, calls: int = 0, matches: int = 0):
+        stats = self.rules.setdefault(key, {"time": 0.0, "calls": 0, "matches": 0})
+        stats["time"] += elapsed
+        stats["calls"] += calls
+        stats["matches"] += matches
+
+    def to_dict(self) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        per-component and per-rule statistics, components in the order they first ran and rules in descending order of time then matches
+        """
+        total = sum(stats["time"] for stats in self.components.values()) or 1e-12
+        components = []
+        for name in self.order:
+            stats = self.components[name]
+            elapsed = stats["time"] or 1e-12
+            components.append({
+                "component": name,
+                "time_s": stats["time"],
+                "pct_time": 100 * stats["time"] / total,
+                "docs": stats["docs"],
+                "tokens": stats["tokens"],
+                "entities": stats["entities"],
+                "docs_per_s": stats["docs"] / elapsed,
+                "tokens_per_s": stats["tokens"] / elapsed,
+            })
+
+        rules = [
+            {"stage": stage, "category": category, "rule": rule, "time_s": stats["time"], "calls": stats["calls"], "matches": stats["matches"]}
+            for (stage, category, rule), stats in self.rules.items()
+        ]
+        rules.sort(key=lambda row: (-row["time_s"], -row["matches"]))
+        return {"components": components, "rules": rules}
+
+    def summary(self) -> "pd.DataFrame":
+        import pandas as pd
+
+        return pd.DataFrame(self.to_dict()["components"]).set_index("component")
+
+    def rule_summary(self) -> "pd.DataFrame":
+        import pandas as pd
+
+        return pd.DataFrame(self.to_dict()["rules"], columns=["stage", "category", "rule", "time_s", "calls", "matches"])
+
+    def report(self) -> str:
+        return self.summary().round(3).to_string() + "\n\n" + self.rule_summary().round(4).to_string(index=False)
+
+    def save_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+class _TimedRule:
+    """
+    wraps a preprocessing or postprocessing rule. preprocessing rules count a match when they change the text and
+    postprocessing rules when they return True, ie. all their patterns passed and the action was taken, or for each
+    entity in the mask returned by a vectorized (`ed_nlp.postprocess`) rule.
+    """
+
+    def __init__(self, rule: Callable, key: Tuple[str, str, str], profiler: PipelineProfiler, count_changes: bool = False):
+        self.rule = rule
+        self.key = key
+        self.profiler = profiler
+        self.count_changes = count_changes
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = self.rule(*args, **kwargs)
+        if self.count_changes:
+            matched = int(result != args[0])
+        elif isinstance(result, bool):
+            matched = int(result)
+        else:
+            # vectorized postprocessing rules return a mask over the doc's entities
+            matched = int(result.sum())
+        self.profiler._add_rule(self.key, time.perf_counter() - start, calls=1, matches=matched)
+        return result
+
+    def __getattr__(self, name):
+        if name == "rule" or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.rule, name)
+
+
+class _TimedComponent:
+    """
+    wraps a pipe (or the tokenizer) so that every doc it produces is timed and counted
+    """
+
+    def __init__(self, name: str, component: Callable, profiler: PipelineProfiler):
+        self.name = name
+        self.component = component
+        self.profiler = profiler
+        self.stage, self.counter = RULE_COUNTERS.get(name, (None, None))
+
+    def __call__(self, doc, **kwargs):
+        start = time.perf_counter()
+        doc = self.component(doc, **kwargs)
+        self.profiler._add_component(self.name, time.perf_counter() - start, doc)
+        if self.counter is not None:
+            for category, literal in self.counter(doc):
+                self.profiler._add_rule((self.stage, category, literal), matches=1)
+        return doc
+
+    def pipe(self, docs, batch_size: Optional[int] = None, **kwargs):
+        for doc in docs:
+            yield self(doc, **kwargs)
+
+    def __getattr__(self, name):
+        # lets `nlp.get_pipe(...)` callers keep using the wrapped component, eg. `.add(rules)`
+        if name == "component" or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.component, name)
+
+
+def _wrap_rules(owner, stage: str, profiler: PipelineProfiler, count_changes: bool = False):
+    rules = getattr(owner, "rules", None)
+    if rules is None:
+        return
+    for i, rule in enumerate(rules):
+        if not isinstance(rule, _TimedRule):
+            key = (stage, getattr(rule, "category", None) or "", f"{i}: {_rule_label(rule)}")
+            rules[i] = _TimedRule(rule, key, profiler, count_changes=count_changes)
+
+
+def instrument(nlp: "spacy.Language", profiler: Optional[PipelineProfiler] = None) -> PipelineProfiler:
+    """
+    instruments `nlp` in place and returns the profiler its statistics are collected in.
+    should be called once all rules have been added, rules added afterwards are timed as part of their pipe only.
+    """
+    profiler = profiler or PipelineProfiler()
+
+    if not isinstance(nlp.tokenizer, _TimedComponent):
+        _wrap_rules(nlp.tokenizer, "preprocess", profiler, count_changes=True)
+        nlp.tokenizer = _TimedComponent(PREPROCESSOR, nlp.tokenizer, profiler)
+
+    # spaCy keeps the pipes, including disabled ones, in `_components`
+    for i, (name, component) in enumerate(nlp._components):
+        if isinstance(component, _TimedComponent):
+            continue
+        if name in ("medspacy_postprocessor", "ed_nlp_postprocessor"):
+            _wrap_rules(component, "postprocess", profiler)
+        if name in ("ed_nlp_section_ner", "ed_nlp_block_cache"):
+            # the NER pipes and ConText they run over parts of the doc, see `ed_nlp.sections` and `ed_nlp.dedup`
+            component.pipes = [(pipe_name, pipe if isinstance(pipe, _TimedComponent) else _TimedComponent(pipe_name, pipe, profiler))
+                               for pipe_name, pipe in component.pipes]
+        nlp._components[i] = (name, _TimedComponent(name, component, profiler))
+
+    return profiler
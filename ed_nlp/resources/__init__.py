@@ -3,12 +3,13 @@ from .target_rules import target_rules
 from .preprocess_rules import preprocess_rules
 from .section_rules import section_rules
 from .context_rules import context_rules
-from .postprocess_rules import postprocess_rules 
+from .postprocess_rules import postprocess_rules, array_postprocess_rules
 
 __all__ = [
     "target_rules",
     "context_rules",
     "preprocess_rules",
     "postprocess_rules",
+    "array_postprocess_rules",
     "section_rules",
 ]
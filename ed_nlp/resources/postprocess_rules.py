@@ -1,6 +1,8 @@
 from medspacy.postprocess import PostprocessingRule, PostprocessingPattern
 from medspacy.postprocess import postprocessing_functions
 
+from ..postprocess import ArrayRule, label_not_in, text_in, window_contains
+
 postprocess_rules = [
     PostprocessingRule(
         patterns=[
@@ -33,3 +35,23 @@ postprocess_rules = [
         description="If an entity has a question mark directly before or after it, set to uncertain.",
     ),
 ]
+
+# the same rules for the vectorized postprocessor, see ed_nlp.postprocess
+array_postprocess_rules = [
+    ArrayRule(
+        label_not_in(["DISEASE", "PROBLEM"]),
+        action="remove",
+        description="Remove entities that are neither a disease or problem (these are symptoms/conditions).",
+    ),
+    ArrayRule(
+        text_in(["presenting illness"]),
+        action="remove",
+        description="Remove bloat 'presenting illness' entities from NER model.",
+    ),
+    ArrayRule(
+        window_contains("?", n=1, left=True, right=True),
+        action="is_uncertain",
+        value=True,
+        description="If an entity has a question mark directly before or after it, set to uncertain.",
+    ),
+]
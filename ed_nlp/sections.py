@@ -0,0 +1,142 @@
+"""
+Section-aware extraction: entities are only looked for in some sections of a note.
+
+Most of what is labeled comes from the history of presenting illness, the review of systems and the physical exam, while
+NER and ConText would otherwise run over the whole note, medication lists included. With `load(sections=...)` the
+sectionizer runs right after the sentence splitter and the NER pipes (the target matcher, or en_ner_bc5cdr_md's ner)
+and ConText are moved into a `SectionNER` pipe, which runs them over copies of the selected sections only
+(`span.as_doc()`, one per run of consecutive selected sections, titles included). The entities found, their target
+rules and ConText modifiers and attributes are then mapped back onto the note, so offsets are in note coordinates and
+`get_entities` works as before. The postprocessor still runs over the whole note.
+
+ConText scopes can't reach past the end of a section copy, which only changes the output when a sentence spans a
+section title. Notes without any of the sections get no entities, and `doc._.context_graph` isn't set.
+
+    nlp = load(sections=NER_SECTIONS)
+"""
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from medspacy.context.context_modifier import ConTextModifier
+from spacy.language import Language
+from spacy.tokens import Doc, Span
+from spacy.util import minibatch
+
+# section categories of ed_nlp.resources.section_rules entities are extracted from
+NER_SECTIONS = ["history_of_presenting_illness", "review_of_systems", "physical_exam"]
+
+
+def section_regions(doc: Doc, categories: Iterable[str]) -> List[Tuple[int, int]]:
+    """
+    token offsets (start, end) of the runs of consecutive sections whose category is in `categories`, titles included
+    """
+    categories = set(categories)
+    regions = []
+    for section in doc._.sections:
+        if section.category not in categories or section.title_start == section.body_end:
+            continue
+        if regions and regions[-1][1] == section.title_start:
+            regions[-1] = (regions[-1][0], section.body_end)
+        else:
+            regions.append((section.title_start, section.body_end))
+    return regions
+
+
+def _map_modifier(modifier: ConTextModifier, doc: Doc, offset: int) -> ConTextModifier:
+    # the scope found in the copy (which can't reach past it) replaces the one the constructor sets from `doc`, the
+    # targets are added as the spans they modify are mapped
+    mapped = ConTextModifier(modifier.rule, modifier.start + offset, modifier.end + offset, doc)
+    scope = modifier.scope
+    mapped.update_scope(doc[scope.start + offset:scope.end + offset])
+    return mapped
+
+
+def _map_back(doc: Doc, sub_doc: Doc, start: int, sub_start: int = 0, sub_end: Optional[int] = None) -> List[Span]:
+    """
+    the entities of `sub_doc[sub_start:sub_end]`, a copy of `doc[start:...]`, as spans of `doc`. span and token
+    extension values set on that part of `sub_doc` (target rules, modifiers, ConText attributes) are copied over with
+    their offsets shifted.
+    """
+    sub_end = len(sub_doc) if sub_end is None else sub_end
+    offset, char_offset = start - sub_start, doc[start].idx - sub_doc[sub_start].idx
+    first_char, last_token = sub_doc[sub_start].idx, sub_doc[sub_end - 1]
+    end_char = last_token.idx + len(last_token.text_with_ws)
+    modifiers: Dict[int, ConTextModifier] = {}
+    for key, value in sub_doc.user_data.items():
+        # extension values are keyed by ('._.', name, start_char, end_char), doc level ones by (..., None, None)
+        if not (isinstance(key, tuple) and len(key) == 4 and key[0] == "._." and key[2] is not None):
+            continue
+        _, name, key_start, key_end = key
+        if not first_char <= key_start < end_char:
+            continue
+        key_end = key_end + char_offset if key_end is not None else None
+        if isinstance(value, tuple) and value and all(isinstance(item, ConTextModifier) for item in value):
+            value = tuple(modifiers.setdefault(id(item), _map_modifier(item, doc, offset)) for item in value)
+            if name == "modifiers":
+                target = doc.char_span(key_start + char_offset, key_end)
+                for modifier in value:
+                    modifier.modify(target)
+        doc.user_data[("._.", name, key_start + char_offset, key_end)] = value
+    return [Span(doc, ent.start + offset, ent.end + offset, label=ent.label, kb_id=ent.kb_id)
+            for ent in sub_doc.ents if sub_start <= ent.start and ent.end <= sub_end]
+
+
+@Language.factory("ed_nlp_section_ner", default_config={"sections": NER_SECTIONS})
+class SectionNER:
+    """
+    runs the pipes added with `add` over the `sections` of each doc only, see the module docstring
+    """
+
+    def __init__(self, nlp: Language, name: str = "ed_nlp_section_ner", sections: List[str] = NER_SECTIONS):
+        self.nlp = nlp
+        self.name = name
+        self.sections = list(sections)
+        self.pipes: List[Tuple[str, Callable]] = []
+
+    @property
+    def pipe_names(self) -> List[str]:
+        return [name for name, _ in self.pipes]
+
+    def add(self, name: str, component: Callable):
+        self.pipes.append((name, component))
+
+    def get_pipe(self, name: str) -> Callable:
+        for pipe_name, component in self.pipes:
+            if pipe_name == name:
+                return component
+        raise KeyError(f"No pipe named {name!r}, available: {self.pipe_names}")
+
+    def __call__(self, doc: Doc) -> Doc:
+        return self._process([doc])[0]
+
+    def pipe(self, docs: Iterable[Doc], batch_size: int = 128) -> Iterable[Doc]:
+        for batch in minibatch(docs, size=batch_size):
+            yield from self._process(batch, batch_size=batch_size)
+
+    def _process(self, docs: List[Doc], batch_size: int = 128) -> List[Doc]:
+        # one copy per region, the pipes then run over the copies of the whole batch
+        regions = {i: section_regions(doc, self.sections) for i, doc in enumerate(docs)}
+        sub_docs: List[Tuple[int, int, Doc]] = []
+        for i, doc in enumerate(docs):
+            if not regions[i]:
+                continue
+            # the doc's arrays are read once rather than once per region
+            array_head = Doc._get_array_attrs()
+            array = doc.to_array(array_head)
+            for start, end in regions[i]:
+                sub_docs.append((i, start, doc[start:end].as_doc(array_head=array_head, array=array)))
+
+        processed = [sub_doc for _, _, sub_doc in sub_docs]
+        for _, component in self.pipes:
+            if hasattr(component, "pipe"):
+                processed = list(component.pipe(processed, batch_size=batch_size))
+            else:
+                processed = [component(sub_doc) for sub_doc in processed]
+
+        ents: Dict[int, List[Span]] = {i: [] for i in {i for i, _, _ in sub_docs}}
+        for (i, start, _), sub_doc in zip(sub_docs, processed):
+            ents[i].extend(_map_back(docs[i], sub_doc, start))
+        for i, mapped in ents.items():
+            # entities already in the doc outside the sections are kept, the ones inside went through the copies
+            outside = [ent for ent in docs[i].ents if not any(ent.start < end and start < ent.end for start, end in regions[i])]
+            docs[i].ents = sorted(outside + mapped, key=lambda ent: ent.start)
+        return docs
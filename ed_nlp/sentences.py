@@ -0,0 +1,200 @@
+"""
+Rule-based sentence segmentation for ED notes, a faster alternative to `medspacy_pysbd`.
+
+The `\\s{2,}` preprocessing rule turns EPIC's flattened line breaks back into newlines, so most boundaries in a note are
+newlines: headers, list items and lines of the review of systems and exam. A new sentence starts at the first token
+after a newline, or after '.', '!' or '?' unless the period ends an abbreviation (a single letter, as in 'y.o.', or one of
+ABBREVIATIONS). Closing brackets/quotes and repeated punctuation stay with the sentence they close.
+
+Every token gets `is_sent_start` set and the first token of a doc always starts a sentence, so `doc.sents`, `ent.sent`,
+the `next_sentence`/`previous_sentence` extensions and the sectionizer's `IS_SENT_START` patterns work as with pysbd.
+
+    nlp = load(sentence_splitter="newline")
+
+`sentence_index` computes the sentence boundaries of a doc once and caches them in `doc.user_data`, so the sentence of
+an entity and its neighbours are array lookups rather than a walk over the doc's tokens each time.
+"""
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from spacy.language import Language
+from spacy.tokens import Doc, Span
+
+SENTENCE_SPLITTERS = {"pysbd": "medspacy_pysbd", "newline": "ed_nlp_sentencizer"}
+
+TERMINAL_PUNCT = {".", "!", "?"}
+CLOSING_PUNCT = {")", "]", "}", '"', "'"}
+# lowercase, as the preprocessor lowercases notes
+ABBREVIATIONS = {"dr", "mr", "mrs", "ms", "vs", "approx", "pt", "pts", "hx", "dx", "sx", "tx", "rx", "fx", "wt", "ht", "temp"}
+
+
+def _is_abbreviation(doc: Doc, i: int) -> bool:
+    if doc[i].text != "." or i == 0:
+        return False
+    prev = doc[i - 1]
+    return not prev.whitespace_ and ((len(prev.text) == 1 and prev.is_alpha) or prev.lower_ in ABBREVIATIONS)
+
+
+@Language.component("ed_nlp_sentencizer")
+def newline_sentencizer(doc: Doc) -> Doc:
+    """
+    sets sentence starts from newlines and terminal punctuation, see the module docstring
+    """
+    boundary = False
+    # a boundary is only pending once the current sentence has some text, so runs of newlines don't make empty sentences
+    has_text = False
+    for i, token in enumerate(doc):
+        if i == 0:
+            token.is_sent_start = True
+        elif boundary and not token.is_space and token.text not in CLOSING_PUNCT and token.text not in TERMINAL_PUNCT:
+            token.is_sent_start = True
+            boundary, has_text = False, False
+        else:
+            token.is_sent_start = False
+
+        if not token.is_space:
+            has_text = True
+        if has_text and ("\n" in token.text or "\n" in token.whitespace_):
+            boundary = True
+        elif token.text in TERMINAL_PUNCT and not _is_abbreviation(doc, i):
+            boundary = True
+    return doc
+
+
+SENTENCE_INDEX_KEY = "ed_nlp_sentence_index"
+
+
+def sentence_index(doc: Doc) -> Tuple[List[int], List[int], List[int]]:
+    """
+    (starts, ends, token_sents): the start and end token of every sentence, and the sentence of every token.
+    computed on first use and cached in `doc.user_data`, sentence boundaries are fixed once the pipeline's first pipe has run.
+    plain lists rather than numpy arrays, as they are indexed one element at a time.
+    """
+    cached = doc.user_data.get(SENTENCE_INDEX_KEY)
+    if cached is not None and len(cached[2]) == len(doc):
+        return cached
+    starts, ends, token_sents = [], [], []
+    for i, sent in enumerate(doc.sents):
+        starts.append(sent.start)
+        ends.append(sent.end)
+        token_sents.extend([i] * (sent.end - sent.start))
+    doc.user_data[SENTENCE_INDEX_KEY] = (starts, ends, token_sents)
+    return starts, ends, token_sents
+
+
+def _sentences(span: Span) -> Tuple[int, int]:
+    """
+    first and last sentence the span overlaps
+    """
+    token_sents = sentence_index(span.doc)[2]
+    return token_sents[span.start], token_sents[span.end - 1]
+
+
+def get_sentence(span: Span) -> Span:
+    """
+    cached equivalent of `span.sent`: from the start of the sentence of the span's first token to the end of the sentence of its last token
+    """
+    starts, ends, _ = sentence_index(span.doc)
+    first, last = _sentences(span)
+    return span.doc[starts[first]:ends[last]]
+
+
+def next_sentence(ent: Span) -> Optional[int]:
+    """
+    number of the sentence of the token after the first token following the entity's sentence, None past the end of
+    the doc. as `ent.doc[ent.sent.end + 1].sent`
+    """
+    _, ends, token_sents = sentence_index(ent.doc)
+    token = ends[_sentences(ent)[1]] + 1
+    return token_sents[token] if token < len(ent.doc) else None
+
+
+def previous_sentence(ent: Span) -> int:
+    """
+    number of the sentence of the token before the entity's sentence, as `ent.doc[ent.sent.start - 1].sent`.
+    as with indexing the doc, for an entity in the first sentence this wraps around to the last sentence.
+    """
+    starts, _, token_sents = sentence_index(ent.doc)
+    return token_sents[starts[_sentences(ent)[0]] - 1]
+
+
+def sentence_span(doc: Doc, sent: int) -> Span:
+    starts, ends, _ = sentence_index(doc)
+    return doc[starts[sent]:ends[sent]]
+
+
+def get_next_sentence(ent: Span) -> Optional[str]:
+    """
+    cached equivalent of `str(ent.doc[ent.sent.end + 1].sent)`, see `next_sentence`
+    """
+    sent = next_sentence(ent)
+    return None if sent is None else str(sentence_span(ent.doc, sent))
+
+
+def get_previous_sentence(ent: Span) -> str:
+    """
+    cached equivalent of `str(ent.doc[ent.sent.start - 1].sent)`, see `previous_sentence`
+    """
+    return str(sentence_span(ent.doc, previous_sentence(ent)))
+
+
+def get_sentence_window(ent: Span, before: int = 1, after: int = 1) -> str:
+    """
+    text of the entity's sentence with up to `before` sentences before it and `after` sentences after it
+    """
+    starts, ends, _ = sentence_index(ent.doc)
+    first, last = _sentences(ent)
+    first, last = max(first - before, 0), min(last + after, len(starts) - 1)
+    return str(ent.doc[starts[first]:ends[last]])
+
+
+def sentence_starts(doc: Doc) -> Set[int]:
+    """
+    character offsets of the first non-whitespace token of each sentence
+    """
+    starts = set()
+    for sent in doc.sents:
+        for token in sent:
+            if not token.is_space:
+                starts.add(token.idx)
+                break
+    return starts
+
+
+def gold_starts(text: str, sentences: List[str], preprocess) -> Set[int]:
+    """
+    character offsets in `text` (already preprocessed) at which each of the gold `sentences` starts.
+    each sentence is preprocessed on its own and found in order, sentences that can't be found are skipped.
+    """
+    starts, pos = set(), 0
+    for sentence in sentences:
+        sentence = preprocess(sentence).strip()
+        if not sentence:
+            continue
+        start = text.find(sentence, pos)
+        if start < 0:
+            continue
+        starts.add(start)
+        pos = start + len(sentence)
+    return starts
+
+
+def boundary_scores(predicted: Iterable[Set[int]], gold: Iterable[Set[int]]) -> Dict[str, Any]:
+    """
+    micro-averaged precision, recall and F1 of predicted sentence starts, and the proportion of docs segmented exactly
+    """
+    tp = n_pred = n_gold = n_exact = n_docs = 0
+    for pred_starts, gold_doc_starts in zip(predicted, gold):
+        tp += len(pred_starts & gold_doc_starts)
+        n_pred += len(pred_starts)
+        n_gold += len(gold_doc_starts)
+        n_exact += pred_starts == gold_doc_starts
+        n_docs += 1
+    precision = tp / n_pred if n_pred else 0.0
+    recall = tp / n_gold if n_gold else 0.0
+    return {
+        "precision": precision,
+        "recall": recall,
+        "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        "exact": n_exact / n_docs if n_docs else 0.0,
+        "n_docs": n_docs,
+    }
@@ -0,0 +1,429 @@
+"""
+Asyncio HTTP service extracting entities from single notes, for the app backend.
+
+Worker processes each hold a pipeline from `load()` (or a snapshot, see `ed_nlp.artifact`), loaded when the service
+starts. Concurrent requests are queued and micro-batched: a batch is sent to a free worker once it has `max_batch_size`
+notes or its first note has waited `max_latency_ms`, whichever comes first, and goes through `nlp.pipe` in one call.
+While every worker is busy notes keep queueing, so batches grow with the load. Requests beyond `max_queue` queued notes
+get a 503 rather than waiting indefinitely.
+
+Only the standard library is used for HTTP (HTTP/1.1, keep-alive, JSON bodies):
+- POST /entities with {"text": ..., "csn": ..., "date": ...} returns the record of `ed_nlp.batch.doc_to_record`, ie.
+  the csn, date, processed text and the `get_entities` output of the note
+- GET /metrics returns request counts, latency percentiles (overall and split into queueing and processing), batch
+  sizes and throughput
+- GET /health returns {"status": "ok"} once the pipelines are loaded, and a 503 while they are (re)loading or after
+  the service is closed
+
+If a worker process dies (eg. killed for using too much memory) the pool is broken: the notes of the batches sent to it
+fail, and a new pool is started while the following batches wait for it. Closing the service fails the notes still
+queued or being processed with a 503.
+
+    python3 serve_ner.py --n-workers 4 --max-batch-size 32 --max-latency-ms 20
+    python3 load_test_service.py --concurrency 32 --n-requests 2000
+"""
+import asyncio
+import json
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .batch import Note, _init_worker, _load, _process_chunk
+
+MAX_BODY = 10 * 1024 * 1024
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class ServiceUnavailable(Exception):
+    """
+    the service is closing, notes are answered with a 503
+    """
+
+
+def _fail(entries: List[Tuple[Note, float, asyncio.Future]], error: BaseException):
+    for _, _, future in entries:
+        if not future.done():
+            future.set_exception(error)
+
+
+def _worker_pid() -> int:
+    # long enough for the other loaded workers to take the next tasks
+    time.sleep(0.05)
+    return os.getpid()
+
+
+class ServiceMetrics:
+    """
+    counters and the latencies of the last `window` notes, in seconds
+    """
+
+    def __init__(self, window: int = 10000):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.notes = 0
+        self.batches = 0
+        # (completed at, total, queued, processing)
+        self.latencies: Deque[Tuple[float, float, float, float]] = deque(maxlen=window)
+        self.batch_sizes: Deque[int] = deque(maxlen=window)
+
+    def add_batch(self, size: int):
+        self.batches += 1
+        self.batch_sizes.append(size)
+
+    def add_note(self, queued: float, processing: float):
+        self.notes += 1
+        self.latencies.append((time.monotonic(), queued + processing, queued, processing))
+
+    def snapshot(self, queue_depth: int = 0, in_flight: int = 0) -> Dict[str, Any]:
+        now = time.monotonic()
+        uptime = now - self.started
+        latencies = np.array(self.latencies, dtype=np.float64).reshape(-1, 4)
+        # notes completed in the last minute
+        recent = int((latencies[:, 0] >= now - 60).sum())
+
+        def percentiles(values: np.ndarray) -> Dict[str, Optional[float]]:
+            if not len(values):
+                return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None}
+            p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+            return {"p50_ms": round(p50, 2), "p95_ms": round(p95, 2), "p99_ms": round(p99, 2),
+                    "max_ms": round(values.max() * 1000, 2)}
+
+        return {
+            "uptime_s": round(uptime, 1),
+            "requests": self.requests,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "notes": self.notes,
+            "batches": self.batches,
+            "queue_depth": queue_depth,
+            "batches_in_flight": in_flight,
+            "mean_batch_size": round(float(np.mean(self.batch_sizes)), 2) if self.batch_sizes else None,
+            "notes_per_s": round(self.notes / max(uptime, 1e-9), 2),
+            "notes_per_s_last_minute": round(recent / max(min(uptime, 60), 1e-9), 2),
+            "latency": percentiles(latencies[:, 1]),
+            "queued": percentiles(latencies[:, 2]),
+            "processing": percentiles(latencies[:, 3]),
+        }
+
+
+class ExtractionService:
+    """
+    Micro-batching front end to a pool of pipelines, see the module docstring. `extract` can be awaited directly
+    (eg. from another asyncio app), `serve` also listens for HTTP requests.
+
+        service = ExtractionService(n_workers=4, use_rules=True)
+        await service.start()
+        record = await service.extract(("Pt has had fever for 5 days.", {"csn": 1}))
+    """
+
+    def __init__(
+        self,
+        n_workers: int = 1,
+        max_batch_size: int = 32,
+        max_latency_ms: float = 20,
+        max_queue: int = 10000,
+        artifact_dir: Optional[str] = None,
+        **load_kwargs,
+    ):
+        self.n_workers = n_workers
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.max_queue = max_queue
+        self.artifact_dir = artifact_dir
+        self.load_kwargs = load_kwargs
+        self.metrics = ServiceMetrics()
+        self._executor = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers_free: Optional[asyncio.Semaphore] = None
+        self._batcher = None
+        self._batches = set()
+        self._in_flight = 0
+        self._restart = None
+        self._closing = False
+        self.ready = False
+
+    async def start(self):
+        """
+        starts the worker processes and waits until each has loaded its pipeline
+        """
+        loop = asyncio.get_running_loop()
+        if self.artifact_dir is not None:
+            # build the snapshot once up front rather than in every worker
+            await loop.run_in_executor(None, _load, self.load_kwargs, self.artifact_dir)
+        self._executor = await self._start_pool()
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._workers_free = asyncio.Semaphore(self.n_workers)
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+        self.ready = True
+
+    async def _start_pool(self) -> ProcessPoolExecutor:
+        loop = asyncio.get_running_loop()
+        executor = ProcessPoolExecutor(self.n_workers, initializer=_init_worker,
+                                       initargs=(self.load_kwargs, self.artifact_dir))
+        # processes pick up tasks as soon as their pipeline is loaded, so tasks are sent until every one has answered
+        pids = set()
+        try:
+            while len(pids) < self.n_workers:
+                pids.update(await asyncio.gather(*[loop.run_in_executor(executor, _worker_pid)
+                                                   for _ in range(self.n_workers)]))
+        except BaseException:
+            executor.shutdown(wait=False)
+            raise
+        return executor
+
+    async def _restart_pool(self):
+        broken, self._executor = self._executor, None
+        broken.shutdown(wait=False)
+        self._executor = await self._start_pool()
+        self.ready = True
+
+    async def close(self):
+        """
+        stops batching, fails the notes still queued or in a batch with `ServiceUnavailable` and stops the workers
+        """
+        self.ready = False
+        self._closing = True
+        error = ServiceUnavailable("the service is shutting down")
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+        while self._queue is not None and not self._queue.empty():
+            _fail([self._queue.get_nowait()], error)
+        # the batches being processed are cancelled, their notes failed, rather than waited for
+        batches = list(self._batches)
+        for task in batches:
+            task.cancel()
+        await asyncio.gather(*batches, return_exceptions=True)
+        if self._restart is not None:
+            self._restart.cancel()
+            await asyncio.gather(self._restart, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def extract(self, note: Note) -> Dict[str, Any]:
+        """
+        the record of a (text, context) note, raises `asyncio.QueueFull` when too many notes are waiting and
+        `ServiceUnavailable` once the service is closing
+        """
+        if self._closing:
+            raise ServiceUnavailable("the service is shutting down")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((note, time.monotonic(), future))
+        return await future
+
+    async def _batch_loop(self):
+        # one get() is kept pending across timeouts and batches. cancelling it on a timeout, as wait_for does, can
+        # drop a note it has just taken off the queue on python 3.8
+        get = None
+        batch = []
+        try:
+            while True:
+                await self._workers_free.acquire()
+                if get is None:
+                    get = asyncio.ensure_future(self._queue.get())
+                batch = [await get]
+                get = None
+                deadline = batch[0][1] + self.max_latency
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        # past the deadline, only take what is already queued
+                        if get is not None or self._queue.empty():
+                            break
+                        batch.append(self._queue.get_nowait())
+                        continue
+                    if get is None:
+                        get = asyncio.ensure_future(self._queue.get())
+                    done, _ = await asyncio.wait({get}, timeout=timeout)
+                    if not done:
+                        break
+                    batch.append(get.result())
+                    get = None
+                task = asyncio.ensure_future(self._run_batch(batch))
+                self._batches.add(task)
+                task.add_done_callback(self._batches.discard)
+                batch = []
+        finally:
+            # notes taken off the queue but not yet sent in a batch
+            if get is not None and get.done() and not get.cancelled():
+                batch.append(get.result())
+            elif get is not None:
+                get.cancel()
+            _fail(batch, ServiceUnavailable("the service is shutting down"))
+
+    async def _run_batch(self, batch: List[Tuple[Note, float, asyncio.Future]]):
+        self._in_flight += 1
+        self.metrics.add_batch(len(batch))
+        start = time.monotonic()
+        executor = None
+        try:
+            if self._restart is not None:
+                # shielded, so a batch cancelled while waiting doesn't cancel the restart
+                await asyncio.shield(self._restart)
+            notes = [note for note, _, _ in batch]
+            executor = self._executor
+            records = await asyncio.get_running_loop().run_in_executor(
+                executor, _process_chunk, (notes, len(notes), False))
+        except BrokenProcessPool as e:
+            # a worker died, the pool can't run anything anymore. restarted once, by the first batch to notice
+            if executor is not None and executor is self._executor and not self._closing:
+                self.ready = False
+                self._restart = asyncio.ensure_future(self._restart_pool())
+            _fail(batch, e)
+        except asyncio.CancelledError:
+            _fail(batch, ServiceUnavailable("the service is shutting down"))
+            raise
+        except Exception as e:
+            _fail(batch, e)
+        else:
+            processing = time.monotonic() - start
+            for (_, enqueued, future), record in zip(batch, records):
+                self.metrics.add_note(start - enqueued, processing)
+                if not future.done():
+                    future.set_result(record)
+        finally:
+            self._in_flight -= 1
+            self._workers_free.release()
+
+    async def _route(self, method: str, path: str, body: bytes) -> Tuple[int, Any]:
+        if path == "/health":
+            if self.ready:
+                return 200, {"status": "ok"}
+            return 503, {"status": "closed" if self._closing else "loading"}
+        if path == "/metrics":
+            return 200, self.metrics.snapshot(queue_depth=self._queue.qsize() if self._queue else 0,
+                                              in_flight=self._in_flight)
+        if path != "/entities":
+            return 404, {"error": f"no route {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, {"error": "the body must be JSON"}
+        if not isinstance(payload, dict) or not isinstance(payload.get("text"), str):
+            return 400, {"error": "expected {\"text\": ..., \"csn\": ..., \"date\": ...}"}
+        try:
+            return 200, await self.extract((payload["text"], {"csn": payload.get("csn"), "date": payload.get("date")}))
+        except asyncio.QueueFull:
+            self.metrics.rejected += 1
+            return 503, {"error": "too many notes queued, retry later"}
+        except ServiceUnavailable as e:
+            self.metrics.rejected += 1
+            return 503, {"error": str(e)}
+        except Exception as e:
+            self.metrics.errors += 1
+            return 500, {"error": f"{type(e).__name__}: {e}"}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                self.metrics.requests += 1
+                if body is None:
+                    status, response = 413, {"error": f"bodies are limited to {MAX_BODY} bytes"}
+                else:
+                    status, response = await self._route(method, path, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(_response(status, response, keep_alive))
+                await writer.drain()
+                if not keep_alive or body is None:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000):
+        """
+        loads the pipelines and serves HTTP requests until SIGINT or SIGTERM
+        """
+        await self.start()
+        server = await asyncio.start_server(self._handle, host, port)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, server.close)
+        print(f"Serving on http://{host}:{port} with {self.n_workers} worker(s)")
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await self.close()
+
+
+async def _read_headers(reader: asyncio.StreamReader) -> Dict[str, str]:
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], Optional[bytes]]]:
+    """
+    (method, path, headers, body) of the next request on the connection, None once it is closed. the body is None when
+    it is larger than MAX_BODY.
+    """
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, path, _ = line.decode("latin-1").split(" ", 2)
+    headers = await _read_headers(reader)
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY:
+        return method, path, headers, None
+    body = await reader.readexactly(length) if length else b""
+    return method, path.split("?", 1)[0], headers, body
+
+
+def _response(status: int, payload: Any, keep_alive: bool = True) -> bytes:
+    body = json.dumps(payload).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode("latin-1") + body
+
+
+async def request(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, method: str, path: str, payload: Any = None
+) -> Tuple[int, Any]:
+    """
+    sends a request over an open keep-alive connection (see `asyncio.open_connection`), returns the status and JSON body
+    """
+    body = json.dumps(payload).encode("utf-8") if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: ed-nlp\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = await _read_headers(reader)
+    return status, json.loads(await reader.readexactly(int(headers.get("content-length", 0))))
+
+
+def serve(host: str = "127.0.0.1", port: int = 8000, n_workers: int = 1, max_batch_size: int = 32,
+          max_latency_ms: float = 20, max_queue: int = 10000, artifact_dir: Optional[str] = None, **load_kwargs):
+    """
+    runs an `ExtractionService` until interrupted
+    """
+    service = ExtractionService(n_workers=n_workers, max_batch_size=max_batch_size, max_latency_ms=max_latency_ms,
+                                max_queue=max_queue, artifact_dir=artifact_dir, **load_kwargs)
+    asyncio.run(service.serve(host, port))
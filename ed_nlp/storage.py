@@ -0,0 +1,124 @@
+"""
+Partitioned parquet storage shared by the preprocessing scripts.
+
+A table is a directory with one parquet file per arrival year, eg. processed/ed-notes-long-patient/year=2019/part-0.parquet,
+so stages can read only the columns (and years) they need and keep dtypes between stages instead of re-parsing csvs.
+"""
+import os
+import shutil
+from glob import glob
+from typing import Iterator, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+PARTITION_COL = "year"
+MISSING_PARTITION = "unknown"
+
+
+def to_parquet_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    object columns can mix types (eg. numbers in free text), which parquet can't store. cast non-missing values to str, as a csv round-trip would.
+    """
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    df.columns = [str(col) for col in df.columns]
+    return df
+
+
+def partition_path(root: str, year: Optional[int]) -> str:
+    return os.path.join(root, f"{PARTITION_COL}={MISSING_PARTITION if year is None else year}", "part-0.parquet")
+
+
+def list_partitions(root: str) -> List[Optional[int]]:
+    """
+    years with a partition in `root`, in order, with rows missing an arrival date (None) last
+    """
+    years = []
+    for path in glob(os.path.join(root, f"{PARTITION_COL}=*", "part-0.parquet")):
+        value = os.path.basename(os.path.dirname(path)).split("=", 1)[1]
+        years.append(None if value == MISSING_PARTITION else int(value))
+    return sorted(years, key=lambda year: (year is None, year))
+
+
+def clear_partitions(root: str):
+    """
+    removes every year partition in `root`. call it before writing a table one year at a time with `write_partition`,
+    otherwise years missing from the new data are left over from the previous run and read with the new ones.
+    """
+    for partition in glob(os.path.join(root, f"{PARTITION_COL}=*")):
+        shutil.rmtree(partition)
+
+
+def write_partition(df: pd.DataFrame, root: str, year: Optional[int]):
+    """
+    writes (or replaces) a single year partition, leaving the other years as they are (see `clear_partitions`)
+    """
+    path = partition_path(root, year)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    to_parquet_safe(df.copy()).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def write_partitioned(
+    df: pd.DataFrame, root: str, date_col: str = "Arrival Date", parse_dates: Optional[List[str]] = None
+) -> List[Optional[int]]:
+    """
+    replaces the table at `root` with `df`, partitioned by the year of `date_col`.
+    `parse_dates` columns are stored as datetimes rather than strings. returns the years written.
+    """
+    df = df.copy()
+    for col in parse_dates or []:
+        df[col] = pd.to_datetime(df[col], errors="coerce")
+    years = pd.to_datetime(df[date_col], errors="coerce").dt.year
+
+    clear_partitions(root)
+
+    written = []
+    for year, partition in df.groupby(years.fillna(-1).astype(int), sort=True):
+        year = None if year == -1 else int(year)
+        write_partition(partition, root, year)
+        written.append(year)
+    return written
+
+
+def read_partition(root: str, year: Optional[int], columns: Optional[List[str]] = None, filters=None) -> pd.DataFrame:
+    """
+    reads a single year, optionally only `columns` and rows matching pyarrow `filters`, eg. [('Note Type', 'in', [...])]
+    """
+    return pd.read_parquet(partition_path(root, year), columns=columns, filters=filters)
+
+
+def iter_partitions(
+    root: str, columns: Optional[List[str]] = None, years: Optional[List[Optional[int]]] = None, filters=None
+) -> Iterator[Tuple[Optional[int], pd.DataFrame]]:
+    """
+    yields (year, dataframe) one partition at a time, so memory is bounded by the largest year
+    """
+    for year in list_partitions(root):
+        if years is not None and year not in years:
+            continue
+        yield year, read_partition(root, year, columns=columns, filters=filters)
+
+
+def read_partitioned(
+    root: str, columns: Optional[List[str]] = None, years: Optional[List[Optional[int]]] = None, filters=None
+) -> pd.DataFrame:
+    """
+    reads a whole table (or the given `years`) into one dataframe
+    """
+    dfs = [df for _, df in iter_partitions(root, columns=columns, years=years, filters=filters)]
+    if not dfs:
+        raise FileNotFoundError(f"No partitions found in {root}")
+    return pd.concat(dfs, axis=0, ignore_index=True)
+
+
+def list_columns(root: str) -> List[str]:
+    """
+    column names of a table, read from the schema of its first partition without loading any data
+    """
+    years = list_partitions(root)
+    if not years:
+        raise FileNotFoundError(f"No partitions found in {root}")
+    return [name for name in pq.read_schema(partition_path(root, years[0])).names if not name.startswith("__")]
@@ -0,0 +1,189 @@
+"""
+Synthetic crystal-style data, for benchmarks and for exercising the pipeline without access to real notes.
+
+Each patient-visit (CSN/MRN) has several note types. Every note is split into rows of at most `max_fragment_len`
+characters, as in the EPIC export, with the patient and note metadata repeated on each row. Note text follows the EPIC
+flattening: headers (HPI, Review of Systems, Physical Exam, ...) are separated by ~9 spaces and line breaks by 2+ spaces.
+
+    spreadsheet = make_crystal_spreadsheet(1000, seed=0)
+    paths = write_crystal_spreadsheets(spreadsheet, 'raw/synthetic', n_files=4)
+    labeled = make_labeled_notes(200)  # provider notes with gold sentences, see compare_sentencizers.py
+"""
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+PATIENT_COLS = ['CSN', 'MRN', 'Patient Name', 'Sex', 'Date of Birth', 'Age (Years)',
+                'Arrival Date', 'Arrival Time', 'CTAS', 'Address',
+                'City', 'Province', 'Postal Code', 'Country', 'Chief Complaint',
+                'Diagnosis', 'Provider to Dispo', 'EMS Offload Time', 'Problem List', 'Disposition']
+
+NOTE_COLS = ['Note Type', 'File Time', 'Author Type', "Author's Service", 'Referral Order', 'External Referral', 'CHIRPP Icon', 'Note Text']
+
+CRYSTAL_COLUMNS = PATIENT_COLS + NOTE_COLS
+
+# (note type, probability a visit has it)
+NOTE_TYPES = [('ED Provider Notes', 0.95), ('ED Triage Notes', 0.9), ('ED Notes', 0.5), ('Discharge Instructions', 0.3)]
+
+FIRST_NAMES = ['Jane', 'John', 'Alex', 'Sam', 'Priya', 'Wei', 'Fatima', 'Liam', 'Olivia', 'Noah']
+LAST_NAMES = ['Doe', 'Smith', 'Tremblay', 'Nguyen', 'Singh', 'Chen', 'Ali', 'Brown', 'Martin', 'Wilson']
+
+COMPLAINTS = ['vomiting', 'headache', 'abdominal pain', 'fever', 'cough', 'head injury', 'rash', 'migraine', 'arm injury', 'diarrhea']
+
+HPI_SENTENCES = [
+    'Pt has had {complaint} for {days} days.',
+    'Vomited {n} times today, non bilious, non bloody.',
+    'No vomiting.',
+    'Complains of headache since this morning?',
+    'Mom reports decreased oral intake.',
+    'Denies fever.',
+    'Possible head injury after fall from bike?',
+    'History of migraines, similar to previous episodes.',
+    'Sibling at home with similar symptoms.',
+    'No headache, no neck stiffness.',
+]
+
+ROS_LINES = ['Constitutional: no fever', 'GI: vomiting, no diarrhea', 'Neuro: headache, no weakness', 'Resp: no cough', 'Skin: no rash']
+
+EXAM_LINES = ['General: well appearing', 'HEENT: normal', 'Abdomen: soft, non tender', 'Neuro: GCS 15, no focal deficits', 'Chest: clear']
+
+PLAN_LINES = ['Likely viral gastroenteritis.', 'Ondansetron given.', 'Discharge home with return precautions.', 'Follow up with family doctor.', 'Migraine, treated with ibuprofen.']
+
+# EPIC flattens headers to ~9 spaces and line breaks to 2 or more
+HEADER_BREAK = ' ' * 9
+LINE_BREAK = '  '
+
+
+def _provider_note_segments(rng: np.random.Generator, name: str, age: int, sex: str, complaint: str) -> List[Tuple[str, str]]:
+    """
+    (sentence, separator that follows it) pairs, a header on its own line is a sentence
+    """
+    hpi_header = rng.choice(['HPI', 'History of Presenting Illness', 'hpi hpi'])
+    hpi = [
+        sentence.format(complaint=complaint, days=rng.integers(1, 8), n=rng.integers(1, 10))
+        for sentence in rng.choice(HPI_SENTENCES, size=rng.integers(2, 6), replace=False)
+    ]
+    intro = f'{name}, a {age} y.o. {rng.integers(0, 12)} m.o. {sex.lower()} presented to the ED with {complaint}.'
+    sections = [
+        (hpi_header, hpi, ' '),
+        ('Past Medical History', [rng.choice(['None', 'Asthma', 'Migraines', 'Eczema'])], LINE_BREAK),
+        ('Review of Systems', list(rng.choice(ROS_LINES, size=3, replace=False)), LINE_BREAK),
+        ('Physical Exam', list(rng.choice(EXAM_LINES, size=3, replace=False)), LINE_BREAK),
+        (rng.choice(['Impression and Plan', 'Assessment & Plan']), list(rng.choice(PLAN_LINES, size=2, replace=False)), ' '),
+    ]
+
+    segments = [(intro, HEADER_BREAK)]
+    for header, lines, sep in sections:
+        segments.append((str(header), LINE_BREAK))
+        segments.extend((str(line), sep) for line in lines[:-1])
+        segments.append((str(lines[-1]), HEADER_BREAK))
+    segments[-1] = (segments[-1][0], '')
+    return segments
+
+
+def _provider_note(rng: np.random.Generator, name: str, age: int, sex: str, complaint: str) -> str:
+    return ''.join(segment + sep for segment, sep in _provider_note_segments(rng, name, age, sex, complaint))
+
+
+def _triage_note(rng: np.random.Generator, complaint: str) -> str:
+    return f'Pt presents with {complaint}.{LINE_BREAK}' + ' '.join(rng.choice(HPI_SENTENCES[1:], size=2, replace=False))
+
+
+def make_labeled_notes(n_notes: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """
+    provider notes with their gold sentence segmentation, as {'text': ..., 'sentences': [...]}
+    """
+    rng = np.random.default_rng(seed)
+    notes = []
+    for _ in range(n_notes):
+        name = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+        segments = _provider_note_segments(rng, name, int(rng.integers(0, 18)), rng.choice(['Male', 'Female']), rng.choice(COMPLAINTS))
+        notes.append({'text': ''.join(segment + sep for segment, sep in segments), 'sentences': [segment for segment, _ in segments]})
+    return notes
+
+
+def _split(text: str, max_len: int) -> List[str]:
+    return [text[start:start + max_len] for start in range(0, len(text), max_len)] or ['']
+
+
+def make_crystal_spreadsheet(n_visits: int, seed: int = 0, max_fragment_len: int = 250, start_year: int = 2015, n_years: int = 6) -> pd.DataFrame:
+    """
+    one row per note fragment with the columns of a crystal export, in CSN order
+    """
+    rng = np.random.default_rng(seed)
+    base = pd.Timestamp(f'{start_year}-01-01')
+    rows = []
+
+    for visit in range(n_visits):
+        name = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+        sex = rng.choice(['Male', 'Female'])
+        age = int(rng.integers(0, 18))
+        complaint = rng.choice(COMPLAINTS)
+        arrival = base + pd.Timedelta(days=int(rng.integers(0, 365 * n_years)), seconds=int(rng.integers(0, 86400)))
+        patient = {
+            'CSN': 100000000 + visit,
+            'MRN': 1000000 + int(rng.integers(0, max(n_visits // 2, 1))),
+            'Patient Name': name,
+            'Sex': sex,
+            'Date of Birth': (arrival - pd.Timedelta(days=365 * age + int(rng.integers(0, 365)))).normalize(),
+            'Age (Years)': age,
+            'Arrival Date': arrival.normalize(),
+            'Arrival Time': arrival,
+            'CTAS': int(rng.integers(1, 6)),
+            'Address': f'{rng.integers(1, 999)} Main St',
+            'City': 'Toronto',
+            'Province': 'ON',
+            'Postal Code': 'M5G 1X8',
+            'Country': 'Canada',
+            'Chief Complaint': complaint.title(),
+            'Diagnosis': rng.choice(['Gastroenteritis', 'Migraine', 'Viral illness', 'Head injury']),
+            'Provider to Dispo': arrival + pd.Timedelta(minutes=int(rng.integers(30, 600))),
+            'EMS Offload Time': np.nan,
+            'Problem List': np.nan,
+            'Disposition': rng.choice(['Discharge', 'Admit']),
+        }
+
+        for note_type, prob in NOTE_TYPES:
+            if rng.random() > prob:
+                continue
+            if note_type == 'ED Provider Notes':
+                text = _provider_note(rng, name, age, sex, complaint)
+            else:
+                text = _triage_note(rng, complaint)
+            note = {
+                'Note Type': note_type,
+                'File Time': arrival + pd.Timedelta(minutes=int(rng.integers(5, 300))),
+                'Author Type': rng.choice(['Physician', 'Registered Nurse', 'Resident']),
+                "Author's Service": 'Emergency',
+                'Referral Order': np.nan,
+                'External Referral': np.nan,
+                'CHIRPP Icon': rng.choice(['Y', np.nan]),
+            }
+            for fragment in _split(text, max_fragment_len):
+                rows.append({**patient, **note, 'Note Text': fragment})
+
+    df = pd.DataFrame(rows, columns=CRYSTAL_COLUMNS)
+    for col in ['Referral Order', 'External Referral', 'EMS Offload Time', 'Problem List']:
+        df[col] = df[col].astype(object)
+    return df
+
+
+def write_crystal_spreadsheets(spreadsheet: pd.DataFrame, out_dir: str, n_files: int = 1, banner: Optional[bool] = None) -> List[str]:
+    """
+    splits `spreadsheet` into `n_files` excel files by visit. with the 'SK CHIRPP Notes' banner above the header of every
+    other file (or of all/none, if `banner` is given), as in the real exports. returns the file paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    visit_file = pd.factorize(spreadsheet['CSN'])[0] % n_files
+    paths = []
+    for i in range(n_files):
+        df = spreadsheet[visit_file == i]
+        path = os.path.join(out_dir, f'crystal-{i:03d}.xlsx')
+        if banner if banner is not None else i % 2 == 1:
+            df = pd.DataFrame([list(df.columns)] + df.values.tolist(),
+                              columns=['SK CHIRPP Notes'] + [f'Unnamed: {j}' for j in range(1, df.shape[1])])
+        df.to_excel(path, index=False)
+        paths.append(path)
+    return paths
@@ -11,10 +11,21 @@ from .resources import target_rules
 from .resources import section_rules
 from .resources import context_rules
 from .resources import postprocess_rules
+from .resources import array_postprocess_rules
+from . import sentences
+from .sentences import SENTENCE_SPLITTERS
+from .preprocess import FastPreprocessor
+from .postprocess import ArrayPostprocessor  # registers the ed_nlp_postprocessor factory
+from .sections import SectionNER  # registers the ed_nlp_section_ner factory
+from .dedup import BlockCache  # registers the ed_nlp_block_cache factory
 
-from typing import List, Dict, Iterator
-import pandas as pd
-from medspacy.io import DocConsumer
+import re
+from typing import List, Dict, Iterator, Tuple, TYPE_CHECKING
+import numpy as np
+
+# pandas (and medspacy.io, which imports it) are only imported by the functions that use them, to keep `load()` quick to import
+if TYPE_CHECKING:
+    import pandas as pd
 
 
 def _set_attributes():
@@ -23,29 +34,24 @@ def _set_attributes():
     """
     Span.set_extension("next_sentence", getter = get_next_sentence, force = True)
     Span.set_extension("previous_sentence", getter = get_previous_sentence, force = True)
+    # ent._.sentence_window(before, after)
+    Span.set_extension("sentence_window", method = sentences.get_sentence_window, force = True)
     Doc.set_extension("internal_id", default=None, force = True)
     Doc.set_extension("date", default=None, force = True)
     Doc.set_extension("csn", default=None, force = True)
 
 def get_next_sentence(ent) -> str:
     """
-    using the current token's end of sentence, get next token's sentence 
+    using the current token's end of sentence, get next token's sentence.
+    sentence boundaries are looked up in an index computed once per doc, see `ed_nlp.sentences.sentence_index`
     """
-    sent = ent.sent
-    try:
-        return str(ent.doc[sent.end + 1].sent)
-    except IndexError:
-        return None
+    return sentences.get_next_sentence(ent)
 
 def get_previous_sentence(ent) -> str:
     """
     using the current token's beginning of sentence, get previous token's sentence 
     """
-    sent = ent.sent
-    try:
-        return str(ent.doc[sent.start - 1].sent)
-    except IndexError:
-        return None
+    return sentences.get_previous_sentence(ent)
     
 
 def create_doc_consumer():
@@ -53,6 +59,8 @@ def create_doc_consumer():
     UNUSED.
     Creates a DocConsumer with custom dtypes.
     """
+    from medspacy.io import DocConsumer
+
     nlp = medspacy.load()
     doc_cons_attrs = DocConsumer.get_default_attrs()
     ent_attrs = doc_cons_attrs['ent']
@@ -81,14 +89,15 @@ def query_results(
     return [item for item in entity_results if query in item["entity_text"]]
 
 
-def get_entities(doc, use_rules: bool) -> Iterator[str]:
+def get_entities(doc, use_rules: bool, sentence_window: int = 0) -> Iterator[str]:
     """
     USED FOR EXTRACTING ENTITIES AND SENTENCES FOR LABELING - see notebook.
     iterates through entities in a doc and generates dictionaries corresponding to attributes of the entity
+    with `sentence_window` > 0, 'window_sentences_extracted' is the text of the entity's sentence and up to that many sentences either side
     """
 
     for ent in doc.ents:
-            yield {
+            ent_dict = {
                 "entity_text": ent.text,
                 "entity_label": ent.label_,
                 "start_char": ent.start_char,
@@ -101,20 +110,25 @@ def get_entities(doc, use_rules: bool) -> Iterator[str]:
                 "is_historical": ent._.is_historical,
                 "is_hypothetical": ent._.is_hypothetical,
                 "is_family": ent._.is_family,
-                "current_sentence_extracted": ent.sent,
+                "current_sentence_extracted": sentences.get_sentence(ent),
                 "previous_sentence_extracted": ent._.previous_sentence, #get_previous_sentence(ent),
                 "next_sentence_extracted": ent._.next_sentence, #get_next_sentence(ent),
                 "section_category": ent._.section_category,
                 "section_title": ent._.section_title,
                 # 'section_text': ent._.section_text,
             }
+            if sentence_window:
+                ent_dict["window_sentences_extracted"] = sentences.get_sentence_window(ent, sentence_window, sentence_window)
+            yield ent_dict
 
 
-def get_regex_tbl(pattern:str, df:pd.DataFrame, col:str = 'Ed Provider Notes') -> pd.DataFrame:
+def get_regex_tbl(pattern:str, df:"pd.DataFrame", col:str = 'Ed Provider Notes') -> "pd.DataFrame":
     """
     FOR WRANGLING AND EDA
     given a string, count the number of occurences in the provider notes of a pattern and return a dataframe with the proportion of notes with said pattern across years
     """
+    import pandas as pd
+
     # str.contains counts the first occurence?
     cts = pd.DataFrame(df[col].str.contains(pattern, regex = True, case=False, na = False))
     if 'year' not in df:
@@ -126,12 +140,118 @@ def get_regex_tbl(pattern:str, df:pd.DataFrame, col:str = 'Ed Provider Notes') -
     return summary_cts
 
 
-def df_from_entity_json(results_list:List[str]) -> pd.DataFrame:
+def _combinable(compiled: "re.Pattern") -> bool:
+    """
+    whether a pattern can be part of a combined pattern: no groups (which would renumber backreferences) and no
+    global inline flags
+    """
+    return compiled.groups == 0 and not compiled.flags & ~re.UNICODE
+
+
+def _combine(patterns: Dict[int, str], flags: int) -> Tuple["re.Pattern", "re.Pattern"]:
+    """
+    the alternation of `patterns`, to search with, and the same alternation with pattern k in group _p{k} (as in
+    `ed_nlp.deid.Redactor`), to tell which one matched. named groups stop re from skipping ahead to the characters a
+    branch starts with, which makes searching about 10x slower, so they are only used at a match
+    """
+    search = re.compile("|".join(f"(?:{pattern})" for pattern in patterns.values()), flags=flags)
+    named = re.compile("|".join(f"(?P<_p{k}>{pattern})" for k, pattern in patterns.items()), flags=flags)
+    return search, named
+
+
+def _regex_hits(patterns: List[str], texts: List[str]) -> np.ndarray:
+    """
+    (note x pattern) boolean array of whether each pattern is found anywhere in each note, ignoring case.
+
+    patterns are combined into one alternation (see `_combine`) and each note is scanned once, from left to right: each
+    match marks its pattern as found, and the scan goes on from the same position with the alternation of the patterns
+    not found yet, so a pattern starting where another one matched is still found. notes are searched one at a time,
+    so anchors and lookarounds see the note on its own. patterns without uppercase characters are matched
+    case-sensitively against the lowercased notes, which is much faster than re.IGNORECASE, so there are at most two
+    scans per note. patterns with groups or inline flags can't be combined and are searched on their own.
+    """
+    hits = np.zeros((len(texts), len(patterns)), dtype=bool)
+    for lower in (True, False):
+        flags = 0 if lower else re.IGNORECASE
+        selected = [k for k, pattern in enumerate(patterns) if (pattern == pattern.lower()) == lower]
+        if not selected:
+            continue
+        notes = [text.lower() for text in texts] if lower else texts
+
+        compiled = {k: re.compile(patterns[k], flags=flags) for k in selected}
+        combined = tuple(k for k in selected if _combinable(compiled[k]))
+        for k in selected:
+            if k not in combined:
+                hits[:, k] = [compiled[k].search(note) is not None for note in notes]
+        if not combined:
+            continue
+
+        # regexes of the patterns left to find, notes tend to find them in the same few orders
+        regexes: Dict[Tuple[int, ...], Tuple["re.Pattern", "re.Pattern"]] = {}
+        for i, note in enumerate(notes):
+            remaining, pos = combined, 0
+            while remaining:
+                if remaining not in regexes:
+                    regexes[remaining] = _combine({k: patterns[k] for k in remaining}, flags)
+                search, named = regexes[remaining]
+                match = search.search(note, pos)
+                if match is None:
+                    break
+                pos = match.start()
+                k = int(named.match(note, pos).lastgroup[2:])
+                hits[i, k] = True
+                # the patterns left to find can start at the same position
+                remaining = tuple(j for j in remaining if j != k)
+    return hits
+
+
+def get_regex_prevalence_tbl(patterns, df, col: str = 'Ed Provider Notes', year_col: str = 'year') -> "pd.DataFrame":
+    """
+    FOR WRANGLING AND EDA
+    multi-pattern version of `get_regex_tbl`: searches all patterns in a single scan of each note (see `_regex_hits`) and returns a year x pattern table with the proportion of notes containing each pattern, 
+    along with the number of notes per year in 'count'. 
+    `patterns` is a list of regexes or a dict of name: regex, `df` is a dataframe or an iterable of dataframes (eg. `pd.read_csv(..., chunksize=...)`) so the whole column never needs to be in memory.
+    """
+    import pandas as pd
+
+    if not isinstance(patterns, dict):
+        patterns = {pattern: pattern for pattern in patterns}
+    names = list(patterns)
+
+    chunks = [df] if isinstance(df, pd.DataFrame) else df
+    sums, counts = None, None
+
+    for chunk in chunks:
+        if year_col not in chunk:
+            raise ValueError(f"Missing '{year_col}' in dataframe")
+        texts = chunk[col].tolist()
+        missing = np.array([not isinstance(text, str) for text in texts], dtype=bool)
+        hits = _regex_hits(list(patterns.values()), ["" if is_missing else text for text, is_missing in zip(texts, missing)])
+        # missing notes don't contain anything, as with na = False
+        hits[missing] = False
+        hits = pd.DataFrame(hits, columns=names, index=chunk.index)
+
+        grouped = hits.groupby(chunk[year_col])
+        chunk_sums, chunk_counts = grouped.sum(), grouped.size()
+        sums = chunk_sums if sums is None else sums.add(chunk_sums, fill_value=0)
+        counts = chunk_counts if counts is None else counts.add(chunk_counts, fill_value=0)
+
+    if sums is None:
+        raise ValueError("No data")
+
+    prevalence = sums.div(counts, axis=0)
+    prevalence['count'] = counts
+    return prevalence.sort_index()
+
+
+def df_from_entity_json(results_list:List[str]) -> "pd.DataFrame":
     """
     UNUSED
     creates a dataframe for labelling, downstream analytics, etc. from the output of 
     nlp pipeline
+    superseded by `ed_nlp.columnar.read_entities`, which reads the same columns from the parquet output of `run_ner.py --columnar`
     """
+    import pandas as pd
     
     # create first dataframe
     first_df =  pd.json_normalize(results_list)
@@ -155,9 +275,31 @@ def load(
     use_rules: bool = True,
     enable={"medspacy_tokenizer", "medspacy_target_matcher", "medspacy_context"},
     disable=[],
-    set_attributes = True
+    set_attributes = True,
+    profile = False,
+    sentence_splitter = "pysbd",
+    fast_preprocessor = True,
+    fast_postprocessor = True,
+    fast_target_matcher = True,
+    lexicon = None,
+    sections = None,
+    block_cache = None
 ) -> spacy.Language:
-    """ """
+    """
+    with `profile=True` every pipe and rule is instrumented and the statistics are collected in `nlp.profiler`, see `ed_nlp.profiling`
+    `sentence_splitter` is "pysbd" (medspacy_pysbd) or "newline", a much faster rule-based splitter, see `ed_nlp.sentences`
+    `fast_preprocessor` applies the preprocess rules with `ed_nlp.preprocess.FastPreprocessor` (same output) instead of medspacy's `Preprocessor`
+    `fast_postprocessor` applies the postprocess rules over all of a doc's entities at once with `ed_nlp.postprocess.ArrayPostprocessor` (same output) instead of medspacy's `Postprocessor`
+    `fast_target_matcher` matches the target rules with `ed_nlp.lexicon.LexiconMatcher`, which compiles literal regexes into stems so matching cost stays flat as rules are added, instead of medspacy's `TargetMatcher`. the pipe keeps the name "medspacy_target_matcher".
+    `lexicon` is the path of a CSV of extra target rules, see `ed_nlp.lexicon`. only used with `use_rules`
+    `sections` is a list of section categories (eg. `ed_nlp.sections.NER_SECTIONS`): the sectionizer runs first and entities are only extracted from those sections, see `ed_nlp.sections`. the NER pipes and ConText are then reached with `nlp.get_pipe("ed_nlp_section_ner").get_pipe(...)`
+    `block_cache` is a number of blocks (lines) of text: NER and ConText only run over the lines not among the last `block_cache` distinct ones seen, see `ed_nlp.dedup`. only with `use_rules`. the NER pipes and ConText are then reached with `nlp.get_pipe("ed_nlp_block_cache").get_pipe(...)`
+    """
+    if sentence_splitter not in SENTENCE_SPLITTERS:
+        raise ValueError(f"sentence_splitter must be one of {list(SENTENCE_SPLITTERS)}, got {sentence_splitter!r}")
+    if block_cache is not None and not use_rules:
+        # the pre-trained ner looks past the end of a block, its output can't be reused per block
+        raise ValueError("block_cache is only supported with use_rules=True")
 
     if set_attributes:
         _set_attributes()
@@ -173,9 +315,16 @@ def load(
     if use_rules:
         nlp = medspacy.load(enable=medspacy_pipes)
 
+        if fast_target_matcher:
+            from .lexicon import LexiconMatcher  # registers the ed_nlp_target_matcher factory
+            nlp.replace_pipe("medspacy_target_matcher", "ed_nlp_target_matcher")
+
         target_matcher = nlp.get_pipe("medspacy_target_matcher")
 
         target_matcher.add(target_rules)
+        if lexicon is not None:
+            from .lexicon import read_lexicon
+            target_matcher.add(read_lexicon(lexicon))
 
         print("Target matcher added to pipeline")
 
@@ -194,25 +343,44 @@ def load(
             ],
         )
     # preprocessor
-    preprocessor = Preprocessor(nlp.tokenizer)
+    preprocessor = FastPreprocessor(nlp.tokenizer) if fast_preprocessor else Preprocessor(nlp.tokenizer)
     # add the rules to the preprocessor
     preprocessor.add(preprocess_rules)
     # set the attribute to the new preprocessor with the added rules
     nlp.tokenizer = preprocessor
 
     # load sentence boundary disambiguator
-    nlp.add_pipe("medspacy_pysbd", first=True)
+    nlp.add_pipe(SENTENCE_SPLITTERS[sentence_splitter], first=True)
 
-    # loading in sectionizer patterns
-    sectionizer = nlp.add_pipe("medspacy_sectionizer")
+    # loading in sectionizer patterns. with `sections` it runs right after the sentence splitter, so NER can be limited to some sections
+    sectionizer = nlp.add_pipe("medspacy_sectionizer", after=SENTENCE_SPLITTERS[sentence_splitter] if sections is not None else None)
     sectionizer.add(section_rules)
 
     # load context rules
 
     context = nlp.get_pipe('medspacy_context')
     context.add(context_rules)
+
+    if sections is not None or block_cache is not None:
+        # NER and ConText only run over the selected sections, or over the lines not seen before
+        ner_pipes = [name for name in nlp.pipe_names if name not in (SENTENCE_SPLITTERS[sentence_splitter], "medspacy_sectionizer")]
+        if block_cache is not None:
+            wrapper = nlp.add_pipe("ed_nlp_block_cache", config={"max_blocks": block_cache, "sections": None if sections is None else list(sections)})
+        else:
+            wrapper = nlp.add_pipe("ed_nlp_section_ner", config={"sections": list(sections)})
+        for name in ner_pipes:
+            wrapper.add(name, nlp.remove_pipe(name)[1])
  
     # load postprocess rules
-    postprocessor = nlp.add_pipe("medspacy_postprocessor")
-    postprocessor.add(postprocess_rules)
+    if fast_postprocessor:
+        postprocessor = nlp.add_pipe("ed_nlp_postprocessor")
+        postprocessor.add(array_postprocess_rules)
+    else:
+        postprocessor = nlp.add_pipe("medspacy_postprocessor")
+        postprocessor.add(postprocess_rules)
+
+    if profile:
+        from .profiling import instrument
+
+        nlp.profiler = instrument(nlp)
     return nlp
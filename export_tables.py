@@ -0,0 +1,43 @@
+"""
+Exports the NER output (run_ner.py's JSONL) as doc, entity and context table files for the app database, to be bulk
+loaded with LOAD DATA or COPY instead of uploaded with upload_docs.py, see `ed_nlp.export`.
+python3 export_tables.py --input processed/output_ner_full.jsonl --out-dir processed/tables --start-ent-id 1 --print-sql mysql
+
+--start-ent-id should be past the largest ent_id already in the Entity table (SELECT MAX(ent_id) FROM entity).
+--sqlite loads the export into a SQLite database, to check it before loading it into the app database.
+"""
+import argparse
+import time
+
+from ed_nlp.export import FORMATS, export_tables, bulk_load_statements, load_sqlite
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', default = 'processed/output_ner_full.jsonl')
+    parser.add_argument('--out-dir', default = 'processed/tables')
+    parser.add_argument('--format', choices = FORMATS, default = 'csv')
+    parser.add_argument('--start-ent-id', type = int, default = 1)
+    parser.add_argument('--context-id', default = None,
+                        help = 'name of the Context primary key column, to assign context ids as well as entity ids')
+    parser.add_argument('--start-context-id', type = int, default = 1)
+    parser.add_argument('--chunk-size', type = int, default = 1000, help = 'records parsed and written at a time')
+    parser.add_argument('--sqlite', default = None, help = 'SQLite database to load the export into')
+    parser.add_argument('--print-sql', choices = ['mysql', 'postgres'], default = None,
+                        help = 'print the statements loading a csv export')
+    args = parser.parse_args()
+
+    start = time.time()
+    n_rows = export_tables(args.input, args.out_dir, fmt = args.format, start_ent_id = args.start_ent_id,
+                           context_id = args.context_id, start_context_id = args.start_context_id,
+                           chunk_size = args.chunk_size)
+    print(f"Exported {n_rows} rows to {args.out_dir} in {time.time() - start:.2f}s")
+
+    if args.sqlite:
+        start = time.time()
+        loaded = load_sqlite(args.out_dir, args.sqlite, fmt = args.format, context_id = args.context_id)
+        print(f"Loaded {loaded} rows into {args.sqlite} in {time.time() - start:.2f}s")
+
+    if args.print_sql:
+        for statement in bulk_load_statements(args.out_dir, dialect = args.print_sql, context_id = args.context_id):
+            print(statement)
@@ -1,31 +1,172 @@
 """
 Filters for only ED related notes and recasts data from long to wide so each row is a patient-visit record with notes as columns.
+
+--streaming builds the same csv in a single pass over chunks of the long csv, so the input does not need to fit in memory.
+--parquet reads the long dataframe partitioned by arrival year (see ed_nlp.storage) one year at a time, reading only the columns needed, and writes the tidy dataframe in the same format.
 """
+import argparse
 import pandas as pd
 import os 
+from typing import Dict, List, Optional, Tuple
 
+from ed_nlp.storage import clear_partitions, iter_partitions, list_columns, write_partition
 
-if __name__ == "__main__":
+ED_NOTE_TYPES = ['ED Provider Notes', 'ED Triage Notes']
 
-    df = pd.read_csv(os.path.join('processed', 'ed-notes-long-patient.csv'))
-    
-    ed_notes = df[df['Note Type'].isin(['ED Provider Notes', 'ED Triage Notes'])].reset_index()
-    
-    # removing note metadata, pivot so note types are the columns and the note text are the values
-    ed_notes2 = ed_notes.drop(columns = ['Author Type', "Author's Service", "CHIRPP Icon", "External Referral", "File Time", "Referral Order"]).pivot_table(index = ['CSN', 'MRN'], columns ='Note Type', values = 'Note Text', aggfunc='first')
+# these columns are the notes metadata and are not unique, ie. cannot be cast to 'tidy' or 'wide' data
+NOTE_METADATA_COLS = ['Author Type', "Author's Service", "CHIRPP Icon", "External Referral", "File Time", "Referral Order"]
+
+
+def pivot_notes(ed_notes: pd.DataFrame) -> pd.DataFrame:
+    """
+    pivot so note types are the columns and the note text are the values
+    """
+    return ed_notes.pivot_table(index = ['CSN', 'MRN'], columns ='Note Type', values = 'Note Text', aggfunc='first')
 
-    # join the patient-visit metadata, minus the note metadata, with the notes
+
+def merge_visits(visits: pd.DataFrame, ed_notes2: pd.DataFrame) -> pd.DataFrame:
+    """
+    join the patient-visit metadata, minus the note metadata, with the notes
+    """
     merged_df = pd.merge(
-        # these columns are the notes metadata and are not unique, ie. cannot be cast to 'tidy' or 'wide' data
-        ed_notes.drop(columns = ['Author Type', "Author's Service", "CHIRPP Icon", "External Referral", "File Time", "Referral Order",'Note Type', 'Note Text', 'index']).drop_duplicates(),
+        visits.drop_duplicates(),
         ed_notes2,
         how="left",
         on = ['CSN', 'MRN']
     )
 
     # remove duplicate - looks like they are true duplicates due to some weird parsing?
-    merged_df = merged_df[~merged_df[['CSN', 'MRN']].duplicated()]
-    
-    merged_df.to_csv('processed/ed-notes-tidy-patient.csv', index = False)
-    
-    
\ No newline at end of file
+    return merged_df[~merged_df[['CSN', 'MRN']].duplicated()]
+
+
+def tidy_ed_notes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    filter -> pivot -> merge -> de-duplicate, on the whole long dataframe in memory
+    """
+    ed_notes = df[df['Note Type'].isin(ED_NOTE_TYPES)].reset_index()
+
+    # removing note metadata, pivot so note types are the columns and the note text are the values
+    ed_notes2 = pivot_notes(ed_notes.drop(columns = NOTE_METADATA_COLS))
+
+    return merge_visits(ed_notes.drop(columns = NOTE_METADATA_COLS + ['Note Type', 'Note Text', 'index']), ed_notes2)
+
+
+def _visit_key(csn, mrn) -> Tuple[Optional[str], Optional[str]]:
+    # missing keys compare equal, as in `duplicated`
+    return (None if pd.isna(csn) else csn, None if pd.isna(mrn) else mrn)
+
+
+def stream_tidy_ed_notes(csv_path: str, out_path: str, chunksize: int = 100000) -> int:
+    """
+    single-pass, chunked equivalent of the filter -> pivot -> merge -> de-duplicate steps, writing the same csv.
+
+    the long csv must be grouped by CSN/MRN, as written by pre_process_crystal.py, so a visit can be written out as soon as the next one starts.
+    values are read as strings so they are written back exactly as they were read, regardless of how each chunk would be typed.
+    for each visit the first row's metadata is kept, and for each note type the first non-missing note text, as `pivot_table(aggfunc='first')` would.
+    returns the number of visits written.
+    """
+    note_cols = sorted(ED_NOTE_TYPES)
+    visit_cols = None
+    # visit key -> [metadata, {note type: note text}], in order of first appearance
+    pending: Dict[tuple, list] = {}
+    written_keys = set()
+    note_types_seen = set()
+    n_duplicate_visits = 0
+    n_written = 0
+    tmp_path = out_path + '.tmp'
+
+    def flush(f, keys: List[tuple]):
+        nonlocal n_written
+        if not keys:
+            return
+        rows = []
+        for key in keys:
+            metadata, notes = pending.pop(key)
+            rows.append(list(metadata) + [notes.get(note_type) for note_type in note_cols])
+            written_keys.add(key)
+        pd.DataFrame(rows, columns = visit_cols + note_cols).to_csv(f, header = n_written == 0, index = False)
+        n_written += len(rows)
+
+    with open(tmp_path, 'w', newline = '') as f:
+        for chunk in pd.read_csv(csv_path, chunksize = chunksize, dtype = str):
+            if visit_cols is None:
+                visit_cols = [col for col in chunk.columns if col not in NOTE_METADATA_COLS + ['Note Type', 'Note Text']]
+
+            ed_notes = chunk[chunk['Note Type'].isin(ED_NOTE_TYPES)]
+            if ed_notes.empty:
+                continue
+
+            # duplicate visits: same CSN/MRN with differing metadata, only the first row is kept
+            visit_rows = ed_notes[visit_cols].drop_duplicates()
+            n_duplicate_visits += int(visit_rows[['CSN', 'MRN']].duplicated().sum())
+
+            for row in visit_rows.drop_duplicates(['CSN', 'MRN']).itertuples(index = False, name = None):
+                key = _visit_key(row[visit_cols.index('CSN')], row[visit_cols.index('MRN')])
+                if key in written_keys:
+                    raise ValueError(f"Visit {key} appears again after other visits, the input must be grouped by CSN/MRN")
+                pending.setdefault(key, [row, {}])
+
+            # first non-missing note text per visit and note type, visits missing a key have no notes (as in pivot_table)
+            texts = ed_notes[ed_notes['Note Text'].notna() & ed_notes['CSN'].notna() & ed_notes['MRN'].notna()]\
+                .drop_duplicates(['CSN', 'MRN', 'Note Type'])
+            for csn, mrn, note_type, text in zip(texts['CSN'], texts['MRN'], texts['Note Type'], texts['Note Text']):
+                pending[_visit_key(csn, mrn)][1].setdefault(note_type, text)
+                note_types_seen.add(note_type)
+
+            # every visit but the last one in the chunk is complete
+            last_key = _visit_key(ed_notes['CSN'].iloc[-1], ed_notes['MRN'].iloc[-1])
+            flush(f, [key for key in pending if key != last_key])
+
+        if pending:
+            flush(f, list(pending))
+
+    # pivot_table drops note types without any text, only known once every chunk is read, so their columns are
+    # dropped by rewriting the output a chunk at a time
+    missing_types = [note_type for note_type in note_cols if note_type not in note_types_seen]
+    if missing_types and n_written:
+        chunks = pd.read_csv(tmp_path, dtype = str, chunksize = chunksize, usecols = lambda col: col not in missing_types)
+        with open(out_path, 'w', newline = '') as f:
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(f, header = i == 0, index = False)
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, out_path)
+
+    if n_duplicate_visits:
+        print(f"{n_duplicate_visits} duplicate visit rows with differing metadata, kept the first of each")
+    return n_written
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parquet', action='store_true', help='read and write year-partitioned parquet instead of csv')
+    parser.add_argument('--streaming', action='store_true', help='single pass over chunks of the long csv')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.parquet:
+        long_root = os.path.join('processed', 'ed-notes-long-patient')
+        visit_cols = [col for col in list_columns(long_root) if col not in NOTE_METADATA_COLS + ['Note Type', 'Note Text']]
+        only_ed = [('Note Type', 'in', ED_NOTE_TYPES)]
+        tidy_root = os.path.join('processed', 'ed-notes-tidy-patient')
+        clear_partitions(tidy_root)
+
+        # the free text is only read for the pivot, the visit metadata is read without it
+        # all rows of a visit share an arrival date and so are in the same partition
+        for (year, ed_notes), (_, visits) in zip(
+            iter_partitions(long_root, columns = ['CSN', 'MRN', 'Note Type', 'Note Text'], filters = only_ed),
+            iter_partitions(long_root, columns = visit_cols, filters = only_ed)
+        ):
+            merged_df = merge_visits(visits, pivot_notes(ed_notes))
+            write_partition(merged_df, tidy_root, year)
+
+    elif args.streaming:
+        stream_tidy_ed_notes(os.path.join('processed', 'ed-notes-long-patient.csv'), 'processed/ed-notes-tidy-patient.csv', chunksize = args.chunksize)
+
+    else:
+        df = pd.read_csv(os.path.join('processed', 'ed-notes-long-patient.csv'))
+
+        merged_df = tidy_ed_notes(df)
+
+        merged_df.to_csv('processed/ed-notes-tidy-patient.csv', index = False)
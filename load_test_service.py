@@ -0,0 +1,78 @@
+"""
+Load generator for the extraction service (serve_ner.py): sends synthetic notes (see ed_nlp.synthetic) from
+--concurrency concurrent keep-alive connections and reports client-side latency and throughput, then the service's own
+metrics.
+python3 load_test_service.py --url http://127.0.0.1:8000 --concurrency 32 --n-requests 2000
+
+With --rate, requests are started at that many per second (spread over the connections) instead of back to back, to
+measure latency at a given load rather than peak throughput. Exits with an error if any request failed.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+from ed_nlp.service import request
+from ed_nlp.synthetic import make_labeled_notes
+
+
+async def connection(host, port, notes, queue, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            try:
+                i, scheduled = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if scheduled is not None:
+                await asyncio.sleep(max(scheduled - time.monotonic(), 0))
+            start = time.monotonic()
+            status, _ = await request(reader, writer, 'POST', '/entities', notes[i % len(notes)])
+            latencies.append(time.monotonic() - (scheduled if scheduled is not None else start))
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def main(args):
+    url = urlparse(args.url)
+    notes = [{'text': note['text'], 'csn': i} for i, note in enumerate(make_labeled_notes(min(args.n_requests, 1000), seed=args.seed))]
+
+    start = time.monotonic()
+    queue = asyncio.Queue()
+    for i in range(args.n_requests):
+        queue.put_nowait((i, start + i / args.rate if args.rate else None))
+    latencies, statuses = [], {}
+    await asyncio.gather(*[connection(url.hostname, url.port or 80, notes, queue, latencies, statuses)
+                           for _ in range(args.concurrency)])
+    elapsed = time.monotonic() - start
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    print(f'{args.n_requests} requests in {elapsed:.2f}s ({args.n_requests / elapsed:.1f} requests/s), '
+          f'{args.concurrency} connections, statuses {statuses}')
+    print(f'latency p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms, max {max(latencies) * 1000:.1f}ms')
+
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    _, metrics = await request(reader, writer, 'GET', '/metrics')
+    writer.close()
+    print('\nservice metrics:\n' + json.dumps(metrics, indent=2))
+    return statuses
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--n-requests', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=None, help='requests per second, as fast as possible by default')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    statuses = asyncio.run(main(args))
+    if set(statuses) != {200}:
+        sys.exit(1)
@@ -2,36 +2,229 @@
 Concatenates all crystal notes, parsing out structure and saving down as i) JSON and ii) a long dataframe for downstream analyses
 python3 pre-process-crystal.py
 
-TODO: add arguments (not really necessary as ideally, this is a one-time step)
+--streaming converts each spreadsheet into its own parquet part, in parallel, and parses the parts one at a time instead of concatenating everything in memory.
+only spreadsheets that changed since the last run are converted again. the csv is then grouped by CSN/MRN rather than sorted.
+with --parquet the parsed parts are still concatenated, as each year partition is written whole.
+python3 pre-process-crystal.py --streaming --n-jobs 8
+
+--parquet saves the long dataframe as parquet partitioned by arrival year (see ed_nlp.storage), which filter_parse_ed_notes.py can read instead of the csv.
 """
 
+import argparse
+import importlib.util
 import json
 import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob 
 from pprint import pprint
 from tqdm import tqdm
-from typing import List
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from ed_nlp.storage import to_parquet_safe, write_partitioned
+
+
+# calamine is a much faster, read-only excel reader (pandas >= 2.2), fall back to openpyxl otherwise
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') is not None else None
+
+
+def _fix_header(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    some exports have a 'SK CHIRPP Notes' banner above the actual header, in which case the first row is the header.
+    the banner is matched regardless of case/whitespace.
+    """
+    if any(str(col).strip().lower() == 'sk chirpp notes' for col in df.columns):
+        df.columns = df.iloc[0] # take first row as header
+        df = df[1:].reset_index(drop = True)
+        # the header row forced every column to object, restore numeric/datetime dtypes
+        df = df.infer_objects()
+    return df
+
+
+def read_crystal_spreadsheet(spreadsheet: str) -> pd.DataFrame:
+    """
+    reads a single crystal excel spreadsheet
+    """
+    df = pd.read_excel(spreadsheet, engine = EXCEL_ENGINE)
+    return _fix_header(df)
 
 
-def load_concat_crystal_notes(globbed_dir:list[str]) -> pd.DataFrame:
+def load_concat_crystal_notes(globbed_dir:List[str]) -> pd.DataFrame:
     """
     reads in and concatenates a directory of crystal excel spreadsheets
     """
     dfs_list = []
     
-    for spreadsheet in tqdm(globbed_files):
-        df = pd.read_excel(spreadsheet)
-        if 'SK CHIRPP Notes' in df.columns:
-            df.columns = df.iloc[0] # take first row as header
-            df = df[1:]
-        dfs_list.append(df)
+    for spreadsheet in tqdm(globbed_dir):
+        dfs_list.append(read_crystal_spreadsheet(spreadsheet))
         
     full_df = pd.concat(dfs_list, axis = 0)
     
     return full_df
 
 
+def _convert_spreadsheet(args) -> str:
+    spreadsheet, part_path = args
+    df = to_parquet_safe(read_crystal_spreadsheet(spreadsheet))
+    tmp_path = part_path + '.tmp'
+    df.to_parquet(tmp_path, index = False)
+    os.replace(tmp_path, part_path)
+    return part_path
+
+
+def _file_signature(path: str) -> Dict[str, float]:
+    stat = os.stat(path)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size}
+
+
+def convert_crystal_spreadsheets(globbed_dir: List[str], parts_dir: str, n_jobs: Optional[int] = None) -> List[str]:
+    """
+    converts each crystal spreadsheet into a parquet part in `parts_dir`, one file per worker at a time so memory is bounded by the largest spreadsheets being read.
+    spreadsheets whose modification time and size are unchanged since the last run are skipped, parts of spreadsheets that no longer exist are removed.
+    returns the paths of all parts, in the order of `globbed_dir`.
+    """
+    os.makedirs(parts_dir, exist_ok = True)
+    manifest_path = os.path.join(parts_dir, '_manifest.json')
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    part_paths = {spreadsheet: os.path.join(parts_dir, os.path.splitext(os.path.basename(spreadsheet))[0] + '.parquet')
+                  for spreadsheet in globbed_dir}
+    signatures = {spreadsheet: _file_signature(spreadsheet) for spreadsheet in globbed_dir}
+
+    to_convert = [spreadsheet for spreadsheet in globbed_dir
+                  if manifest.get(os.path.basename(spreadsheet)) != signatures[spreadsheet] 
+                  or not os.path.isfile(part_paths[spreadsheet])]
+    print(f'Converting {len(to_convert)} of {len(globbed_dir)} spreadsheets')
+
+    with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+        jobs = [(spreadsheet, part_paths[spreadsheet]) for spreadsheet in to_convert]
+        for spreadsheet, _ in zip(to_convert, tqdm(executor.map(_convert_spreadsheet, jobs), total = len(jobs))):
+            manifest[os.path.basename(spreadsheet)] = signatures[spreadsheet]
+            # saved after every spreadsheet so an interrupted run keeps its progress
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent = 4)
+
+    current = set(part_paths.values())
+    for stale in set(glob(os.path.join(parts_dir, '*.parquet'))) - current:
+        os.remove(stale)
+    manifest = {name: sig for name, sig in manifest.items() 
+                if name in {os.path.basename(spreadsheet) for spreadsheet in globbed_dir}}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent = 4)
+
+    return [part_paths[spreadsheet] for spreadsheet in globbed_dir]
+
+
+def load_crystal_parts(part_paths: List[str], columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    concatenates parquet parts written by `convert_crystal_spreadsheets`, optionally reading only `columns`
+    """
+    return pd.concat([pd.read_parquet(part, columns = columns) for part in part_paths], axis = 0)
+
+
+def _common_dtypes(part_paths: List[str]) -> Dict[str, np.dtype]:
+    """
+    the dtype of each column once the parts are concatenated. columns missing in every row of a part (stored as nulls) are left out, as pandas ignores them when concatenating
+    """
+    empties = []
+    for part in part_paths:
+        schema = pq.read_schema(part)
+        empty = schema.empty_table().to_pandas()
+        empties.append(empty[[field.name for field in schema if field.name in empty and not pa.types.is_null(field.type)]])
+    return pd.concat(empties, axis = 0).dtypes.to_dict()
+
+
+# columns related to patient information, could be broken down into patient-specific and patient-visit columns 
+PATIENT_METADATA_COLS = ['CSN', 'MRN', 'Patient Name', 'Sex', 'Date of Birth', 'Age (Years)', 
+                         'Arrival Date', 'Arrival Time', 'CTAS', 'Address', 
+                         'City', 'Province', 'Postal Code', 'Country', 'Chief Complaint', 
+                         'Diagnosis', 'Provider to Dispo', 'EMS Offload Time', 'Problem List', 'Disposition'] 
+
+NOTE_METADATA_COLS = ['Note Type', 'File Time', 'Author Type', "Author's Service"]
+
+MULTIPLE_VAL_COLS = ['Note Type', 'File Time', 'Author Type', "Author's Service", 'Referral Order', 'External Referral', 'CHIRPP Icon', 'Note Text']
+
+# cast to str per patient-visit
+STR_COLS = ['Date of Birth', 'Arrival Date', 'Arrival Time', 'Provider to Dispo', 'File Time']
+
+
+def _datetime_str_by_group(col: pd.Series, group_ids: np.ndarray) -> pd.Series:
+    """
+    vectorized equivalent of calling `col.astype(str)` separately on each group.
+    pandas picks the string format of a datetime column from all of its values - dates only if every value is at midnight, 
+    otherwise seconds, with milli/micro/nanoseconds only if any value needs them - so the format is decided per group here.
+    """
+    col = col.astype('datetime64[ns]')
+    ints = col.to_numpy().view('i8')
+    valid = col.notna().to_numpy()
+    flags = pd.DataFrame({
+        'time': valid & (ints % (86400 * 10**9) != 0),
+        'ms': valid & (ints % 10**9 != 0),
+        'us': valid & (ints % 10**6 != 0),
+        'ns': valid & (ints % 10**3 != 0),
+    }).groupby(group_ids).transform('any')
+
+    out = col.dt.strftime('%Y-%m-%d %H:%M:%S.%f').to_numpy(dtype = object)
+    time_, ms, us, ns = (flags[flag].to_numpy() for flag in ['time', 'ms', 'us', 'ns'])
+    for mask, length in [(~time_, 10), (time_ & ~ms, 19), (ms & ~us, 23)]:
+        mask = mask & valid
+        out[mask] = [value[:length] for value in out[mask]]
+    out[ns] = [value + f'{extra:03d}' for value, extra in zip(out[ns], ints[ns] % 1000)]
+    out[~valid] = 'NaT'
+    return pd.Series(out, index = col.index, dtype = object)
+
+
+def _assemble_crystal_notes(spreadsheet: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    reassembles the split notes of every patient-visit with a single sort and group-by over the whole dataframe.
+
+    returns i) one row of patient metadata per patient-visit, in (CSN, MRN) order and ii) one row per note, ordered by patient-visit
+    then note metadata, where `_visit` is the position of the note's patient-visit in i).
+    rows missing a CSN/MRN or note metadata (other than the file time) are dropped, as `groupby` would.
+    """
+    # dropped (missing) keys are -1 or NaN depending on the pandas version
+    group_ids = spreadsheet.groupby(['CSN', 'MRN'], sort = True).ngroup().to_numpy()
+    keep = np.flatnonzero(group_ids >= 0)
+    order = keep[np.argsort(group_ids[keep], kind = 'stable')]
+    df = spreadsheet.iloc[order]
+    group_ids = group_ids[order].astype(np.int64)
+
+    df = df[list(dict.fromkeys(PATIENT_METADATA_COLS + MULTIPLE_VAL_COLS))].copy()
+    for col in STR_COLS:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = _datetime_str_by_group(df[col], group_ids)
+        else:
+            df[col] = df[col].astype(str)
+
+    first_rows = np.r_[True, group_ids[1:] != group_ids[:-1]]
+    visits = df.loc[first_rows, PATIENT_METADATA_COLS].reset_index(drop = True)
+
+    notes = df[MULTIPLE_VAL_COLS].assign(_visit = group_ids)
+    notes = notes[notes[NOTE_METADATA_COLS].notna().all(axis = 1)]
+    note_ids = notes.groupby(['_visit'] + NOTE_METADATA_COLS, sort = True).ngroup().to_numpy()
+    order = np.argsort(note_ids, kind = 'stable')
+    notes = notes.iloc[order]
+    note_ids = note_ids[order]
+
+    # fragments of a note are contiguous, in their original order, so join between the note boundaries
+    starts = np.flatnonzero(np.r_[True, note_ids[1:] != note_ids[:-1]])
+    ends = np.r_[starts[1:], len(note_ids)]
+    fragments = notes['Note Text'].fillna('').astype(str).tolist()
+    note_text = [''.join(fragments[start:end]) for start, end in zip(starts, ends)]
+
+    notes = notes.iloc[starts].reset_index(drop = True)
+    notes['Note Text'] = note_text
+    notes = notes[['_visit'] + MULTIPLE_VAL_COLS]
+
+    return visits, notes
+
+
 def parse_crystal_notes(spreadsheet: pd.DataFrame)  -> List[dict]:
     """
     Parses a dataframe of crystal notes into json
@@ -40,17 +233,32 @@ def parse_crystal_notes(spreadsheet: pd.DataFrame)  -> List[dict]:
     A single patient-visit (CSN-MRN) can be have multiple note types, with each note type being split into several rows due to a supposed character limit in EPIC.
     """
     
-    master_list = []
+    # confident these are already sorted..
+    spreadsheet['File Time'] = pd.to_datetime(spreadsheet['File Time'].astype('object'))
+
+    visits, notes = _assemble_crystal_notes(spreadsheet)
+
+    master_list = visits.to_dict(orient = 'records')
+    for csn_mrn_dict in master_list:
+        csn_mrn_dict['Notes'] = []
 
-    # columns related to patient information, could be broken down into patient-specific and patient-visit columns 
-    patient_metadata_cols = ['CSN', 'MRN', 'Patient Name', 'Sex', 'Date of Birth', 'Age (Years)', 
-                             'Arrival Date', 'Arrival Time', 'CTAS', 'Address', 
-                             'City', 'Province', 'Postal Code', 'Country', 'Chief Complaint', 
-                             'Diagnosis', 'Provider to Dispo', 'EMS Offload Time', 'Problem List', 'Disposition'] 
+    note_visits = notes['_visit'].tolist()
+    for visit, note_dict in zip(note_visits, notes.drop(columns = ['_visit']).to_dict(orient = 'records')):
+        master_list[visit]['Notes'].append(note_dict)
     
-    note_metadata_cols = ['Note Type', 'File Time', 'Author Type', "Author's Service"]
+    return master_list
+
+
+def _parse_crystal_notes_loop(spreadsheet: pd.DataFrame)  -> List[dict]:
+    """
+    Original, group-by-group implementation of `parse_crystal_notes`, kept as the reference the vectorized version is checked against.
+    """
     
-    multiple_val_cols = ['Note Type', 'File Time', 'Author Type', "Author's Service", 'Referral Order', 'External Referral', 'CHIRPP Icon', 'Note Text']
+    master_list = []
+
+    patient_metadata_cols = PATIENT_METADATA_COLS
+    note_metadata_cols = NOTE_METADATA_COLS
+    multiple_val_cols = MULTIPLE_VAL_COLS
     
     # confident these are already sorted..
     spreadsheet['File Time'] = pd.to_datetime(spreadsheet['File Time'].astype('object'))
@@ -59,7 +267,7 @@ def parse_crystal_notes(spreadsheet: pd.DataFrame)  -> List[dict]:
     
     for (group_id, group) in tqdm(grouped_df):
         
-        for col in ['Date of Birth', 'Arrival Date', 'Arrival Time', 'Provider to Dispo', 'File Time']:
+        for col in STR_COLS:
             group[col] = group[col].astype(str)
 
         # create our visit-patient metadata dictionary using the known, duplicated columns. 
@@ -88,6 +296,70 @@ def parse_crystal_notes(spreadsheet: pd.DataFrame)  -> List[dict]:
     
     return master_list
 
+def parse_crystal_notes_long(spreadsheet: pd.DataFrame) -> pd.DataFrame:
+    """
+    Parses a dataframe of crystal notes directly into the long dataframe (one row per patient-visit-note) that `crystal_json_to_df(parse_crystal_notes(...))` produces, 
+    without building the nested json in between.
+    """
+
+    spreadsheet['File Time'] = pd.to_datetime(spreadsheet['File Time'].astype('object'))
+
+    visits, notes = _assemble_crystal_notes(spreadsheet)
+
+    # visits without any notes are kept as a single row with empty note columns, as exploding an empty 'Notes' list would
+    empty_visits = np.setdiff1d(np.arange(len(visits)), notes['_visit'].to_numpy())
+    notes = pd.concat([notes, pd.DataFrame({'_visit': empty_visits})], axis = 0, ignore_index = True)\
+        .sort_values('_visit', kind = 'stable')
+
+    long_df = pd.concat([visits.iloc[notes['_visit'].to_numpy()].reset_index(drop = True),
+                         notes[MULTIPLE_VAL_COLS].reset_index(drop = True)],
+                        axis = 1)
+
+    return long_df
+
+
+def iter_crystal_parts_long(part_paths: List[str]) -> Iterator[pd.DataFrame]:
+    """
+    `parse_crystal_notes_long` of the concatenated parts, one part at a time. visits with rows in more than one part are set aside and parsed together last, so each visit is in a single frame.
+    the frames are each sorted by CSN/MRN but, written one after another, only grouped by them. columns are cast to the dtype they would have in the concatenated parts, so values are written out the same way.
+    """
+    keys = pd.concat([pd.read_parquet(part, columns = ['CSN', 'MRN']).drop_duplicates() for part in part_paths], axis = 0)
+    visit_parts = keys.groupby(['CSN', 'MRN']).size()
+    split_visits = visit_parts.index[visit_parts > 1]
+    dtypes = _common_dtypes(part_paths)
+
+    split_rows = []
+    for part in part_paths:
+        df = pd.read_parquet(part)
+        df = df.astype({col: dtype for col, dtype in dtypes.items() if col in df and df[col].dtype != dtype})
+        is_split = pd.MultiIndex.from_frame(df[['CSN', 'MRN']]).isin(split_visits)
+        split_rows.append(df[is_split])
+        if not is_split.all():
+            yield parse_crystal_notes_long(df[~is_split].copy())
+
+    if len(split_visits):
+        yield parse_crystal_notes_long(pd.concat(split_rows, axis = 0))
+
+
+def iter_crystal_json(long_df: pd.DataFrame) -> Iterator[dict]:
+    """
+    Lazily rebuilds the nested json of `parse_crystal_notes` from the long dataframe, one patient-visit at a time.
+    """
+    patient_cols = [col for col in long_df.columns if col not in MULTIPLE_VAL_COLS]
+    note_cols = [col for col in long_df.columns if col in MULTIPLE_VAL_COLS]
+
+    keys = long_df[['CSN', 'MRN']]
+    starts = np.flatnonzero((keys != keys.shift()).any(axis = 1).to_numpy())
+    ends = np.r_[starts[1:], len(long_df)]
+
+    for start, end in zip(starts, ends):
+        visit_df = long_df.iloc[start:end]
+        csn_mrn_dict = visit_df[patient_cols].iloc[:1].to_dict(orient = 'records')[0]
+        # a missing note type marks a visit without notes
+        csn_mrn_dict['Notes'] = visit_df.loc[visit_df['Note Type'].notna(), note_cols].to_dict(orient = 'records')
+        yield csn_mrn_dict
+
+
 def crystal_json_to_df(json_list = List[dict]) -> pd.DataFrame:
     """
     Takes a json, where each element is a patient-visit along with a nested array of 'Notes' and converts it into a long dataframe. 
@@ -108,6 +380,12 @@ def crystal_json_to_df(json_list = List[dict]) -> pd.DataFrame:
     return long_df
 
 if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streaming', action='store_true', help='convert spreadsheets to parquet parts in parallel and parse them one at a time instead of one concatenated csv')
+    parser.add_argument('--n-jobs', type=int, default=None)
+    parser.add_argument('--parquet', action='store_true', help='save the long dataframe as parquet partitioned by arrival year instead of csv')
+    args = parser.parse_args()
     
     raw_crystal_dir = './raw/Pre-Screen/*xlsx'
     out_dir = './processed'
@@ -116,22 +394,32 @@ if __name__ == "__main__":
         os.makedirs(out_dir)
     concat_df_filename = os.path.join(out_dir, 'concatenated-crystal-notes.csv')
     
-    # skip if concatenated df doesn't exist, pyopenxl is slow..
-    if not os.path.isfile(concat_df_filename): 
-        globbed_files = glob(raw_crystal_dir)
+    if args.streaming:
+        part_paths = convert_crystal_spreadsheets(sorted(glob(raw_crystal_dir)), os.path.join(out_dir, 'crystal-parts'), n_jobs = args.n_jobs)
+        long_dfs = iter_crystal_parts_long(part_paths)
+    else:
+        # skip if concatenated df doesn't exist, pyopenxl is slow..
+        if not os.path.isfile(concat_df_filename): 
+            globbed_files = glob(raw_crystal_dir)
 
-        concat_df = load_concat_crystal_notes(globbed_files)
+            concat_df = load_concat_crystal_notes(globbed_files)
 
-        concat_df.to_csv(concat_df_filename, index = False)
-    else:
-        concat_df = pd.read_csv(concat_df_filename)
+            concat_df.to_csv(concat_df_filename, index = False)
+        else:
+            concat_df = pd.read_csv(concat_df_filename)
     
-    json_list = parse_crystal_notes(concat_df)
+        long_dfs = [parse_crystal_notes_long(concat_df)]
 
-    # saves output as json and into a long dataframe
-    # with open(os.path.join( out_dir, "ed-crystal-dump-v2.json"),"w") as f:
-    #     f.write(json.dumps(json_list, indent = 4))
-
-    long_df = crystal_json_to_df(json_list)
+    # optionally, save the nested json
+    # with open(os.path.join( out_dir, "ed-crystal-dump-v2.jsonl"),"w") as f:
+    #     for csn_mrn_dict in iter_crystal_json(long_df):
+    #         f.write(json.dumps(csn_mrn_dict, default = str) + "\n")
     
-    long_df.to_csv(os.path.join(out_dir, 'ed-notes-long-patient.csv'), index = False)
\ No newline at end of file
+    if args.parquet:
+        # each year partition is written whole, so parsed parts are concatenated
+        long_df = long_dfs[0] if not args.streaming else pd.concat(long_dfs, axis = 0, ignore_index = True)
+        write_partitioned(long_df, os.path.join(out_dir, 'ed-notes-long-patient'), date_col = 'Arrival Date', parse_dates = ['File Time'])
+    else:
+        with open(os.path.join(out_dir, 'ed-notes-long-patient.csv'), 'w', newline = '') as f:
+            for i, long_df in enumerate(long_dfs):
+                long_df.to_csv(f, header = i == 0, index = False)
@@ -1,32 +1,82 @@
+"""
+Removes patient metadata and names (where applicable) at the beginning of ED provider notes.
+
+--parquet processes the year-partitioned tidy dataframe (see ed_nlp.storage) one year at a time.
+--n-process redacts notes in parallel, see ed_nlp.deid for the redaction rules.
+"""
+import argparse
+import os
 import pandas as pd
 import json
 
+from ed_nlp.deid import DEFAULT_RULES, redact_notes, check_counts, summarize_counts
+from ed_nlp.storage import clear_partitions, iter_partitions, write_partition
+
+# we drop the MRN because it is not unique, the CSN is.
+PATIENT_METADATA_COLS = ['MRN', 'Patient Name', 'Sex', 'Date of Birth', 'Age (Years)', 'Address', 'Postal Code', 'City', 'Province', 'Country', 'Provider to Dispo', 'EMS Offload Time']
+
+
+def redact_names(df: pd.DataFrame, n_process: int = 1) -> pd.DataFrame:
+    """
+    redacts patient names in place and returns the number of redactions per note
+    """
+    df['ED Provider Notes'], counts = redact_notes(df['ED Provider Notes'], DEFAULT_RULES, n_process = n_process)
+
+    # sanity check replacements, should be 1 occurence of the replaced pattern at MOST
+    check_counts(counts, DEFAULT_RULES)
+    return counts
+
+
+def summarize_redactions(counts: pd.DataFrame, year: pd.Series) -> pd.DataFrame:
+    """
+    number and proportion of notes redacted per year
+    """
+    return summarize_counts(counts, year)['patient_name']
+
+
 if __name__ == "__main__":
-    df = pd.read_csv('processed/ed-notes-tidy-patient.csv')
 
-    master_key = df[['CSN', 'MRN']].to_dict(orient = 'records')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parquet', action='store_true', help='read and write year-partitioned parquet, one year at a time')
+    parser.add_argument('--n-process', type=int, default=1)
+    args = parser.parse_args()
 
-    with open("master_key.json", "w") as f:
-        json.dump(master_key, f, indent=4)
+    if args.parquet:
+        master_key = []
+        summaries = []
+        no_metadata_root = os.path.join('processed', 'ed-notes-tidy-patient-no-metadata')
+        clear_partitions(no_metadata_root)
+        for year, df in iter_partitions(os.path.join('processed', 'ed-notes-tidy-patient')):
+            master_key.extend(df[['CSN', 'MRN']].to_dict(orient = 'records'))
 
+            cts = redact_names(df, n_process = args.n_process)
+            summaries.append(summarize_redactions(cts, pd.Series(pd.DatetimeIndex(df['Arrival Date']).year, index = df.index)))
 
-    # remove standard pattern consisting of John doe, a X y.o. Y m.o male presented....
-    df['ED Provider Notes'] = df['ED Provider Notes'].replace("^([A-Za-z].*?)presented", "[Patient Name Redacted] presented", regex = True)
+            write_partition(df.drop(columns = PATIENT_METADATA_COLS), no_metadata_root, year)
 
-    # sanity check replacements, should be 1 occurence of the replaced pattern at MOST
-    cts = pd.DataFrame(df['ED Provider Notes'].str.count('\\[Patient Name Redacted\\] presented'))
-    assert cts[cts['ED Provider Notes'] > 1].shape[0] == 0
-    # df.iloc[cts[cts['ED Provider Notes'] > 1].index]
+        summary_cts = pd.concat(summaries)
+
+        with open("master_key.json", "w") as f:
+            json.dump(master_key, f, indent=4)
+
+    else:
+        df = pd.read_csv('processed/ed-notes-tidy-patient.csv')
+
+        master_key = df[['CSN', 'MRN']].to_dict(orient = 'records')
+
+        with open("master_key.json", "w") as f:
+            json.dump(master_key, f, indent=4)
+
+        cts = redact_names(df, n_process = args.n_process)
 
-    df['year'] = pd.DatetimeIndex(df['Arrival Date']).year
-    df = df.sort_values(['year'])
-    cts['year'] = df['year'] 
+        df['year'] = pd.DatetimeIndex(df['Arrival Date']).year
+        df = df.sort_values(['year'])
 
-    summary_cts = cts.groupby('year')['ED Provider Notes'].agg(['sum', 'count'])
-    summary_cts['prop'] = summary_cts['sum']/summary_cts['count']
-    df = df.drop(columns = ['year'])
+        summary_cts = summarize_redactions(cts, df['year'])
+        df = df.drop(columns = ['year'])
 
-    # we drop the MRN because it is not unique, the CSN is.
-    df2 = df.drop(columns = ['MRN', 'Patient Name', 'Sex', 'Date of Birth', 'Age (Years)', 'Address', 'Postal Code', 'City', 'Province', 'Country', 'Provider to Dispo', 'EMS Offload Time'])
+        df2 = df.drop(columns = PATIENT_METADATA_COLS)
 
-    df2.to_csv('processed/ed-notes-tidy-patient-no-metadata.csv', index = False)
\ No newline at end of file
+        df2.to_csv('processed/ed-notes-tidy-patient-no-metadata.csv', index = False)
+    
+    print(summary_cts)
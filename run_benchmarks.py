@@ -0,0 +1,217 @@
+"""
+Times each stage of the pipeline on synthetic crystal data (see ed_nlp.synthetic) at several corpus sizes, reporting
+throughput and peak memory. Results are saved as JSON so runs can be compared to catch regressions.
+python3 run_benchmarks.py --sizes 100 1000 5000
+
+Compare against an earlier run, exiting with an error if any stage got slower or used more memory by more than --threshold:
+python3 run_benchmarks.py --compare processed/benchmarks/results-20221001-120000.json
+
+Stages: the excel read (load_concat_crystal_notes), parse_crystal_notes_long (as pre_process_crystal.py runs it), the
+filter/pivot of filter_parse_ed_notes.py, de-identification, building the pipeline with load(), nlp.pipe +
+get_entities (on at most --nlp-limit notes) and the bulk upload into a temporary sqlite database. Stages whose
+dependencies aren't installed are skipped, along with the stages that need their output.
+Results are saved under processed/benchmarks by default.
+peak memory is the peak python allocation (tracemalloc) during a separate, untimed run of the stage.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from ed_nlp.synthetic import make_crystal_spreadsheet, write_crystal_spreadsheets
+from pre_process_crystal import load_concat_crystal_notes, parse_crystal_notes_long
+from filter_parse_ed_notes import tidy_ed_notes
+from remove_patient_md import redact_names
+
+STAGES = ['load_concat_crystal_notes', 'parse_crystal_notes_long', 'filter_parse_ed_notes', 'deid', 'load', 'nlp', 'upload']
+
+
+def measure(fn: Callable, repeat: int = 1, memory: bool = True) -> Tuple[Any, float, Optional[float]]:
+    """
+    returns the output of `fn()`, the best wall time over `repeat` calls and the peak traced memory in MB
+    """
+    best, out = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return out, best, peak_mb
+
+
+def _upload(records: List[Dict[str, Any]], tmp_dir: str) -> int:
+    import upload_docs
+    from app.extensions import db
+
+    db_path = os.path.join(tmp_dir, 'benchmark.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    jsonl_path = os.path.join(tmp_dir, 'ner.jsonl')
+    with open(jsonl_path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+    os.environ['ST_DATABASE_URI'] = f'sqlite:///{db_path}'
+    app = upload_docs.get_register_app()
+    with app.app_context():
+        db.create_all()
+    return upload_docs.bulk_upload(app, db, jsonl_path)
+
+
+def run_size(n_visits: int, stages: List[str], tmp_dir: str, seed: int = 0, n_files: int = 4,
+             repeat: int = 1, memory: bool = True, nlp_limit: int = 500) -> List[Dict[str, Any]]:
+    """
+    runs every stage in `stages` on `n_visits` synthetic visits, each stage taking the output of the previous one
+    """
+    results = []
+
+    def skip(stage: str, reason: str):
+        print(f'{stage}: skipped ({reason})')
+        results.append({'stage': stage, 'n_visits': n_visits, 'skipped': reason})
+
+    def record(stage: str, data: Any, n_items: Callable[[Any], int], fn: Callable[[Any], Any], unit: str):
+        """
+        runs (and times, if selected) `fn(data)`, where `data` is the output of the previous stage. returns None when
+        the stage can't run, so the stages after it are skipped too
+        """
+        if data is None:
+            skip(stage, 'no input, an earlier stage was skipped')
+            return None
+        if stage not in stages:
+            try:
+                return fn(data)
+            except ImportError as e:
+                skip(stage, str(e))
+                return None
+        try:
+            out, seconds, peak_mb = measure(lambda: fn(data), repeat = repeat, memory = memory)
+        except ImportError as e:
+            skip(stage, str(e))
+            return None
+        n_items = n_items(data)
+        results.append({'stage': stage, 'n_visits': n_visits, 'n_items': n_items, 'unit': unit, 'seconds': seconds,
+                        'items_per_s': n_items / max(seconds, 1e-9), 'peak_mb': peak_mb})
+        print(f'{stage}: {n_items} {unit} in {seconds:.3f}s ({n_items / max(seconds, 1e-9):.1f} {unit}/s)'
+              + (f', peak {peak_mb:.1f} MB' if peak_mb is not None else ''))
+        return out
+
+    spreadsheet = make_crystal_spreadsheet(n_visits, seed = seed)
+    print(f'\n{n_visits} visits, {len(spreadsheet)} spreadsheet rows')
+
+    if 'load_concat_crystal_notes' in stages:
+        def read_excel(spreadsheet):
+            paths = write_crystal_spreadsheets(spreadsheet, os.path.join(tmp_dir, f'xlsx-{n_visits}'), n_files = n_files)
+            return load_concat_crystal_notes(paths)
+        concat_df = record('load_concat_crystal_notes', spreadsheet, len, read_excel, 'rows')
+        # without an excel engine, the later stages run on the generated spreadsheet
+        spreadsheet = concat_df if concat_df is not None else spreadsheet
+
+    # parse_crystal_notes_long converts 'File Time' in place
+    long_df = record('parse_crystal_notes_long', spreadsheet, len, lambda df: parse_crystal_notes_long(df.copy()), 'rows')
+    tidy_df = record('filter_parse_ed_notes', long_df, len, tidy_ed_notes, 'rows')
+
+    def deid(tidy_df):
+        df = tidy_df.copy()
+        redact_names(df)
+        return df
+    deid_df = record('deid', tidy_df, lambda df: int(df['ED Provider Notes'].notna().sum()), deid, 'notes')
+
+    if not {'load', 'nlp', 'upload'} & set(stages):
+        return results
+
+    def load_pipeline(_):
+        from ed_nlp.utils import load
+
+        return load()
+
+    def process(notes):
+        from ed_nlp.batch import process_notes
+
+        return list(process_notes(nlp, notes))
+
+    nlp = record('load', True, lambda _: 1, load_pipeline, 'pipelines')
+    notes = None
+    if nlp is not None and deid_df is not None:
+        from ed_nlp.batch import iter_notes
+
+        notes_path = os.path.join(tmp_dir, f'notes-{n_visits}.csv')
+        deid_df.to_csv(notes_path, index = False)
+        notes = list(iter_notes(notes_path))[:nlp_limit]
+    records = record('nlp', notes, len, process, 'notes')
+    record('upload', records, len, lambda records: _upload(records, tmp_dir), 'docs')
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], threshold: float = 1.2) -> pd.DataFrame:
+    """
+    ratio of current to baseline time and peak memory per (stage, size), with a flag for ratios above `threshold`
+    """
+    cols = ['stage', 'n_visits', 'seconds', 'peak_mb']
+    current = pd.DataFrame([r for r in results if 'skipped' not in r], columns = cols)
+    base = pd.DataFrame([r for r in baseline if 'skipped' not in r], columns = cols)
+    df = current.merge(base, on = ['stage', 'n_visits'], suffixes = ('', '_baseline'))
+    df['time_ratio'] = df['seconds'] / df['seconds_baseline']
+    df['memory_ratio'] = df['peak_mb'] / df['peak_mb_baseline']
+    df['regression'] = (df['time_ratio'] > threshold) | (df['memory_ratio'] > threshold)
+    return df
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [100, 1000, 5000], help = 'numbers of patient-visits')
+    parser.add_argument('--stages', nargs = '+', default = STAGES, choices = STAGES)
+    parser.add_argument('--repeat', type = int, default = 1, help = 'timed runs per stage, the best is kept')
+    parser.add_argument('--no-memory', action = 'store_true', help = 'skip the traced run for peak memory')
+    parser.add_argument('--nlp-limit', type = int, default = 500, help = 'most notes run through the NLP pipeline per size')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--out-dir', default = os.path.join('processed', 'benchmarks'))
+    parser.add_argument('--compare', default = None, help = 'results file of an earlier run to compare against')
+    parser.add_argument('--threshold', type = float, default = 1.2)
+    args = parser.parse_args()
+
+    started = datetime.now()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            results.extend(run_size(size, args.stages, tmp_dir, seed = args.seed, repeat = args.repeat,
+                                    memory = not args.no_memory, nlp_limit = args.nlp_limit))
+
+    os.makedirs(args.out_dir, exist_ok = True)
+    out_path = os.path.join(args.out_dir, f"results-{started.strftime('%Y%m%d-%H%M%S')}.json")
+    meta = {'date': started.isoformat(timespec = 'seconds'), 'commit': _git_commit(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'pandas': pd.__version__, 'args': vars(args)}
+    with open(out_path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent = 2)
+    print(f'\nSaved results to {out_path}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        comparison = compare(results, baseline['results'], threshold = args.threshold)
+        print(f"\nCompared to {args.compare} (commit {baseline['meta'].get('commit')}):")
+        print(comparison.round(3).to_string(index = False))
+        if comparison['regression'].any():
+            sys.exit(1)
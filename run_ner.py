@@ -0,0 +1,99 @@
+"""
+Extracts entities from every ED provider note and writes the output of `ed_nlp.get_entities` as JSONL, one line per note.
+python3 run_ner.py --n-process 8 --batch-size 64
+
+With --job-dir the run is checkpointed per shard and results are cached, so re-running after a crash or a rule edit
+only processes what is missing:
+python3 run_ner.py --n-process 8 --job-dir processed/ner-job
+
+With --doc-dir processed docs are also checkpointed per shard, after the sentence splitter and after the target matcher,
+so a rule edit only reruns the pipes downstream of it (see ed_nlp.incremental):
+python3 run_ner.py --n-process 8 --doc-dir processed/ner-docs
+
+With --profile the first --limit notes are run in a single process through an instrumented pipeline and the time spent in
+each component and rule is printed and written to the given JSON file:
+python3 run_ner.py --profile processed/profile.json --limit 1000
+
+With --columnar, --output is a directory of parquet tables with sentences stored as offsets into the notes, read back with
+ed_nlp.columnar.read_entities:
+python3 run_ner.py --n-process 8 --columnar --output processed/ner-columnar
+
+With --sections entities are only extracted from the given sections (by default those in ed_nlp.sections.NER_SECTIONS),
+NER and ConText skip the rest of the note:
+python3 run_ner.py --n-process 8 --sections history_of_presenting_illness review_of_systems
+
+With --dedup notes with the same text are only processed once, and with --block-cache the lines of templated text
+already seen by a worker skip NER and ConText (see ed_nlp.dedup):
+python3 run_ner.py --n-process 8 --dedup --block-cache 50000
+"""
+import argparse
+import json
+import time
+from itertools import islice
+
+from ed_nlp.batch import run_batch, iter_notes, process_notes
+from ed_nlp.cache import run_checkpointed, merge_parts
+from ed_nlp.incremental import run_incremental
+from ed_nlp.sections import NER_SECTIONS
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--input', default='processed/ed-notes-tidy-patient-no-metadata.csv')
+    parser.add_argument('--output', default='processed/output_ner_full.jsonl')
+    parser.add_argument('--text-col', default='ED Provider Notes')
+    parser.add_argument('--n-process', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--use-model', action='store_true', help='use en_ner_bc5cdr_md instead of the target rules')
+    parser.add_argument('--job-dir', default=None, help='checkpoint shards here and resume from them on re-runs')
+    parser.add_argument('--cache', default=None, help='result cache, defaults to <job-dir>/cache.sqlite')
+    parser.add_argument('--doc-dir', default=None, help='checkpoint processed docs here and rerun only the pipes a rule edit affects')
+    parser.add_argument('--shard-size', type=int, default=10000)
+    parser.add_argument('--artifact-dir', default=None, help='load the pipeline from a snapshot here, see ed_nlp.artifact')
+    parser.add_argument('--profile', default=None, help='profile the pipeline and write per-component and per-rule timings here')
+    parser.add_argument('--limit', type=int, default=None, help='number of notes to profile, all by default')
+    parser.add_argument('--columnar', action='store_true', help='write parquet tables to the --output directory instead of JSONL')
+    parser.add_argument('--sections', nargs='*', default=None, help='only extract entities from these sections, NER_SECTIONS if none are given')
+    parser.add_argument('--dedup', action='store_true', help='process notes with the same text once')
+    parser.add_argument('--block-cache', type=int, default=None, help='cache the results of this many distinct lines per worker')
+    args = parser.parse_args()
+    if args.columnar and (args.job_dir or args.doc_dir or args.profile):
+        parser.error('--columnar is only written by a plain run, not with --job-dir, --doc-dir or --profile')
+
+    load_kwargs = {'use_rules': not args.use_model}
+    if args.sections is not None:
+        load_kwargs['sections'] = args.sections or NER_SECTIONS
+    if args.block_cache is not None:
+        load_kwargs['block_cache'] = args.block_cache
+
+    start = time.time()
+    if args.profile:
+        from ed_nlp.utils import load
+
+        nlp = load(profile=True, **load_kwargs)
+        start = time.time()
+        n_docs = 0
+        with open(args.output, 'w', encoding='utf-8') as f:
+            notes = islice(iter_notes(args.input, text_col=args.text_col), args.limit)
+            for record in process_notes(nlp, notes, use_rules=not args.use_model, batch_size=args.batch_size):
+                f.write(json.dumps(record) + '\n')
+                n_docs += 1
+        print(nlp.profiler.report())
+        nlp.profiler.save_json(args.profile)
+    elif args.doc_dir:
+        parts = run_incremental(args.input, args.doc_dir, shard_size=args.shard_size, n_process=args.n_process,
+                                batch_size=args.batch_size, text_col=args.text_col, artifact_dir=args.artifact_dir,
+                                **load_kwargs)
+        n_docs = merge_parts(parts, args.output)
+    elif args.job_dir:
+        parts = run_checkpointed(args.input, args.job_dir, cache_path=args.cache, shard_size=args.shard_size,
+                                 n_process=args.n_process, batch_size=args.batch_size, text_col=args.text_col,
+                                 artifact_dir=args.artifact_dir, **load_kwargs)
+        n_docs = merge_parts(parts, args.output)
+    else:
+        n_docs = run_batch(args.input, args.output, n_process=args.n_process, batch_size=args.batch_size,
+                           text_col=args.text_col, columnar=args.columnar, dedup=args.dedup, artifact_dir=args.artifact_dir,
+                           **load_kwargs)
+    elapsed = time.time() - start
+    print(f"{n_docs} notes in {elapsed:.1f}s ({n_docs / max(elapsed, 1e-9):.1f} notes/sec)")
@@ -0,0 +1,32 @@
+"""
+Serves entity extraction over HTTP for the app backend, see ed_nlp.service.
+python3 serve_ner.py --n-workers 4 --max-batch-size 32 --max-latency-ms 20 --port 8000
+
+curl -X POST localhost:8000/entities -d '{"text": "Pt has had fever for 5 days.", "csn": 1}'
+curl localhost:8000/metrics
+"""
+import argparse
+
+from ed_nlp.sections import NER_SECTIONS
+from ed_nlp.service import serve
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--n-workers', type=int, default=1, help='worker processes, each with its own pipeline')
+    parser.add_argument('--max-batch-size', type=int, default=32, help='most notes per nlp.pipe call')
+    parser.add_argument('--max-latency-ms', type=float, default=20, help='longest a note waits for a batch to fill')
+    parser.add_argument('--max-queue', type=int, default=10000, help='queued notes beyond this get a 503')
+    parser.add_argument('--use-model', action='store_true', help='use en_ner_bc5cdr_md instead of the target rules')
+    parser.add_argument('--artifact-dir', default=None, help='load the pipeline from a snapshot here, see ed_nlp.artifact')
+    parser.add_argument('--sections', nargs='*', default=None, help='only extract entities from these sections, NER_SECTIONS if none are given')
+    args = parser.parse_args()
+
+    load_kwargs = {'use_rules': not args.use_model}
+    if args.sections is not None:
+        load_kwargs['sections'] = args.sections or NER_SECTIONS
+    serve(args.host, args.port, n_workers=args.n_workers, max_batch_size=args.max_batch_size,
+          max_latency_ms=args.max_latency_ms, max_queue=args.max_queue, artifact_dir=args.artifact_dir, **load_kwargs)
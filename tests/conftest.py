@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the scripts at the root of the repo (pre_process_crystal.py, upload_docs.py, ...) are imported as modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,34 @@
+"""
+Block-cached extraction (`load(block_cache=...)`, see `ed_nlp.dedup`) against the whole-note pipeline.
+"""
+import pytest
+
+from ed_nlp.batch import doc_to_record
+from ed_nlp.synthetic import make_labeled_notes
+from ed_nlp.utils import load
+
+
+@pytest.fixture(scope="module")
+def texts():
+    texts = [note["text"] for note in make_labeled_notes(150, seed=5)]
+    # repeated notes and lines, so later notes are mostly made of cached blocks
+    return texts + texts[:30] + [text.replace("\n", "\n\n", 1) for text in texts[30:60]]
+
+
+@pytest.mark.parametrize("sentence_splitter", ["newline", "pysbd"])
+def test_block_cache_matches_whole_notes(texts, sentence_splitter):
+    expected = [doc_to_record(doc)["entities"] for doc in load(sentence_splitter=sentence_splitter).pipe(texts)]
+
+    nlp = load(sentence_splitter=sentence_splitter, block_cache=1000)
+    # one note at a time and in batches, so blocks are seen both within and across batches
+    result = [doc_to_record(nlp(text))["entities"] for text in texts[:20]]
+    result += [doc_to_record(doc)["entities"] for doc in nlp.pipe(texts[20:], batch_size=16)]
+
+    assert nlp.get_pipe("ed_nlp_block_cache").hits > 0
+    assert sum(map(len, expected)) > 0
+    assert result == expected
+
+
+def test_block_cache_requires_rules():
+    with pytest.raises(ValueError):
+        load(use_rules=False, block_cache=1000)
@@ -0,0 +1,74 @@
+"""
+Table export of the NER output (`ed_nlp.export`), loaded into SQLite and compared with the rows of the records.
+"""
+import json
+import sqlite3
+
+import pytest
+
+from ed_nlp.export import export_tables, load_sqlite
+
+FLAGS = ["is_negated", "is_uncertain", "is_historical", "is_hypothetical", "is_family"]
+
+
+def _modifier(text, category, start):
+    return {"modifier_text": text, "modifier_category": category, "modifier_direction": "FORWARD",
+            "modifier_start_char": start, "modifier_end_char": start + len(text),
+            "modifier_scope_start_char": start, "modifier_scope_end_char": start + 40}
+
+
+def _entity(text, start, modifiers=(), **flags):
+    return {"entity_text": text, "start_char": start, "end_char": start + len(text),
+            **{flag: flags.get(flag, False) for flag in FLAGS},
+            "current_sentence_extracted": f"No {text}, \"quoted\",\nover two lines.",
+            "section_category": "history_of_presenting_illness" if start < 50 else None,
+            "section_title": "HPI:" if start < 50 else None,
+            "modifiers": list(modifiers)}
+
+
+@pytest.fixture
+def records():
+    return [
+        {"csn": 101, "date": "2020-01-02", "text": "HPI: no fever, \"chills\"\nROS: cough",
+         "entities": [_entity("fever", 8, [_modifier("no", "NEGATED_EXISTENCE", 5)], is_negated=True),
+                      _entity("cough", 60)]},
+        {"csn": 102, "date": None, "text": "nothing found", "entities": []},
+        {"csn": 103, "date": "2021-03-04", "text": "possible pneumonia, mother had asthma",
+         "entities": [_entity("pneumonia", 9, [_modifier("possible", "POSSIBLE_EXISTENCE", 0),
+                                                _modifier("mother", "FAMILY", 20)], is_uncertain=True, is_family=True),
+                      _entity("asthma", 31, [_modifier("mother", "FAMILY", 20)], is_family=True)]},
+    ]
+
+
+def _expected(records, start_ent_id, context_id):
+    docs, entities, contexts = [], [], []
+    ent_id, ctx_id = start_ent_id, 1
+    for record in records:
+        docs.append((record["csn"], record["text"], record["date"]))
+        for ent in record["entities"]:
+            entities.append((ent_id, record["csn"], ent["entity_text"], ent["start_char"], ent["end_char"],
+                             *[int(ent[flag]) for flag in FLAGS], ent["current_sentence_extracted"],
+                             ent["section_category"], ent["section_title"]))
+            for modifier in ent["modifiers"]:
+                contexts.append(((ctx_id,) if context_id else ()) + (ent_id, *modifier.values()))
+                ctx_id += 1
+            ent_id += 1
+    return {"doc": docs, "entity": entities, "context": contexts}
+
+
+@pytest.mark.parametrize("fmt", ["csv", "parquet"])
+@pytest.mark.parametrize("context_id", [None, "ctx_id"])
+def test_load_sqlite_matches_records(tmp_path, records, fmt, context_id):
+    jsonl_path = tmp_path / "output_ner.jsonl"
+    jsonl_path.write_text("".join(json.dumps(record) + "\n" for record in records), encoding="utf-8")
+
+    # chunks of 2 records, so ids carry over between chunks
+    export_tables(str(jsonl_path), str(tmp_path / "tables"), fmt=fmt, start_ent_id=7, context_id=context_id, chunk_size=2)
+    n_rows = load_sqlite(str(tmp_path / "tables"), str(tmp_path / "ed.sqlite"), fmt=fmt, context_id=context_id)
+
+    expected = _expected(records, 7, context_id)
+    assert n_rows == {table: len(rows) for table, rows in expected.items()}
+    with sqlite3.connect(str(tmp_path / "ed.sqlite")) as conn:
+        for table, rows in expected.items():
+            # integer primary keys are rowids, so rows come back in key order rather than file order
+            assert sorted(conn.execute(f"SELECT * FROM {table}").fetchall()) == sorted(rows)
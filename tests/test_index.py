@@ -0,0 +1,52 @@
+"""
+Entity search with `EntityIndex` against the linear scan of `ed_nlp.utils.query_results`, on normalized entity text.
+"""
+import pytest
+
+from ed_nlp.index import EntityIndex, normalize
+from ed_nlp.synthetic import make_labeled_notes
+from ed_nlp.utils import get_entities, load, query_results
+
+# texts whose trigrams contain those of queries they don't contain ('ababab' in 'abab'), and odd case and whitespace
+EXTRA = [
+    {"entity_text": "abab", "is_negated": False, "section_category": None},
+    {"entity_text": "Abd  Pain", "is_negated": True, "section_category": "review_of_systems"},
+    {"entity_text": "x", "is_negated": None, "section_category": None},
+]
+QUERIES = ["", "a", "x", "Z", "ab", "ed", " p", "abd", "ing", "ABD PAIN", "ababab", "abab", "vomit", "Migraines",
+           "headache", "iting", "pain ", "not in any entity"]
+
+
+@pytest.fixture(scope="module")
+def entities():
+    nlp = load()
+    texts = [note["text"] for note in make_labeled_notes(100, seed=11)]
+    return [ent for doc in nlp.pipe(texts) for ent in get_entities(doc, use_rules=True)] + EXTRA
+
+
+@pytest.mark.parametrize("mmap", [None, False, True])
+def test_search_matches_query_results(tmp_path, entities, mmap):
+    index = EntityIndex.from_entities(entities)
+    if mmap is not None:
+        index.save(str(tmp_path / "entity-index"))
+        index = EntityIndex.load(str(tmp_path / "entity-index"), mmap=mmap)
+
+    normalized = [{**entity, "entity_text": normalize(entity["entity_text"]), "id": i} for i, entity in enumerate(entities)]
+    for query in QUERIES:
+        expected = [entity["id"] for entity in query_results(normalize(query), normalized)]
+        assert index.search(query).tolist() == expected, query
+        assert index.query_results(query, entities) == [entities[i] for i in expected]
+
+        negated = [i for i in expected if entities[i]["is_negated"] is False]
+        assert index.search(query, negated=False).tolist() == negated
+        ros = [i for i in expected if entities[i]["section_category"] == "review_of_systems"]
+        assert index.search(query, section_category="review_of_systems").tolist() == ros
+    assert 0 < len(index.search("vomit")) < len(index.search("i")) < len(index)
+
+
+def test_trigram_only_index(tmp_path, entities):
+    # an index saved before unigram and bigram postings falls back to scanning the texts for short queries
+    index = EntityIndex.from_entities(entities)
+    index.gram_sizes = [3]
+    for query in ["", "a", "ab", "abd", "ababab"]:
+        assert index.search(query).tolist() == EntityIndex.from_entities(entities).search(query).tolist()
@@ -0,0 +1,56 @@
+"""
+`LexiconMatcher` (the default target matcher in `load()`) against medspacy's `TargetMatcher`, on the pipeline's
+target rules plus a generated lexicon.
+"""
+import pytest
+
+from benchmark_lexicon import run, write_lexicon
+from ed_nlp.lexicon import LexiconMatcher, read_lexicon
+from ed_nlp.resources import target_rules
+from ed_nlp.synthetic import make_labeled_notes
+from ed_nlp.utils import load
+
+
+@pytest.fixture(scope="module")
+def nlp():
+    return load(fast_target_matcher=False)
+
+
+@pytest.fixture(scope="module")
+def texts():
+    return [note["text"] for note in make_labeled_notes(150, seed=5)]
+
+
+@pytest.mark.parametrize("size", [10, 200])
+def test_lexicon_matcher_matches_medspacy(tmp_path, nlp, texts, size):
+    path = str(tmp_path / "lexicon.csv")
+    write_lexicon(path, size, seed=1)
+    rules = target_rules + read_lexicon(path)
+
+    medspacy_matcher = nlp.create_pipe("medspacy_target_matcher")
+    medspacy_matcher.add(rules)
+    lexicon_matcher = LexiconMatcher(nlp)
+    lexicon_matcher.add(rules)
+
+    _, expected = run(medspacy_matcher, nlp, texts)
+    _, result = run(lexicon_matcher, nlp, texts)
+    # the target rules' regexes and the lexicon's prefix, substring and phrase rules all match some notes
+    literals = {literal for ents in expected for *_, literal in ents}
+    assert {"headache", "diarrh", "fever", "abdominal pain"} <= literals
+    assert result == expected
+
+
+def test_stem_cache_is_bounded(tmp_path, nlp, texts):
+    path = str(tmp_path / "lexicon.csv")
+    write_lexicon(path, 50, seed=1)
+    rules = target_rules + read_lexicon(path)
+    expected = LexiconMatcher(nlp)
+    expected.add(rules)
+    matcher = LexiconMatcher(nlp)
+    matcher.add(rules)
+    for table in matcher._stems.values():
+        table.cache_size = 20
+
+    _, result = run(matcher, nlp, texts)
+    assert all(0 < len(table.cache) <= 20 for table in matcher._stems.values())
+    assert result == run(expected, nlp, texts)[1]
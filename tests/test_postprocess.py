@@ -0,0 +1,34 @@
+"""
+The vectorized postprocessor (`ed_nlp.postprocess`, the default in `load()`) against medspacy's `Postprocessor`.
+"""
+from compare_postprocessors import augment, make_texts
+from ed_nlp.utils import load
+
+ATTRIBUTES = ["is_negated", "is_uncertain", "is_historical", "is_hypothetical", "is_family"]
+
+
+def _postprocessed(nlp, postprocessor: str, texts):
+    # entities are relabeled and 'presenting illness' entities added before postprocessing, so every rule fires
+    with nlp.select_pipes(disable=[postprocessor]):
+        docs = [augment(doc, seed=i) for i, doc in enumerate(nlp.pipe(texts))]
+    labels = [ent.label_ for doc in docs for ent in doc.ents]
+    n_presenting = sum(ent.text == "presenting illness" for doc in docs for ent in doc.ents)
+    docs = [nlp.get_pipe(postprocessor)(doc) for doc in docs]
+    ents = [[(ent.start, ent.end, ent.label_) + tuple(getattr(ent._, attr) for attr in ATTRIBUTES) for ent in doc.ents]
+            for doc in docs]
+    return labels, n_presenting, ents
+
+
+def test_array_postprocessor_matches_medspacy():
+    texts = make_texts(150, seed=3)
+    labels, n_presenting, expected = _postprocessed(load(fast_postprocessor=False), "medspacy_postprocessor", texts)
+    _, _, result = _postprocessed(load(), "ed_nlp_postprocessor", texts)
+
+    # every rule applies to some entities: the label rule removes the CHEMICAL ones, the text rule the 'presenting
+    # illness' ones and the question mark rule sets is_uncertain
+    kept = [ent for ents in expected for ent in ents]
+    assert "CHEMICAL" in labels and n_presenting > 0
+    assert {label for _, _, label, *_ in kept} <= {"DISEASE", "PROBLEM"}
+    assert len(kept) < len(labels) - n_presenting
+    assert any(is_uncertain for *_, is_uncertain, _, _, _ in kept)
+    assert result == expected
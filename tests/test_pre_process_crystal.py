@@ -0,0 +1,83 @@
+"""
+The vectorized note reassembly (`parse_crystal_notes`, `parse_crystal_notes_long`) against the original group-by-group
+loop, `_parse_crystal_notes_loop`, and the part-by-part parsing of `--streaming` against the concatenated parts.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ed_nlp.storage import to_parquet_safe
+from ed_nlp.synthetic import make_crystal_spreadsheet
+from pre_process_crystal import (_parse_crystal_notes_loop, crystal_json_to_df, iter_crystal_parts_long,
+                                 load_crystal_parts, parse_crystal_notes, parse_crystal_notes_long)
+
+
+@pytest.fixture
+def spreadsheet() -> pd.DataFrame:
+    # short fragments, so most notes are split over several rows
+    df = make_crystal_spreadsheet(40, seed=3, max_fragment_len=80)
+    csns = df['CSN'].unique()
+
+    # multi-line notes, and a missing fragment
+    df.loc[df.index[::7], 'Note Text'] = df.loc[df.index[::7], 'Note Text'] + '\n\n  Plan:\n'
+    df.loc[df.index[5], 'Note Text'] = np.nan
+    # a visit without notes: its rows have no note metadata
+    df.loc[df['CSN'] == csns[1], ['Note Type', 'File Time', 'Author Type', "Author's Service", 'Note Text']] = np.nan
+    # missing dates, for a whole visit and for a single note
+    df.loc[df['CSN'] == csns[2], ['Arrival Date', 'Arrival Time', 'Provider to Dispo']] = pd.NaT
+    df.loc[df['CSN'] == csns[3], 'Date of Birth'] = pd.NaT
+    df.loc[(df['CSN'] == csns[4]) & (df['Note Type'] == 'ED Provider Notes'), 'File Time'] = pd.NaT
+    # a visit with a missing MRN
+    df.loc[df['CSN'] == csns[5], 'MRN'] = np.nan
+    # rows out of visit order
+    return df.sample(frac=1, random_state=0).sort_values('CSN', kind='stable').reset_index(drop=True)
+
+
+def _frame(json_list) -> pd.DataFrame:
+    return crystal_json_to_df(json_list).reset_index(drop=True)
+
+
+def test_parse_crystal_notes_matches_loop(spreadsheet):
+    expected = _parse_crystal_notes_loop(spreadsheet.copy())
+    result = parse_crystal_notes(spreadsheet.copy())
+
+    assert any(not visit['Notes'] for visit in expected)
+    assert [len(visit['Notes']) for visit in result] == [len(visit['Notes']) for visit in expected]
+    pd.testing.assert_frame_equal(_frame(result), _frame(expected))
+
+
+def test_parse_crystal_notes_long_matches_loop(spreadsheet):
+    expected = _frame(_parse_crystal_notes_loop(spreadsheet.copy()))
+    result = parse_crystal_notes_long(spreadsheet.copy())
+
+    # going through dicts, the loop's all-missing object columns come back as float
+    pd.testing.assert_frame_equal(result, expected[result.columns.tolist()], check_dtype=False)
+
+
+def test_parts_parsed_one_at_a_time_match_concatenated(spreadsheet, tmp_path):
+    # the parts split a visit, and only the first part is missing a CTAS, so the others store it as integers
+    spreadsheet.loc[spreadsheet['CSN'] == spreadsheet['CSN'].iloc[0], 'CTAS'] = np.nan
+    bounds = [0, len(spreadsheet) // 3, len(spreadsheet) // 3 + 1, len(spreadsheet)]
+    part_paths = []
+    for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        part = spreadsheet.iloc[start:end].copy()
+        if part['CTAS'].notna().all():
+            part['CTAS'] = part['CTAS'].astype('int64')
+        part_paths.append(str(tmp_path / f'part-{i}.parquet'))
+        to_parquet_safe(part).to_parquet(part_paths[-1], index=False)
+
+    expected = parse_crystal_notes_long(load_crystal_parts(part_paths))
+    long_dfs = list(iter_crystal_parts_long(part_paths))
+
+    # each visit is in a single frame, so the csv written frame by frame is grouped by CSN/MRN
+    visits = [set(zip(long_df['CSN'], long_df['MRN'])) for long_df in long_dfs]
+    assert len(long_dfs) > len(part_paths) - 1 and sum(map(len, visits)) == len(set().union(*visits))
+    csv, expected_csv = io.StringIO(), io.StringIO()
+    for i, long_df in enumerate(long_dfs):
+        long_df.to_csv(csv, header=i == 0, index=False)
+    expected.to_csv(expected_csv, index=False)
+    result, expected = (pd.read_csv(io.StringIO(f.getvalue()), dtype=str).sort_values(['CSN', 'MRN'], kind='stable')
+                        .reset_index(drop=True) for f in [csv, expected_csv])
+    pd.testing.assert_frame_equal(result, expected)
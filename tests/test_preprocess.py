@@ -0,0 +1,66 @@
+"""
+`FastPreprocessor` (the default in `load()`) against medspacy's `Preprocessor`, which runs every rule over every note.
+"""
+import re
+
+import pytest
+from medspacy.preprocess import Preprocessor, PreprocessingRule
+
+from ed_nlp.preprocess import FastPreprocessor, required_literal
+from ed_nlp.resources import preprocess_rules
+from ed_nlp.synthetic import make_labeled_notes
+
+EDGE_CASES = [
+    # the patient name rule: with and without a prefix up to 'presented', which can't cross a line
+    "John Smith, a 5 y.o. male presented to the ED with fever.  HPI: fever for 2 days.",
+    "5 y.o. male presented to the ED with fever.",
+    "Presented to the ED with fever.",
+    "jane doe\npresented with cough",
+    "Pt was seen. The patient presented with cough, presented again later.",
+    # the hpi rules: twice (the greedy rule), once, inside a word and as a prefix
+    "HPI: cough. ROS: ok. HPI again: none.",
+    "hpi cough",
+    "chpi and hpix are not hpi.",
+    # review of systems, with and without a word boundary after it
+    "Review of Systems  Neuro: headache         Review of systemsx",
+    "review of systems",
+    # none of the literals
+    "",
+    "   ",
+    "Fever and cough for 3 days.\n\nNo rash.",
+]
+
+
+@pytest.fixture(scope="module")
+def texts():
+    return [note["text"] for note in make_labeled_notes(200, seed=9)] + EDGE_CASES
+
+
+def test_fast_preprocessor_matches_medspacy(texts):
+    # without a tokenizer both return the preprocessed text
+    expected = Preprocessor(lambda text: text)
+    expected.add(preprocess_rules)
+    fast = FastPreprocessor(lambda text: text)
+    fast.add(preprocess_rules)
+
+    result = [fast.preprocess(text) for text in texts]
+    assert result == [expected(text) for text in texts]
+    assert [fast(text) for text in texts] == result
+    # the patient name rule replaced some prefixes and left the other notes alone
+    assert 0 < sum(text.startswith("[Patient Name] presented") for text in result) < len(result)
+
+
+def test_required_literal():
+    assert required_literal(re.compile(r"\bhpi\b")) == "hpi"
+    assert required_literal(re.compile(r"review of systems\b")) == "review of systems"
+    assert required_literal(re.compile("^[a-z](.*?)presented")) == "presented"
+    assert required_literal(re.compile(r"\s{2,}")) is None
+    assert required_literal(re.compile("hpi", re.IGNORECASE)) is None
+
+
+def test_add_single_rule():
+    preprocessor = FastPreprocessor(lambda text: text)
+    preprocessor.add(PreprocessingRule(re.compile(r"\bhpi\b"), repl="history of presenting illness:"))
+    preprocessor.add([lambda text: text.upper()])
+    assert len(preprocessor.rules) == 2
+    assert preprocessor("hpi: fever") == "HISTORY OF PRESENTING ILLNESS:: FEVER"
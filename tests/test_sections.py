@@ -0,0 +1,36 @@
+"""
+Section-aware extraction (`load(sections=...)`, see `ed_nlp.sections`) against the whole-note pipeline.
+"""
+import pytest
+
+from ed_nlp.batch import doc_to_record
+from ed_nlp.sections import NER_SECTIONS, section_regions
+from ed_nlp.synthetic import make_labeled_notes
+from ed_nlp.utils import load
+
+
+@pytest.fixture(scope="module")
+def texts():
+    return [note["text"] for note in make_labeled_notes(150, seed=7)]
+
+
+@pytest.mark.parametrize("sentence_splitter", ["newline", "pysbd"])
+def test_sections_match_whole_notes(texts, sentence_splitter):
+    full = load(sentence_splitter=sentence_splitter)
+    nlp = load(sentence_splitter=sentence_splitter, sections=NER_SECTIONS)
+
+    n_modifiers = 0
+    for full_doc, doc in zip(full.pipe(texts), nlp.pipe(texts)):
+        # the synthetic notes have no sentence across a section title, so the records of the entities in the
+        # selected sections are the same, modifiers (mapped back from the section copies) included
+        regions = [(doc[start].idx, doc[end - 1].idx + len(doc[end - 1])) for start, end in section_regions(doc, NER_SECTIONS)]
+        expected = [record for record, ent in zip(doc_to_record(full_doc)["entities"], full_doc.ents)
+                    if any(start <= ent.start_char and ent.end_char <= end for start, end in regions)]
+        assert doc_to_record(doc)["entities"] == expected
+
+        for ent in doc.ents:
+            for modifier in ent._.modifiers:
+                assert modifier.doc is doc and modifier.scope.doc is doc
+                assert modifier.num_targets > 0
+                n_modifiers += 1
+    assert n_modifiers > 0
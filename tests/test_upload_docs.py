@@ -0,0 +1,69 @@
+"""
+`upload_docs.py --bulk` against the per-row ORM upload, both into SQLite. needs flask_sqlalchemy and the app package
+upload_docs.py imports its models from, skipped otherwise.
+"""
+import json
+
+import pytest
+
+pytest.importorskip("flask_sqlalchemy")
+upload_docs = pytest.importorskip("upload_docs")
+
+RECORDS = [
+    {"csn": 101, "date": "2020-01-02", "text": "HPI: no fever\nROS: cough",
+     "entities": [
+         {"entity_text": "fever", "start_char": 8, "end_char": 13, "is_negated": True, "is_uncertain": False,
+          "is_historical": False, "is_hypothetical": False, "is_family": False,
+          "current_sentence_extracted": "HPI: no fever", "section_category": "history_of_presenting_illness",
+          "section_title": "HPI:",
+          "modifiers": [{"modifier_text": "no", "modifier_category": "NEGATED_EXISTENCE", "modifier_direction": "FORWARD",
+                         "modifier_start_char": 5, "modifier_end_char": 7, "modifier_scope_start_char": 5,
+                         "modifier_scope_end_char": 13}]},
+         {"entity_text": "cough", "start_char": 19, "end_char": 24, "is_negated": False, "is_uncertain": False,
+          "is_historical": False, "is_hypothetical": False, "is_family": False,
+          "current_sentence_extracted": "ROS: cough", "section_category": "review_of_systems", "section_title": "ROS:",
+          "modifiers": []},
+     ]},
+    {"csn": 102, "date": "2020-01-03", "text": "nothing found", "entities": []},
+    {"csn": 103, "date": "2021-03-04", "text": "possible pneumonia in mother",
+     "entities": [
+         {"entity_text": "pneumonia", "start_char": 9, "end_char": 18, "is_negated": False, "is_uncertain": True,
+          "is_historical": False, "is_hypothetical": False, "is_family": True,
+          "current_sentence_extracted": "possible pneumonia in mother", "section_category": None, "section_title": None,
+          "modifiers": [{"modifier_text": "possible", "modifier_category": "POSSIBLE_EXISTENCE",
+                         "modifier_direction": "FORWARD", "modifier_start_char": 0, "modifier_end_char": 8,
+                         "modifier_scope_start_char": 0, "modifier_scope_end_char": 28},
+                        {"modifier_text": "mother", "modifier_category": "FAMILY", "modifier_direction": "BACKWARD",
+                         "modifier_start_char": 22, "modifier_end_char": 28, "modifier_scope_start_char": 0,
+                         "modifier_scope_end_char": 22}]},
+     ]},
+]
+
+
+def _upload(tmp_path, monkeypatch, name, upload, **kwargs):
+    jsonl_path = tmp_path / "output_ner.jsonl"
+    jsonl_path.write_text("".join(json.dumps(record) + "\n" for record in RECORDS), encoding="utf-8")
+    monkeypatch.setenv("ST_DATABASE_URI", f"sqlite:///{tmp_path / name}")
+
+    app = upload_docs.get_register_app()
+    db = upload_docs.db
+    with app.app_context():
+        db.create_all()
+    upload(app, db, str(jsonl_path), **kwargs)
+
+    rows = {}
+    with app.app_context():
+        for model in [upload_docs.models.Doc, upload_docs.models.Entity, upload_docs.models.Context]:
+            table = model.__table__
+            query = table.select().order_by(*table.primary_key.columns)
+            rows[table.name] = [tuple(row) for row in db.session.execute(query).fetchall()]
+    return rows
+
+
+def test_bulk_upload_matches_orm(tmp_path, monkeypatch):
+    expected = _upload(tmp_path, monkeypatch, "orm.sqlite", upload_docs.upload_per_row)
+    # chunks of 2 docs, so entity ids carry over between chunks
+    result = _upload(tmp_path, monkeypatch, "bulk.sqlite", upload_docs.bulk_upload, chunk_size=2)
+
+    assert [len(rows) for rows in expected.values()] == [3, 3, 3]
+    assert result == expected
@@ -1,4 +1,7 @@
 # 163865it [1:31:29, 29.85it/s]
+# python3 upload_docs.py --bulk  loads the same file in chunks with executemany inserts instead of per-row flushes
+# python3 export_tables.py  writes the same rows as csv/parquet files to bulk load with LOAD DATA or COPY
+import argparse
 import os
 import logging
 import pandas as pd
@@ -9,8 +12,10 @@ from dataclasses import asdict
 from typing import Any, Callable, Dict, List, Union, Iterable, Mapping
 sys.path.append('/home/dso/ed/ed-app/services/flask')
 
+from itertools import islice
 from tqdm import tqdm
 from flask import Flask, logging as flask_logging, jsonify
+from sqlalchemy import func
 from sqlalchemy.orm import contains_eager
 from flask_sqlalchemy import SQLAlchemy
 
@@ -50,13 +55,10 @@ def get_register_app():
 
     return app
 
-if __name__ == "__main__":
-
-    app = get_register_app()
-    db = SQLAlchemy(app)
-
-    file = '/home/dso/ed/output_ner_full.jsonl'
-    dat =[]
+def upload_per_row(app, db, file):
+    """
+    uploads the NER output one document at a time through the ORM
+    """
     with open(file,'r', encoding='utf-8') as j:
         for line in tqdm(j):   
 
@@ -117,7 +119,97 @@ if __name__ == "__main__":
                                 modifier_scope_start_char = modifier.get('modifier_scope_start_char'),
                                 modifier_scope_end_char = modifier.get('modifier_scope_end_char')
                             )
-                        db.session.add(mod_obj)
+                            db.session.add(mod_obj)
                 db.session.flush()
                 db.session.commit()
-            app.logger.info('Done')
\ No newline at end of file
+            app.logger.info('Done')
+
+
+def records_to_rows(records: Iterable[Dict[str, Any]], next_ent_id: int):
+    """
+    flattens parsed NER records into Doc, Entity and Context rows. 
+    entity ids are assigned here, starting at `next_ent_id`, so Context rows can reference them without a flush.
+    returns the three lists of rows and the next free entity id.
+    """
+    doc_rows, ent_rows, ctx_rows = [], [], []
+    for record in records:
+        csn = record.get('csn')
+        doc_rows.append({'csn': csn, 'text': record.get('text'), 'date': record.get('date')})
+
+        for entity in record['entities']:
+            ent_rows.append({'ent_id': next_ent_id,
+                             'csn': csn,
+                             'text': entity['entity_text'],
+                             'start_char': entity.get('start_char'),
+                             'end_char': entity.get('end_char'),
+                             'is_negated': entity.get('is_negated'),
+                             'is_uncertain': entity.get('is_uncertain'),
+                             'is_historical': entity.get('is_historical'),
+                             'is_hypothetical': entity.get('is_hypothetical'),
+                             'is_family': entity.get('is_family'),
+                             'sentence': entity.get('current_sentence_extracted'),
+                             'section_category': entity.get('section_category'),
+                             'section_title': entity.get('section_title')})
+
+            for modifier in entity.get('modifiers', []):
+                ctx_rows.append({'ent_id': next_ent_id,
+                                 'modifier_text': modifier.get('modifier_text'),
+                                 'modifier_category': modifier.get('modifier_category'),
+                                 'modifier_direction': modifier.get('modifier_direction'),
+                                 'modifier_start_char': modifier.get('modifier_start_char'),
+                                 'modifier_end_char': modifier.get('modifier_end_char'),
+                                 'modifier_scope_start_char': modifier.get('modifier_scope_start_char'),
+                                 'modifier_scope_end_char': modifier.get('modifier_scope_end_char')})
+            next_ent_id += 1
+
+    return doc_rows, ent_rows, ctx_rows, next_ent_id
+
+
+def bulk_upload(app, db, file, chunk_size = 1000):
+    """
+    uploads the NER output in chunks of `chunk_size` documents within a single app context.
+    each chunk is three executemany inserts (Doc, Entity, Context) and one commit.
+    entity ids are assigned client-side from the current max id, so nothing else should write to the Entity table during the upload.
+    """
+    n_docs = 0
+    with app.app_context(), open(file, 'r', encoding='utf-8') as j:
+        next_ent_id = (db.session.query(func.max(models.Entity.ent_id)).scalar() or 0) + 1
+        progress = tqdm()
+
+        while True:
+            lines = list(islice(j, chunk_size))
+            if not lines:
+                break
+
+            doc_rows, ent_rows, ctx_rows, next_ent_id = records_to_rows((json.loads(line) for line in lines), next_ent_id)
+
+            for table, rows in [(models.Doc.__table__, doc_rows), 
+                                (models.Entity.__table__, ent_rows), 
+                                (models.Context.__table__, ctx_rows)]:
+                if rows:
+                    db.session.execute(table.insert(), rows)
+            db.session.commit()
+
+            n_docs += len(doc_rows)
+            progress.update(len(doc_rows))
+
+        progress.close()
+    app.logger.info(f'Done, uploaded {n_docs} docs')
+    return n_docs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', default='/home/dso/ed/output_ner_full.jsonl')
+    parser.add_argument('--bulk', action='store_true', help='batched executemany inserts instead of per-row ORM flushes')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    app = get_register_app()
+    db = SQLAlchemy(app)
+
+    if args.bulk:
+        bulk_upload(app, db, args.file, chunk_size = args.chunk_size)
+    else:
+        upload_per_row(app, db, args.file)